@@ -1,60 +1,36 @@
 #!/usr/bin/python
 from __future__ import annotations
 
-import json
+import time
+
+STARTED = time.perf_counter()  # taken before the heavy imports, for --startup-profile
+
+import argparse
 import os
-import shutil
-import stat
-import subprocess
+import signal
 import sys
-import tarfile
 import traceback
-import time
-import zipfile
-from io import BytesIO
 from collections.abc import Callable, Iterable
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from pprint import pprint
-
-import requests
-from tqdm import tqdm
-
-try:
-    from rich import print as rprint
-
-except ImportError:
-    rprint = pprint
-
 
-import ffmpeg
-from cfg_argparser import CfgDict
-from PySide6 import QtGui, QtWidgets
+from PySide6 import QtCore, QtGui, QtWidgets
 from PySide6.QtCore import Qt, QThread, Signal, Slot
 from PySide6.QtWidgets import (QCheckBox, QComboBox, QFrame, QLabel, QLineEdit,
-                               QProgressBar, QPushButton, QSlider, QToolButton,
-                               QWidget)
-
+                               QListWidget, QProgressBar, QPushButton, QSlider,
+                               QToolButton, QWidget)
+
+from config_store import WriteBehindConfig
+from engine import (AUTO, CPU_COUNT, DEFAULTS, IMAGE_FORMATS, PRESETS, SCALERS, Encoder, get_encoder,
+                    resolve_threads)
+from governor import GOVERNOR
+from jobs import Job, JobQueue, JobState, converted_path
+from journal import get_journal
+from predict import Predictor
+from thumbnails import TILE_WIDTH, contact_sheet
 from utilities import Timer
 
-CPU_COUNT = os.cpu_count()
-PROGRAM_ORIGIN = Path(os.path.dirname(__file__))
-
-
-def byte_format(size, suffix="B"):
-    '''modified version of: https://stackoverflow.com/a/1094933'''
-    size = "".join([val for val in size if val.isnumeric()])
-    if size != "":
-        size = int(size)
-        for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti']:
-            if abs(size) < 2**10:
-                return f"{size:3.1f}{unit}{suffix}"
-            size /= 2**10
-        return f"{size:3.1f}{unit}{suffix}"
-    else:
-        return f"N/A{suffix}"
-
 
 @dataclass
 class Widget:
@@ -104,7 +80,7 @@ input_bar = (
 output_bar = (
     Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Output:"}),
     Widget((1, 1, 2), "text", QLineEdit, {"align": "Left"}),
-    Widget((3, 1, 1), "dropdown", QComboBox, {"items": ["mp4", "mkv", "avi", "ts", "png"]}),
+    Widget((3, 1, 1), "dropdown", QComboBox, {"items": ["mp4", "mkv", "avi", "ts"] + IMAGE_FORMATS}),
 )
 
 video_bar = (
@@ -125,25 +101,68 @@ audio_bar = (
 threads_bar = (
     Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Threads:"}),
     Widget((1, 1, 2), "slider", QSlider, {"orientation": "Horizontal",
-                                          "range": (1, CPU_COUNT)}),
+                                          "range": (0, CPU_COUNT)}),  # 0 is auto
     Widget((3, 1, 1), "label", QLabel, {"align": "Center", "text": "NaN"}),
 )
 
 speed_bar = (
     Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Speed:"}),
-    Widget((1, 1, 2), "dropdown", QComboBox, {"items": ["veryslow", "slower", "slow",
-                                                        "medium",   "fast",   "faster",
-                                                        "veryfast", "ultrafast"]}),
+    Widget((1, 1, 2), "dropdown", QComboBox, {"items": PRESETS + [AUTO]}),
+    Widget((3, 1, 1), "force", QCheckBox, {"text": "Re-encode"}),
 )
 fps_bar = (
     Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "fps:"}),
     Widget((1, 1, 2), "fps", QLineEdit, {"align": "Left", }),
 )
 
+# image sequences only
+frames_bar = (
+    Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Frames:"}),
+    Widget((1, 1, 1), "start", QLineEdit, {"align": "Left", "placeholder": "first"}),
+    Widget((2, 1, 1), "end", QLineEdit, {"align": "Left", "placeholder": "last"}),
+    Widget((3, 1, 1), "step", QLineEdit, {"align": "Left", "placeholder": "every 1"}),
+)
+
+image_bar = (
+    Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Compression:"}),
+    Widget((1, 1, 2), "compression", QSlider, {"orientation": "Horizontal",
+                                               "range": (0, 9)}),
+    Widget((1, 1, 2), "quality", QSlider, {"orientation": "Horizontal",
+                                           "range": (1, 100)}),
+    Widget((3, 1, 1), "label", QLabel, {"align": "Center", "text": "NaN"}),
+)
+
 res_bar = (
     Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "resolution:"}),
-    Widget((1, 1, 2), "line", QLineEdit, {"align": "Left"}),
-    Widget((3, 1, 1), "dropdown", QComboBox, {"items": ["copy", "max", "min"]}),
+    Widget((1, 1, 1), "line", QLineEdit, {"align": "Left"}),
+    Widget((1, 1, 1), "fit", QLineEdit, {"align": "Left", "placeholder": "WxH"}),
+    Widget((2, 1, 1), "scaler", QComboBox, {"items": SCALERS}),
+    Widget((3, 1, 1), "dropdown", QComboBox, {"items": ["copy", "max", "min", "fit"]}),
+)
+
+segment_bar = (
+    Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Segments:"}),
+    Widget((1, 1, 2), "slider", QSlider, {"orientation": "Horizontal",
+                                          "range": (1, CPU_COUNT)}),
+    Widget((3, 1, 1), "checkbox", QCheckBox, {"text": "Split"}),
+)
+
+workers_bar = (
+    Widget((0, 1, 1), "dialog", QLabel, {"align": "Center", "text": "Workers:"}),
+    Widget((1, 1, 2), "slider", QSlider, {"orientation": "Horizontal",
+                                          "range": (1, CPU_COUNT)}),
+    Widget((3, 1, 1), "label", QLabel, {"align": "Center", "text": "NaN"}),
+)
+
+queue_bar = (
+    Widget((0, 1, 4), "jobs", QListWidget, {}, hideable=False),
+)
+
+queue_control_bar = (
+    Widget((0, 1, 1), "add", QPushButton, {"text": "Add files"}),
+    Widget((1, 1, 1), "up", QPushButton, {"text": "Up"}),
+    Widget((2, 1, 1), "down", QPushButton, {"text": "Down"}),
+    Widget((3, 1, 1), "cancel", QPushButton, {"text": "Cancel job"}),
 )
 
 stat_dialog = (
@@ -156,8 +175,11 @@ progress_bar = (
 )
 
 control_bar = (
-    Widget((0, 1, 4), "start_button", QPushButton, {"text": "Start"}),
-    Widget((0, 1, 4), "stop_button", QPushButton, {"text": "Stop"}),
+    Widget((0, 1, 3), "start_button", QPushButton, {"text": "Start"}),
+    Widget((3, 1, 1), "predict_button", QPushButton, {"text": "Predict"}),
+    Widget((0, 1, 1), "pause_button", QPushButton, {"text": "Pause"}),
+    Widget((1, 1, 1), "finish_button", QPushButton, {"text": "Finish now"}),
+    Widget((2, 1, 2), "stop_button", QPushButton, {"text": "Stop"}),
     Widget((0, 1, 3), "yes_button", QPushButton, {"text": "Continue"}),
     Widget((3, 1, 1), "no_button", QPushButton, {"text": "Cancel"})
 )
@@ -178,6 +200,8 @@ class Status(Enum):
     RUNNING = 1
     OVERWRITE = 2
     CONFIRM_CLOSE = 3
+    RESUME = 4
+    STOPPING = 5  # the running jobs were asked to finish early
 
 
 class Mode(Enum):
@@ -187,13 +211,13 @@ class Mode(Enum):
 
 
 class MainWindow(QtWidgets.QWidget):
-    def __init__(self, t: Timer, defaults: CfgDict):
+    def __init__(self, t: Timer, defaults: WriteBehindConfig | None = None):
+        '''Builds the widgets. The config is bound separately by bind_config(),
+        so the window can be shown before config.json is read.'''
         super(MainWindow, self).__init__()
         self.t = t
-        self.t.print("Initializing MainWindow")
-        self.config = defaults
         self.setWindowTitle("TurnH264")
-        self.resize(400, 450)
+        self.resize(400, 600)
         self.setMinimumSize(320, 300)
         self.layout = QtWidgets.QGridLayout(self)
         self.barnum = 0
@@ -212,14 +236,27 @@ class MainWindow(QtWidgets.QWidget):
         self.threads_bar = add_bar(threads_bar)
         self.speed_bar = add_bar(speed_bar)
         self.fps_bar = add_bar(fps_bar)
+        self.frames_bar = add_bar(frames_bar)
+        self.image_bar = add_bar(image_bar)
+        self.segment_bar = add_bar(segment_bar)
+        self.workers_bar = add_bar(workers_bar)
+        self.queue_bar: QListWidget = add_bar(queue_bar).jobs
+        self.queue_control_bar = add_bar(queue_control_bar)
         self.progress_bar: QProgressBar = add_bar(progress_bar).progress_bar
         self.stat_dialog: StatusLabel = add_bar(stat_dialog).stats
         self.control_bar = add_bar(control_bar)
 
-        t.print("Created widgets")
-
+        self.paused = False  # the running jobs are paused, see pause_clicked
         self.control_mode = Mode.START  # control_mode is a property with a setter method
         self.status = Status.READY
+        t.lap("widget construction")
+
+        if defaults is not None:
+            self.bind_config(defaults)
+
+    def bind_config(self, defaults: WriteBehindConfig):
+        '''Fills the widgets from the config and keeps the config updated'''
+        self.config = defaults
 
         # saving row
         with self.save_bar as sbar:
@@ -275,13 +312,26 @@ class MainWindow(QtWidgets.QWidget):
 
         # thread row
         with self.threads_bar as tbar:
-            self.add_to_config({'threads': CPU_COUNT * 0.75}, tbar.slider.setValue, tbar.slider.valueChanged)
-            tbar.slider.valueChanged.connect(lambda val: tbar.label.setText(f"{val}/{CPU_COUNT}"))
+            # older configs stored CPU_COUNT * 0.75, a float
+            self.add_to_config({'threads': DEFAULTS['threads']}, tbar.slider.setValue, tbar.slider.valueChanged,
+                               config_type=int,
+                               widget_type=int,
+                               default_fallback=lambda x: False)  # 0 is auto, not empty
+            tbar.slider.valueChanged.connect(
+                lambda val: tbar.label.setText(f"{val}/{CPU_COUNT}" if val else f"auto ({resolve_threads(0)})"))
             tbar.slider.valueChanged.emit(self.config['threads'])
 
         # speed row
         with self.speed_bar as sbar:
             self.add_to_config({'speed': 'slow'}, sbar.dropdown.setCurrentText, sbar.dropdown.currentTextChanged)
+            # h264 inputs that wouldn't change are only remuxed, unless this is checked
+            self.add_to_config({'force_encode': False},
+                               sbar.force.setCheckState,
+                               sbar.force.stateChanged,
+                               widget_type=lambda b: {True: Qt.CheckState.Checked,
+                                                      False: Qt.CheckState.Unchecked}.get(b, Qt.CheckState.Unchecked),
+                               config_type=lambda state: sbar.force.checkState() == Qt.CheckState.Checked,
+                               default_fallback=lambda x: False)
 
         # fps row
         with self.fps_bar as fbar:
@@ -291,6 +341,24 @@ class MainWindow(QtWidgets.QWidget):
             fbar.fps.setValidator(QtGui.QDoubleValidator())  # Only accepts numbers
             fbar.fps.textChanged.connect(self.ping_changing_input)
 
+        # image sequence rows
+        with self.frames_bar as frbar:
+            for widget, key in ((frbar.start, 'frame_start'), (frbar.end, 'frame_end'), (frbar.step, 'frame_step')):
+                widget.setValidator(QtGui.QIntValidator(0, 2**31 - 1))
+                self.add_to_config({key: DEFAULTS[key]}, widget.setText, widget.textChanged,
+                                   config_type=int,
+                                   widget_type=lambda x: str(x) if x else "")
+        with self.image_bar as ibar:
+            self.add_to_config({'compression_level': DEFAULTS['compression_level']},
+                               ibar.compression.setValue, ibar.compression.valueChanged,
+                               default_fallback=lambda x: False)  # 0 is uncompressed
+            self.add_to_config({'jpeg_quality': DEFAULTS['jpeg_quality']},
+                               ibar.quality.setValue, ibar.quality.valueChanged)
+            ibar.compression.valueChanged.connect(lambda val: ibar.label.setText(str(val)))
+            ibar.quality.valueChanged.connect(lambda val: ibar.label.setText(f"{val}%"))
+        self.output_bar.dropdown.currentTextChanged.connect(self.extension_changed)
+        self.extension_changed(self.config['extension'])
+
         # resolution row
         with self.res_bar as rbar:
             self.add_to_config({'res_dropdown': 'copy'}, rbar.dropdown.setCurrentText, rbar.dropdown.currentTextChanged)
@@ -298,27 +366,90 @@ class MainWindow(QtWidgets.QWidget):
                                config_type=int,
                                widget_type=str)
             rbar.line.setValidator(QtGui.QIntValidator())
+            self.add_to_config({'fit_size': DEFAULTS['fit_size']}, rbar.fit.setText, rbar.fit.textChanged)
+            self.add_to_config({'scaler': DEFAULTS['scaler']}, rbar.scaler.setCurrentText,
+                               rbar.scaler.currentTextChanged)
             rbar.dropdown.currentIndexChanged.connect(self.res_dropdown_changed)
             rbar.dropdown.currentIndexChanged.emit(rbar.dropdown.currentIndex())
 
+        # segment row, splits a single input across several ffmpeg processes
+        with self.segment_bar as sgbar:
+            self.add_to_config({'segmented': False},
+                               sgbar.checkbox.setCheckState,
+                               sgbar.checkbox.stateChanged,
+                               widget_type=lambda b: {True: Qt.CheckState.Checked,
+                                                      False: Qt.CheckState.Unchecked}.get(b, Qt.CheckState.Unchecked),
+                               config_type=lambda state: sgbar.checkbox.checkState() == Qt.CheckState.Checked,
+                               default_fallback=lambda x: False)
+            self.add_to_config({'segment_workers': 4}, sgbar.slider.setValue, sgbar.slider.valueChanged)
+            sgbar.slider.valueChanged.connect(
+                lambda val: sgbar.checkbox.setText(f"Split ({val})"))
+            sgbar.slider.valueChanged.emit(self.config['segment_workers'])
+
+        # worker row
+        with self.workers_bar as wbar:
+            self.add_to_config({'workers': 1}, wbar.slider.setValue, wbar.slider.valueChanged)
+            wbar.slider.valueChanged.connect(lambda val: wbar.label.setText(f"{val}/{CPU_COUNT}"))
+            wbar.slider.valueChanged.emit(self.config['workers'])
+
+        # job queue
+        self.queue = JobQueue(self.config['workers'], resolve_threads(self.config['threads']), journal=get_journal())
+        self.queue.admit = GOVERNOR.admit
+        # starts the jobs the governor held back once the load or memory allows it
+        self.admit_timer = QtCore.QTimer(self)
+        self.admit_timer.setInterval(1000)
+        self.admit_timer.timeout.connect(lambda: self.queue.pending and self.fill_workers())
+        self.workers: dict[int, FfmpegThread] = {}  # job id -> running thread
+        self.predictor: PredictThread | None = None
+        self.thumbnails: dict[str, str] = {}  # input -> thumbnail, shown as the job's icon
+        self.thumbnailers: list[ThumbnailThread] = []
+        self.sheets: list[QLabel] = []  # open contact sheet windows
+        self.queue_bar.setIconSize(QtCore.QSize(TILE_WIDTH // 4, TILE_WIDTH // 4))
+        self.queue_bar.itemDoubleClicked.connect(self.job_double_clicked)
+        self.workers_bar.slider.valueChanged.connect(self.workers_changed)
+        with self.queue_control_bar as qbar:
+            qbar.add.clicked.connect(self.add_files_clicked)
+            qbar.up.clicked.connect(lambda: self.move_selected_job(-1))
+            qbar.down.clicked.connect(lambda: self.move_selected_job(1))
+            qbar.cancel.clicked.connect(self.cancel_selected_job)
+
         with self.control_bar as cbar:
             cbar.start_button.clicked.connect(self.start_clicked)
+            cbar.predict_button.clicked.connect(self.predict_clicked)
+            cbar.pause_button.clicked.connect(self.pause_clicked)
+            cbar.finish_button.clicked.connect(self.finish_clicked)
             cbar.stop_button.clicked.connect(self.stop_clicked)
+            cbar.pause_button.setToolTip("Pauses the running encodes without losing their progress")
+            cbar.finish_button.setToolTip("Stops the running encodes but keeps what they encoded, "
+                                          "the queued jobs stay queued")
+            cbar.stop_button.setToolTip("Cancels the running encodes and removes their outputs")
             cbar.yes_button.clicked.connect(self.yes_clicked)
             cbar.no_button.clicked.connect(self.no_clicked)
 
-        # ffmpeg thread
-        self.ffmpeg_thread = FfmpegThread(self)
-        self.ffmpeg_thread.config = self.config  # bind the thread configs
-        self.ffmpeg_thread.progress.connect(self.progress_bar.setValue)
-        self.ffmpeg_thread.finished.connect(self.ffmpeg_finished)
-        self.ffmpeg_thread.status.connect(self.set_status)
-        self.ffmpeg_thread.max_prog.connect(self.progress_bar.setMaximum)
-        self.ffmpeg_thread.change_title.connect(self.change_title)
+        self.t.lap("config binding")
+        self.offer_resume()
 
-        t.print("Configured and connected widgets")
-
-        pass
+    def offer_resume(self):
+        '''asks whether to run the jobs a crash interrupted again'''
+        self.interrupted = self.queue.journal.unfinished()
+        if not self.interrupted:
+            return
+        self.stat_dialog.status = (f"{len(self.interrupted)} job(s) were interrupted last time. Resume?\n"
+                                   + "\n".join(str(entry) for entry in self.interrupted[:5]))
+        self.status = Status.RESUME
+        self.control_mode = Mode.YES_NO
+
+    def resume_interrupted(self):
+        for entry in self.interrupted:
+            self.queue.journal.restore(entry, self.queue)
+        self.interrupted = []
+        self.execute_ffmpeg()
+
+    def discard_interrupted(self):
+        for entry in self.interrupted:
+            self.queue.journal.discard(entry)
+        self.interrupted = []
+        self.reset()
 
     def change_title(self, s):
         if s:
@@ -337,6 +468,12 @@ class MainWindow(QtWidgets.QWidget):
             self.status = Status.CONFIRM_CLOSE
             event.ignore()
         else:
+            if self.predictor is not None:
+                self.predictor.kill()
+            for thread in list(self.workers.values()) + ([self.predictor] if self.predictor else []):
+                thread.wait(5000)  # let them clean up, a QThread can't be destroyed while running
+            self.config.flush()
+            print(f"config: {self.config.saves} writes, {self.config.saves_avoided} avoided")
             event.accept()
 
     def add_to_config(self, name_and_default: dict,
@@ -374,7 +511,8 @@ class MainWindow(QtWidgets.QWidget):
             try:
                 self.save_bar.status.status = ""
                 self.config.update({name: conv_incoming(val)})
-                self.config.save()
+                if not self.config.save_on_change:  # with autosave update() already asked for it
+                    self.config.save()  # only schedules a write, see WriteBehindConfig
             except Exception as e:
                 err = f"updating key '{name}' failed: {e}"
                 self.save_bar.status.status = err
@@ -413,7 +551,8 @@ class MainWindow(QtWidgets.QWidget):
             # "default_index": lambda w, data: w.setCurrentIndex(data),
             "orientation": lambda w, data: w.setOrientation(getattr(Qt.Orientation, data)),
             "range": lambda w, data: w.setRange(*data),
-            "value": lambda w, data: w.setValue(data)
+            "value": lambda w, data: w.setValue(data),
+            "placeholder": lambda w, data: w.setPlaceholderText(data)
         }
         for data_type in widget_methods:
             if data_type in data:
@@ -431,7 +570,9 @@ class MainWindow(QtWidgets.QWidget):
     @Slot()
     def save_clicked(self):
         self.config.save()
-        self.stat_dialog.status = "Config saved."
+        self.config.flush()
+        self.stat_dialog.status = (f"Config saved. {self.config.saves_avoided} of "
+                                   f"{self.config.requests} writes avoided.")
 
     @Slot()
     def input_button_clicked(self):
@@ -448,18 +589,7 @@ class MainWindow(QtWidgets.QWidget):
         if '"' in self.input_bar.text.text():
             self.input_bar.text.setText(value.replace("\"", ""))
         if self.input_bar.text.text():
-            path = Path(self.input_bar.text.text())
-            path = path.with_stem(f"{path.stem}-converted")
-            if self.config['fps'] != 0:
-                if self.config['fps'] % 1 == 0:
-                    path = path.with_stem(f"{path.stem}-{int(self.config['fps'])}fps")
-                else:
-                    path = path.with_stem(f"{path.stem}-{self.config['fps']}fps")
-
-            if self.config['extension'] == "png":
-                path = path.with_stem(f"{path.stem}-%06d")
-            path = path.with_suffix(f".{self.config['extension']}")
-            self.output_bar.text.setText(str(path))
+            self.output_bar.text.setText(str(converted_path(self.input_bar.text.text(), self.config)))
         else:
             self.output_bar.text.setText("")
 
@@ -476,30 +606,196 @@ class MainWindow(QtWidgets.QWidget):
 
     @Slot(int)
     def res_dropdown_changed(self, value: int):
-        self.res_bar.line.setVisible(value != 0)
+        self.res_bar.line.setVisible(value in (1, 2))
+        self.res_bar.fit.setVisible(value == 3)
+        self.res_bar.scaler.setVisible(value != 0)
+
+    @Slot(str)
+    def extension_changed(self, extension: str):
+        '''shows the frame range and the image quality rows only for image sequences'''
+        for widget in (self.frames_bar.dialog, self.frames_bar.start, self.frames_bar.end, self.frames_bar.step):
+            widget.setVisible(extension in IMAGE_FORMATS)
+        # png and webp have a compression level, jpg a quality and bmp neither
+        self.image_bar.compression.setVisible(extension in ('png', 'webp'))
+        self.image_bar.quality.setVisible(extension == 'jpg')
+        self.image_bar.dialog.setVisible(extension in ('png', 'webp', 'jpg'))
+        self.image_bar.label.setVisible(extension in ('png', 'webp', 'jpg'))
+        self.image_bar.dialog.setText("Quality:" if extension == 'jpg' else "Compression:")
+        self.image_bar.compression.setRange(0, 6 if extension == 'webp' else 9)
+        self.image_bar.label.setText(f"{self.config['jpeg_quality']}%" if extension == 'jpg'
+                                     else str(self.config['compression_level']))
+
+    @Slot()
+    def add_files_clicked(self):
+        """Adds one job per selected file, using the current settings"""
+        home = str(Path(self.config['input'] or "~").expanduser().parent)
+        files = QtWidgets.QFileDialog.getOpenFileNames(
+            self, "Select input files", home
+        )[0]
+        for file in files:
+            self.queue.add(file, converted_path(file, self.config), self.config)
+        if files:
+            self.stat_dialog.status = f"Added {len(files)} job(s)."
+            self.make_thumbnails([file for file in files if file not in self.thumbnails])
+        self.refresh_queue()
+
+    def make_thumbnails(self, files: list[str], grid: tuple[int, int] = (1, 1)):
+        '''makes thumbnails (or contact sheets) off the gui thread, see thumbnail_made()'''
+        if not files:
+            return
+        thread = ThumbnailThread(self)
+        thread.files, thread.grid = files, grid
+        thread.made.connect(lambda file, image, grid=grid: self.thumbnail_made(file, image, grid))
+        thread.finished.connect(lambda thread=thread: self.thumbnailers.remove(thread))
+        self.thumbnailers.append(thread)
+        thread.start()
+
+    def thumbnail_made(self, file: str, image: str, grid: tuple[int, int]):
+        if grid == (1, 1):
+            self.thumbnails[file] = image
+            self.refresh_queue()
+            return
+        # a contact sheet was asked for by double clicking the job
+        sheet = QLabel()
+        sheet.setWindowTitle(f"{Path(file).name} | TurnH264")
+        sheet.setPixmap(QtGui.QPixmap(image))
+        sheet.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
+        sheet.show()
+        sheet.destroyed.connect(lambda: self.sheets.remove(sheet))
+        self.sheets.append(sheet)  # or it's garbage collected right away
+        self.stat_dialog.status = f"Contact sheet of {Path(file).name}"
+
+    @Slot(QtWidgets.QListWidgetItem)
+    def job_double_clicked(self, item: QtWidgets.QListWidgetItem):
+        job = self.selected_job()
+        if job is not None:
+            self.stat_dialog.status = f"Making a contact sheet of {job.name}..."
+            self.make_thumbnails([job.input], (4, 4))
+
+    def selected_job(self) -> Job | None:
+        row = self.queue_bar.currentRow()
+        if 0 <= row < len(self.queue):
+            return self.queue.jobs[row]
 
     @Slot()
-    def detect_clicked(self):
-        # update the thread args
-        self.ffmpeg_thread.path = self.config['input']
-        # start the thread
-        self.ffmpeg_thread.get_metadata()
+    def move_selected_job(self, offset: int):
+        job = self.selected_job()
+        if job is not None:
+            self.queue.move(job.id, offset)
+            self.refresh_queue()
+            self.queue_bar.setCurrentRow(self.queue.jobs.index(job))
+
+    @Slot()
+    def cancel_selected_job(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        self.queue.cancel(job.id)
+        if job.id in self.workers:
+            self.kill_worker(self.workers[job.id])
+        self.refresh_queue()
+
+    def refresh_queue(self):
+        """Redraws the job list and the overall progress"""
+        jobs = list(self.queue)
+        if self.queue_bar.count() == len(jobs):
+            for idx, job in enumerate(jobs):  # update in place, rebuilding flickers
+                self.queue_bar.item(idx).setText(str(job))
+        else:
+            row = self.queue_bar.currentRow()
+            self.queue_bar.clear()
+            self.queue_bar.addItems([str(job) for job in jobs])
+            self.queue_bar.setCurrentRow(row)
+        for idx, job in enumerate(jobs):
+            item = self.queue_bar.item(idx)
+            if job.input in self.thumbnails and item.icon().isNull():
+                item.setIcon(QtGui.QIcon(self.thumbnails[job.input]))
+
+        running = self.queue.running
+        total = sum(max(job.max_prog, 0) for job in running)
+        if total > 0:
+            self.progress_bar.setMaximum(total)
+            self.progress_bar.setValue(sum(min(job.progress, job.max_prog) for job in running))
 
     @Slot()
     def execute_ffmpeg(self):
+        # keeps the old single-input behaviour when nothing was queued
+        if not self.queue.pending:
+            self.queue.add(self.config['input'], self.output_bar.text.text(), self.config)
         self.running()
-        self.ffmpeg_thread.path = self.config['input']
-        self.ffmpeg_thread.start()
+        self.queue.workers = self.config['workers']
+        self.queue.budget = resolve_threads(self.config['threads'])
+        GOVERNOR.configure(self.config)
+        self.fill_workers()
+        self.admit_timer.start()
+
+    def fill_workers(self):
+        """Starts pending jobs until the worker pool is full"""
+        while not self.paused and (job := self.queue.next_job()) is not None:
+            thread = FfmpegThread(self)
+            thread.job = job
+            thread.config = job.config
+            thread.path = job.input
+            thread.progress.connect(lambda val, job=job: self.job_progress(job, val))
+            thread.max_prog.connect(lambda val, job=job: setattr(job, 'max_prog', val))
+            thread.checkpoint.connect(lambda data, job=job: self.queue.checkpoint(job, data))
+            thread.status.connect(lambda s, job=job: self.job_status(job, s))
+            thread.change_title.connect(lambda s, job=job: self.job_title(job, s))
+            thread.finished.connect(lambda thread=thread: self.worker_finished(thread))
+            self.workers[job.id] = thread
+            thread.start()
+        self.refresh_queue()
 
-        pass
+    @Slot(int)
+    def workers_changed(self, value: int):
+        self.queue.workers = value
+        if self.status == Status.RUNNING:
+            self.fill_workers()
+
+    def job_progress(self, job: Job, value: int):
+        self.queue.progress(job, value)
+        self.refresh_queue()
+
+    def job_status(self, job: Job, s: str):
+        if len(self.queue.running) > 1:
+            s = f"{job.name}:\n{s}"
+        self.set_status(s)
+
+    def job_title(self, job: Job, s: str):
+        if len(self.queue.running) > 1:
+            # a job without a frame count yet reports raw frames, which mustn't count
+            done = sum(min(j.progress, max(j.max_prog, 0)) for j in self.queue.running)
+            total = sum(max(j.max_prog, 0) for j in self.queue.running)
+            s = f"%{100 * done / total:.2f}" if total else s
+        self.change_title(s)
 
     def running(self):
         self.status = Status.RUNNING
         self.control_mode = Mode.STOP
         self.stat_dialog.status = "Running..."
 
+    @Slot()
+    def worker_finished(self, thread: FfmpegThread):
+        job = thread.job
+        self.workers.pop(job.id, None)
+        verification = thread.encoder.verification if thread.encoder is not None else None
+        job.verification = verification.to_dict() if verification else {}
+        if thread.error is not None:
+            self.queue.finish(job, JobState.FAILED, f"{type(thread.error).__name__}: {thread.error}")
+        elif thread.encoder is not None and thread.encoder.stopped:
+            self.queue.finish(job, JobState.CANCELLED, "stopped early, the output so far was kept")
+        else:
+            self.queue.finish(job, JobState.DONE, thread.encoder.summary() if thread.encoder is not None else "")
+        if self.status == Status.RUNNING:
+            self.fill_workers()
+        if not self.workers:
+            self.ffmpeg_finished()
+        self.refresh_queue()
+
     @Slot()
     def ffmpeg_finished(self):
+        self.admit_timer.stop()
+        self.set_paused(False)
         self.control_mode = Mode.START
         self.status = Status.READY
 
@@ -507,6 +803,10 @@ class MainWindow(QtWidgets.QWidget):
     def start_clicked(self):
         self.stat_dialog.status = "Start clicked."
 
+        if self.queue.pending:
+            self.execute_ffmpeg()
+            return
+
         if not os.path.exists(self.config['input']):
             self.stat_dialog.status = "Input does not exist."
             return
@@ -519,11 +819,34 @@ class MainWindow(QtWidgets.QWidget):
         else:
             self.execute_ffmpeg()
 
+    @Slot()
+    def predict_clicked(self):
+        """Encodes a few samples of the input and shows the projected size and time"""
+        if not os.path.exists(self.config['input']):
+            self.stat_dialog.status = "Input does not exist."
+            return
+        if self.predictor is not None and self.predictor.isRunning():
+            return
+        self.predictor = thread = PredictThread(self)
+        thread.config = dict(self.config, output=self.output_bar.text.text())
+        thread.path = self.config['input']
+        thread.status.connect(self.set_status)
+        thread.finished.connect(lambda: self.predict_finished(thread))
+        self.control_bar.predict_button.setEnabled(False)
+        thread.start()
+
+    @Slot()
+    def predict_finished(self, thread: PredictThread):
+        self.control_bar.predict_button.setEnabled(True)
+        if thread.result is not None:
+            self.stat_dialog.status = str(thread.result)
+
     @Slot()
     def yes_clicked(self):
         {
             Status.OVERWRITE: self.execute_ffmpeg,
-            Status.CONFIRM_CLOSE: lambda: (self.stop_clicked(), self.close())
+            Status.CONFIRM_CLOSE: lambda: (self.stop_clicked(), self.close()),
+            Status.RESUME: self.resume_interrupted
         }.get(self.status)()
         pass
 
@@ -531,21 +854,59 @@ class MainWindow(QtWidgets.QWidget):
     def no_clicked(self):
         {
             Status.OVERWRITE: self.reset,
-            Status.CONFIRM_CLOSE: self.running
+            Status.CONFIRM_CLOSE: self.running,
+            Status.RESUME: self.discard_interrupted
         }.get(self.status)()
         pass
 
+    @Slot()
+    def pause_clicked(self):
+        '''pauses the running jobs, or resumes them, no new ones start while paused'''
+        try:
+            for thread in self.workers.values():
+                if self.paused:
+                    thread.resume()
+                else:
+                    thread.pause()
+        except NotImplementedError as e:
+            self.stat_dialog.status = str(e)
+            return
+        self.set_paused(not self.paused)
+        self.stat_dialog.status = "Paused, nothing is lost." if self.paused else "Resumed."
+        if not self.paused:
+            self.fill_workers()
+
+    def set_paused(self, paused: bool):
+        self.paused = paused
+        self.control_bar.pause_button.setText("Resume" if paused else "Pause")
+
+    @Slot()
+    def finish_clicked(self):
+        '''stops the running jobs early, keeping their outputs playable'''
+        self.status = Status.STOPPING
+        self.set_paused(False)  # stopping resumes them
+        for thread in self.workers.values():
+            thread.stop()
+        self.stat_dialog.status = "Finishing, the outputs so far are kept..."
+
+    @staticmethod
+    def kill_worker(thread: FfmpegThread):
+        # the encoder stops its ffmpeg and removes the partial output, then the thread ends by itself
+        thread.kill()
+
     @Slot()
     def stop_clicked(self):
         if self.status == Status.READY:
             raise NotImplementedError
-        elif self.status == Status.RUNNING:
+        elif self.status in (Status.RUNNING, Status.STOPPING):
             self.reset()
+        self.set_paused(False)
 
         self.control_mode = Mode.START
         self.status = Status.READY
-        self.ffmpeg_thread.terminate()
-        self.ffmpeg_thread.stream.kill()
+        for job_id, thread in list(self.workers.items()):
+            self.queue.cancel(job_id)
+            self.kill_worker(thread)
         self.progress_bar.setValue(0)
         self.stat_dialog.status = "Ffmpeg stopped."
         print("Thread stopped")
@@ -573,300 +934,126 @@ class MainWindow(QtWidgets.QWidget):
         '''0 = Start, 1 = Stop, 2 = Yes/No'''
         # Start
         self.control_bar.start_button.setVisible({Mode.START: True}.get(value, False))
+        self.control_bar.predict_button.setVisible({Mode.START: True}.get(value, False))
         # self.control_bar.auto_detect.setVisible({Mode.START: True}.get(value, False))
         # Stop
         self.control_bar.stop_button.setVisible({Mode.STOP: True}.get(value, False))
+        self.control_bar.pause_button.setVisible({Mode.STOP: True}.get(value, False) and hasattr(signal, 'SIGSTOP'))
+        self.control_bar.finish_button.setVisible({Mode.STOP: True}.get(value, False))
         # Yes / No
         self.control_bar.yes_button.setVisible({Mode.YES_NO: True}.get(value, False))
         self.control_bar.no_button.setVisible({Mode.YES_NO: True}.get(value, False))
         self._control_mode = value
 
 
-class File:
-    def __init__(self, txt):
-        self.data = txt
-
-    def read(self, file) -> BytesIO:
-        raise NotImplementedError
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.data.close()
-        pass
-
-
-class TFile(File):
-    def __init__(self, txt):
-        self.data = tarfile.open(txt)
-
-    def read(self, file) -> BytesIO:
-        return self.data.extractfile(file)
-
-
-class ZFile(File):
-    def __init__(self, txt):
-        self.data = zipfile.ZipFile(txt)
-
-    def read(self, file) -> BytesIO:
-        return BytesIO(self.data.read(file))
-
-
-@dataclass
-class FileInfo:  # small dataclass used in FfmpegThread.download_ffmpeg
-    paths: dict
-    type: File
-    out: Path
-    src: str
-
-
 class FfmpegThread(QThread):
+    '''Runs an engine.Encoder off the gui thread, relaying its callbacks as signals'''
     progress = Signal(int)
     max_prog = Signal(int)
     change_title = Signal(str)
     status = Signal(str)
     probed = Signal(dict)
-    metadata: dict
+    checkpoint = Signal(dict)
     config: dict
     path: str
-    ffmpeg_path: str = 'ffmpeg'
-    ffprobe_path: str = 'ffprobe'
-    stream: subprocess.Popen
+    job: Job = None
+    error: Exception | None = None
+    encoder: Encoder = None
+    result = None  # whatever encoder.run() returned
+    cancelled = False
+    paused = False
+    stopped = False
+
+    def make_encoder(self) -> Encoder:
+        return get_encoder(self.config, self.path)
 
     def run(self):
-        # self._run()
+        self.encoder = self.make_encoder()
+        self.encoder.progress = self.progress.emit
+        self.encoder.max_prog = self.max_prog.emit
+        self.encoder.change_title = self.change_title.emit
+        self.encoder.status = self.status.emit
+        self.encoder.checkpoint = self.checkpoint.emit
+        if self.cancelled:  # killed before the encoder existed
+            return
+        if self.stopped:
+            self.encoder.stop()
+        elif self.paused:
+            self.encoder.pause()
         try:
-            self._run()
+            self.result = self.encoder.run()
         except Exception as e:
+            self.error = e
             traceback.print_exception(e)
             self.change_title.emit("Error")
             self.status.emit(f"{type(e).__name__}: {e}")
 
-    def _run(self):
-        self.check_for_ffmpeg()
-        self.metadata = self._get_metadata(self.ffprobe_path)
-        video_stream = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'video'][0]
-
-        # approximate the frame count from the framerate and duration
-        if 'duration' in self.metadata['format']:
-            duration = float(self.metadata['format']['duration'])
-            framerate = eval(video_stream['r_frame_rate'])
-            frame_count = int(duration * framerate)
-            if self.config['fps']:
-                frame_count = int(self.config['fps'] * duration)
-        else:
-            frame_count = -1
-        self.max_prog.emit(frame_count)
-
-        self.status.emit("Gathered metadata.")
-
-        self.stream: subprocess.Popen = self.get_ffmpeg_stream(video_stream).run_async(pipe_stdout=True,
-                                                                                       cmd=self.ffmpeg_path)
-        self.status.emit("configured ffmpeg.")
-
-        while not self.stream.poll():
-            dct = {}
-            line = ""
-            while not 'progress' in line:
-                line = self.stream.stdout.readline().decode('utf-8').strip()
-                time.sleep(0.01)
-                k, v = line.split('=')
-                dct[k] = v
-
-            progress = int(dct['frame'])
-            if int(100 * progress / frame_count) % 5 == 0:
-                self.change_title.emit(f"%{100 * progress / frame_count:.2f}")
-
-            self.progress.emit(min(progress, frame_count))
-            dlg = [
-                "Converting" if dct['progress'] == 'continue' else "Finished",
-                f"%{int(dct['frame']) * 100/frame_count:.2f}   [{dct['frame']} / ~{frame_count}]",
-                f"Total size: {byte_format(dct['total_size'])}",
-                f"speed: {dct['speed']}, fps: {dct['fps']}",
-                f"bitrate: {dct['bitrate']}",
-            ]
-            if int(dct['drop_frames']):
-                dlg.append(f"dropped frames: {dct['drop_frames']}")
-            if int(dct['dup_frames']):
-                dlg.append(f"duped framed: {dct['dup_frames']}")
-
-            self.status.emit("\n".join(dlg))
-
-            if line == 'progress=end':
-                print(f"{self.config['output']} has been created")
-                break
-
-    def get_ffmpeg_stream(self, video_data):
-        video = ffmpeg.input(self.config['input'])
-        kwargs = {}
-
-        # video
-        kwargs.update({
-            "crf":  {'crf': self.config['video_bitrate']},
-            "KB/s": {'video_bitrate': f"{self.config['video_bitrate']}K"},
-            "MB/s": {'video_bitrate': f"{self.config['video_bitrate']}M"}
-        }.get(self.config['video_dropdown']))
-
-        # audio
-        if self.config['audio_dropdown'] != "copy":
-            kwargs.update({'audio_bitrate': f"{self.config['audio_bitrate']}k"})
-        else:
-            kwargs.update({'c:a': "copy"})
-        # threads, speed
-        kwargs.update({
-            'threads': self.config['threads'],
-            'preset': self.config['speed']
-        })
-
-        # resolution
-        if self.config['res_dropdown'] != "copy" and self.config['resolution'] > 0:
-            dims = video_data['width'], video_data['height']
-            scales = {
-                'max': self.config['resolution'] / max(dims),
-                'min': self.config['resolution'] / min(dims)
-            }.get(self.config['res_dropdown'])
-            dims = dims[0] * scales, dims[1] * scales
-
-            if any(dim % 1 != 0 for dim in dims):
-                self.status.emit(f"Warning: predicted resolution: {dims[0]:.2f}x{dims[1]:.2f} is not pixel perfect")
-                time.sleep(3)
-
-            video = video.filter('scale', f"{int(dims[0])}x{int(dims[1])}")
-
-        # fps
-        if self.config['fps']:
-            kwargs['r'] = self.config['fps']
-
-        # misc args
-        kwargs.update({
-            'progress': '-',
-            'loglevel': 'error'
-        })
-        video = (
-            video
-            .output(self.config['output'], **kwargs)
-            .overwrite_output()
-            .global_args('-nostats',
-                         '-hide_banner')
-        )
-        print(video.get_args())
-        return video
-
-    def _get_metadata(self, cmd):
-        return ffmpeg.probe(self.path, cmd=cmd)
-
-    def check_for_ffmpeg(self, attempts=0):
-        if attempts > 3:
-            rprint("Ffmpeg failed to download")
-            exit()
-        self.ffmpeg_path = shutil.which('ffmpeg', path=PROGRAM_ORIGIN / 'bin')  or shutil.which('ffmpeg')
-        self.ffprobe_path = shutil.which('ffprobe', path=PROGRAM_ORIGIN / 'bin')  or shutil.which('ffprobe')
-        if not (
-            (
-                (self.ffmpeg_path and os.path.exists(self.ffmpeg_path))
-                or
-                (self.ffprobe_path and os.path.exists(self.ffprobe_path))
-            )
-            # and False  # uncomment to test downloader
-        ):
-            self.status.emit("An ffmpeg binary is missing, attempting to download...")
-            self.download_ffmpeg()
-            self.check_for_ffmpeg(attempts + 1)
-
-    def download_ffmpeg(self):
-        print("Downloading Ffmpeg")
-        # get list of builds
-
-        exe_dict = {
-            'linux': FileInfo(
-                {'bin/ffmpeg':  'ffmpeg-master-latest-linux64-gpl/bin/ffmpeg',
-                 'bin/ffprobe': 'ffmpeg-master-latest-linux64-gpl/bin/ffprobe'},
-                type=TFile, out=PROGRAM_ORIGIN / 'ffmpeg.tar.xz',
-                src="https://github.com/BtbN/FFmpeg-Builds/releases/download/latest/ffmpeg-master-latest-linux64-gpl.tar.xz"
-            ),
-            'win32': FileInfo(
-                {'bin/ffmpeg.exe': 'ffmpeg-master-latest-win64-gpl/bin/ffmpeg.exe',
-                 'bin/ffprobe.exe': 'ffmpeg-master-latest-win64-gpl/bin/ffprobe.exe'},
-                type=ZFile, out=PROGRAM_ORIGIN / 'ffmpeg.zip',
-                src="https://github.com/BtbN/FFmpeg-Builds/releases/download/latest/ffmpeg-master-latest-win64-gpl.zip"
-            ),
-        }
-        exe_info = exe_dict[sys.platform]
-
-        if not os.path.exists(exe_info.out):
-            with open(exe_info.out, 'wb') as file:
-                chunksize = 8192
-                with requests.get(exe_info.src, stream=True) as r:
-                    for chunk in r.iter_content(chunk_size=chunksize):
-                        file.write(chunk)
-
-        self.status.emit("File downloaded. Extracting...")
-
-        with exe_info.type(exe_info.out) as f:
-            for out, src in exe_info.paths.items():
-                Path(out).parent.mkdir(parents=True, exist_ok=True)
-                if not Path(out).exists():
-                    FfmpegThread.extract_and_save(
-                        f,
-                        src,
-                        out,
-                        chmod=stat.S_IEXEC if sys.platform != 'win32' else None
-                    )
+    def kill(self):
+        self.cancelled = True
+        if self.encoder is not None:
+            self.encoder.kill()
 
-    @staticmethod
-    def extract_and_save(
-            file: File,
-            pth: str,
-            outpath: str,
-            chmod=None,
-            overwrite=False
-    ) -> None:
-        '''Extracts a file from tfile and save it.
+    def pause(self):
+        self.paused = True
+        if self.encoder is not None:
+            self.encoder.pause()
 
-        Parameters
-        ----------
-        tfile : tarfile.TarFile
-            The file to extract from
-        pth : str
-            The path in the object to extract
-        outpath : str
-            The path to save to
-        chmod : _type_, optional
-            Calls os.chmod on the resulting file, by default None
-        overwrite : bool, optional
-            If exists, overwrite, by default False
-
-        Raises
-        ------
-        FileExistsError
-            If the file exists and overwrite is not called.
-        '''
-        if os.path.exists(outpath):
-            if not overwrite:
-                raise FileExistsError
-            else:
-                os.remove(outpath)
-
-        with open(outpath, 'wb') as out:
-            data = file.read(pth)
-            for i in tqdm(data):
-                out.write(i)
-            if chmod:
-                if hasattr(chmod, '__iter__'):
-                    for attr in chmod:
-                        os.chmod(outpath, attr)
-                else:
-                    os.chmod(outpath, chmod)
+    def resume(self):
+        self.paused = False
+        if self.encoder is not None:
+            self.encoder.resume()
 
+    def stop(self):
+        self.stopped = True
+        if self.encoder is not None:
+            self.encoder.stop()
 
-if __name__ == "__main__":
-    t = Timer()
-    app = QtWidgets.QApplication([])
 
-    defaults = CfgDict('config.json', save_on_change=False,
-                       sort_on_save=True)
-    main_app_window = MainWindow(t, defaults)
+class ThumbnailThread(QThread):
+    '''Makes a contact sheet of every file in `files`, a 1x1 grid is a thumbnail'''
+    made = Signal(str, str)  # input, image
+    files: list[str]
+    grid: tuple[int, int] = (1, 1)
+
+    def run(self):
+        for file in self.files:
+            try:
+                self.made.emit(file, str(contact_sheet(file, *self.grid)))
+            except Exception as e:
+                print(f"no thumbnail for {file}: {type(e).__name__}: {e}")
+
+
+class PredictThread(FfmpegThread):
+    '''Runs a predict.Predictor, its Prediction ends up in `result`'''
+
+    def make_encoder(self) -> Encoder:
+        return Predictor(self.config, self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="TurnH264")
+    parser.add_argument('--startup-profile', nargs='?', type=float, const=0, metavar="BUDGET",
+                        help="print how long each startup phase took and exit, "
+                             "failing if the total is over BUDGET seconds")
+    args, qt_args = parser.parse_known_args()
+
+    t = Timer(STARTED)
+    t.lap("imports")
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    t.lap("qt application")
+    main_app_window = MainWindow(t)
     main_app_window.show()
+    app.processEvents()  # paint the window before any non-ui work
+    t.lap("window shown")
+
+    defaults = WriteBehindConfig('config.json', save_on_change=False,
+                                 sort_on_save=True)
+    t.lap("config load")
+    main_app_window.bind_config(defaults)
+
+    if args.startup_profile is not None:
+        print(t.report())
+        sys.exit(int(bool(args.startup_profile) and t.total > args.startup_profile))
     code = app.exec()
+    defaults.flush()
     sys.exit(code)
@@ -0,0 +1,169 @@
+'''Finds the fastest x264 preset and thread count for this machine.
+
+A short reference clip is encoded across a grid of presets and thread counts
+with the user's rate settings. The fastest combination whose output isn't much
+bigger than the best compression in the grid is stored per machine, and is
+used wherever the speed is "auto" or the thread count is 0.
+'''
+from __future__ import annotations
+
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import engine
+from engine import CPU_COUNT, PRESETS, Encoder, find_ffmpeg
+from progress import SUPERVISOR
+
+DEFAULT_NAME = "autotune.json"
+# outputs may be this much bigger than the smallest one in the grid
+MAX_SIZE_RATIO = 1.15
+REFERENCE_SIZE = "1280x720"
+# seconds
+REFERENCE_LENGTH = 3.0
+
+
+@dataclass
+class TuneResult:
+    preset: str
+    threads: int
+    fps: float
+    size: int
+    wall: float
+
+
+def machine_id() -> str:
+    '''host name, cpu model and core count, tunings don't carry over between machines'''
+    model = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as file:
+            model = next((line.split(':', 1)[1].strip() for line in file if line.startswith('model name')), model)
+    except OSError:
+        pass
+    return f"{platform.node()}|{model}|{CPU_COUNT}"
+
+
+def thread_grid(cpu_count: int = CPU_COUNT) -> list[int]:
+    '''powers of two up to the core count, plus 3/4 of it and all of it
+
+    >>> thread_grid(12)
+    [1, 2, 4, 8, 9, 12]
+    '''
+    grid = {cpu_count, max(int(cpu_count * 0.75), 1)}
+    grid.update(2**i for i in range(cpu_count.bit_length()) if 2**i <= cpu_count)
+    return sorted(grid)
+
+
+def tuning_path() -> Path:
+    return engine.data_path(DEFAULT_NAME)
+
+
+def load_tuning() -> dict | None:
+    '''the stored tuning of this machine, or None'''
+    try:
+        with open(tuning_path()) as file:
+            return json.load(file).get(machine_id())
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuning(tuning: dict) -> None:
+    path = tuning_path()
+    try:
+        with open(path) as file:
+            machines = json.load(file)
+    except (OSError, ValueError):
+        machines = {}
+    machines[machine_id()] = tuning
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'w') as file:
+        json.dump(machines, file, indent=4)
+    os.replace(tmp, path)
+
+
+def make_reference(path: str | Path, source: str | None = None, length: float = REFERENCE_LENGTH,
+                   size: str = REFERENCE_SIZE, ffmpeg_path: str = 'ffmpeg') -> Path:
+    '''Writes the clip every combination is timed on.
+
+    Without a `source` it's generated with lavfi's testsrc2, otherwise `length`
+    seconds are cut from the middle of `source`. The clip is stored as lossless
+    h264 so decoding it costs about what a real input would.
+    '''
+    if source is None:
+        input_args = ['-f', 'lavfi', '-i', f"testsrc2=size={size}:rate=30"]
+    else:
+        import ffmpeg
+        duration = float(ffmpeg.probe(source)['format'].get('duration', 0))
+        input_args = ['-ss', f"{max(duration / 2 - length / 2, 0):.3f}", '-i', source]
+    subprocess.run(
+        [ffmpeg_path, '-v', 'error', '-y', *input_args, '-t', str(length), '-an',
+         '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', str(path)],
+        check=True
+    )
+    return Path(path)
+
+
+def measure(reference: Path, config: dict, preset: str, threads: int, workdir: Path) -> TuneResult:
+    '''encodes the reference with `preset` and `threads` using the same command as a real job'''
+    output = workdir / f"{preset}-{threads}.mkv"
+    encoder = Encoder(dict(config, input=str(reference), output=str(output), speed=preset, threads=threads,
+                           res_dropdown='copy', fps=0, force_encode=True))
+    encoder.check_for_ffmpeg()
+    encoder.metadata = encoder._get_metadata(encoder.ffprobe_path)
+    video = [stream for stream in encoder.metadata['streams'] if stream['codec_type'] == 'video'][0]
+    start = time.perf_counter()
+    stream = encoder.get_ffmpeg_stream(video, audio=False).run_async(pipe_stdout=True, pipe_stderr=True,
+                                                                     cmd=encoder.ffmpeg_path)
+    watch = SUPERVISOR.watch(stream)
+    if watch.wait() != 0:
+        raise RuntimeError(f"{preset} with {threads} threads failed: {watch.stderr}")
+    wall = time.perf_counter() - start
+    frames = watch.last.frame if watch.last else 0
+    size = os.path.getsize(output)
+    output.unlink()
+    return TuneResult(preset, threads, frames / wall if wall else 0.0, size, wall)
+
+
+def pick(results: list[TuneResult], max_size_ratio: float = MAX_SIZE_RATIO) -> TuneResult:
+    '''the fastest result no more than `max_size_ratio` times bigger than the smallest'''
+    smallest = min(result.size for result in results)
+    return max((result for result in results if result.size <= smallest * max_size_ratio),
+               key=lambda result: result.fps)
+
+
+def autotune(config: dict, presets: list[str] = PRESETS, threads: list[int] | None = None,
+             source: str | None = None, length: float = REFERENCE_LENGTH, size: str = REFERENCE_SIZE,
+             max_size_ratio: float = MAX_SIZE_RATIO,
+             status: Callable[[str], None] = print) -> dict:
+    '''Runs the grid one encode at a time, so the timings don't disturb each other,
+    then stores and returns the tuning for this machine.'''
+    threads = threads or thread_grid()
+    ffmpeg_path = find_ffmpeg()[0] or 'ffmpeg'
+    with tempfile.TemporaryDirectory(prefix=".autotune-", dir=engine.DATA_DIR) as workdir:
+        workdir = Path(workdir)
+        status("Preparing the reference clip...")
+        reference = make_reference(workdir / "reference.mkv", source, length, size, ffmpeg_path)
+        results = []
+        for preset in presets:
+            for count in threads:
+                result = measure(reference, config, preset, count, workdir)
+                status(f"{preset:<10} {count:>3} threads: {result.fps:7.1f} fps, {engine.byte_format(str(result.size))}")
+                results.append(result)
+    best = pick(results, max_size_ratio)
+    tuning = {
+        'speed': best.preset,
+        'threads': best.threads,
+        'max_size_ratio': max_size_ratio,
+        'rate': [config['video_dropdown'], config['video_bitrate']],
+        'reference': source or f"testsrc2 {size}",
+        'created': time.time(),
+        'results': [asdict(result) for result in results],
+    }
+    save_tuning(tuning)
+    return tuning
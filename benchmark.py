@@ -0,0 +1,365 @@
+#!/usr/bin/python
+'''Offline performance benchmarks for TurnH264.
+
+Every input is generated on the spot with ffmpeg's lavfi sources and the
+ffmpeg download is served from a local archive, so no network or media
+library is needed. Without ffmpeg only the conversions are skipped. Results
+are written as JSON and can be compared against an earlier run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --baseline before.json --threshold 0.15
+    python benchmark.py --quick --only parser startup
+'''
+from __future__ import annotations
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import engine
+from engine import DEFAULTS, find_ffmpeg, get_encoder
+from progress import SUPERVISOR, ProgressParser
+
+PROGRAM_ORIGIN = Path(os.path.dirname(os.path.abspath(__file__)))
+# a regression is a median this much slower than the baseline's
+THRESHOLD = 0.15
+# (size, seconds) of the generated conversion inputs
+CONVERSIONS = [("320x240", 5), ("1280x720", 5), ("1920x1080", 3)]
+QUICK_CONVERSIONS = [("320x240", 2)]
+
+
+@dataclass
+class Result:
+    name: str
+    seconds: float  # median of the runs, lower is better
+    runs: list[float]
+    extra: dict = field(default_factory=dict)
+
+
+@dataclass
+class Context:
+    workdir: Path
+    repeat: int
+    quick: bool
+    speed: str
+    ffmpeg_path: str | None
+
+
+class Skipped(Exception):
+    '''raised by a benchmark that can't run here, the reason ends up in the report'''
+
+
+BENCHMARKS: dict[str, Callable[[Context], list[Result]]] = {}
+# the ones that are skipped without ffmpeg, the rest still run
+NEEDS_FFMPEG: set[str] = set()
+
+
+def benchmark(name: str, needs_ffmpeg: bool = False):
+    '''registers a benchmark, it returns one Result per case'''
+    def decorator(func):
+        BENCHMARKS[name] = func
+        if needs_ffmpeg:
+            NEEDS_FFMPEG.add(name)
+        return func
+    return decorator
+
+
+def timed(repeat: int, func: Callable[[], dict | None]) -> tuple[list[float], dict]:
+    '''runs `func` `repeat` times, returns the wall times and the last run's extra data'''
+    runs, extra = [], {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extra = func() or {}
+        runs.append(time.perf_counter() - start)
+    return runs, extra
+
+
+def make_input(ctx: Context, size: str, seconds: float) -> Path:
+    '''a testsrc2 clip with a sine tone, encoded losslessly so decoding is cheap but real'''
+    path = ctx.workdir / f"input-{size}-{seconds:g}s.mkv"
+    if not path.exists():
+        subprocess.run(
+            [ctx.ffmpeg_path, '-v', 'error', '-y',
+             '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate=30",
+             '-f', 'lavfi', '-i', "sine=frequency=440:sample_rate=48000",
+             '-t', str(seconds), '-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', '-c:a', 'aac',
+             str(path)],
+            check=True
+        )
+    return path
+
+
+@benchmark("conversion", needs_ffmpeg=True)
+def bench_conversion(ctx: Context) -> list[Result]:
+    '''end to end conversions through the same engine the gui's FfmpegThread runs'''
+    results = []
+    cases = [(size, seconds, False) for size, seconds in (QUICK_CONVERSIONS if ctx.quick else CONVERSIONS)]
+    cases.append((cases[0][0], cases[0][1], True))  # the remux fast path
+    for size, seconds, remux in cases:
+        path = make_input(ctx, size, seconds)
+        # every repeat has to encode instead of reusing the first one's output, verifying is timed on its own
+        config = dict(DEFAULTS, input=str(path), output=str(ctx.workdir / f"out-{size}.mp4"),
+                      speed=ctx.speed, force_encode=not remux, output_cache=False, verify=False)
+
+        def run():
+            encoder = get_encoder(config)
+            frames = []
+            encoder.progress = frames.append
+            encoder.run()
+            return {'frames': frames[-1] if frames else 0}
+
+        runs, extra = timed(ctx.repeat, run)
+        median = statistics.median(runs)
+        extra['fps'] = round(extra['frames'] / median, 1) if median else 0
+        name = f"conversion/{size}/{seconds}s" + ("/remux" if remux else f"/{ctx.speed}")
+        results.append(Result(name, median, runs, extra))
+
+        def check():
+            encoder = get_encoder(dict(config, verify=True))
+            encoder.check_for_ffmpeg()
+            encoder.metadata = encoder._get_metadata(encoder.ffprobe_path)
+            encoder.verify_output()
+            return {'ok': encoder.verification.ok}
+
+        runs, extra = timed(ctx.repeat, check)
+        results.append(Result(name.replace("conversion/", "verify/", 1), statistics.median(runs), runs, extra))
+    return results
+
+
+def progress_blob(blocks: int) -> bytes:
+    '''what `-progress -` writes for `blocks` updates'''
+    lines = []
+    for i in range(blocks):
+        lines.append(
+            f"frame={i}\nfps=123.45\nstream_0_0_q=23.0\nbitrate=1234.5kbits/s\ntotal_size={i * 4096}\n"
+            f"out_time_us={i * 33333}\nout_time_ms={i * 33333}\nout_time=00:00:00.000000\n"
+            f"dup_frames=0\ndrop_frames=0\nspeed=4.2x\nprogress=continue\n"
+        )
+    return "".join(lines).encode()
+
+
+@benchmark("parser")
+def bench_parser(ctx: Context) -> list[Result]:
+    '''ProgressParser fed in pipe sized chunks, and the supervisor reading a real pipe'''
+    blocks = 20000 if ctx.quick else 200000
+    blob = progress_blob(blocks)
+
+    def parse():
+        parser = ProgressParser()
+        count = 0
+        for offset in range(0, len(blob), 65536):
+            count += len(parser.feed(blob[offset:offset + 65536]))
+        assert count == blocks, count
+        return {'records': count}
+
+    runs, extra = timed(ctx.repeat, parse)
+    median = statistics.median(runs)
+    extra.update(records_per_second=round(blocks / median), mib_per_second=round(len(blob) / median / 2**20, 1))
+    results = [Result("parser/feed", median, runs, extra)]
+
+    blob_path = ctx.workdir / "progress.txt"
+    blob_path.write_bytes(blob)
+
+    def pipe():
+        process = subprocess.Popen(
+            [sys.executable, '-c',
+             f"import shutil, sys; shutil.copyfileobj(open({str(blob_path)!r}, 'rb'), sys.stdout.buffer)"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        records = []
+        watch = SUPERVISOR.watch(process, lambda record: records.append(record.frame))
+        watch.wait()
+        assert len(records) == blocks, len(records)
+        return {'records': len(records)}
+
+    runs, extra = timed(ctx.repeat, pipe)
+    median = statistics.median(runs)
+    extra.update(records_per_second=round(blocks / median))
+    results.append(Result("parser/supervisor", median, runs, extra))
+    return results
+
+
+@benchmark("startup")
+def bench_startup(ctx: Context) -> list[Result]:
+    '''cold start of the gui up to a bound config, on an offscreen display'''
+    try:
+        import PySide6  # noqa: F401
+    except ImportError:
+        raise Skipped("PySide6 is not installed")
+    cwd = ctx.workdir / "startup"
+    cwd.mkdir(exist_ok=True)
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+
+    def start():
+        out = subprocess.run([sys.executable, str(PROGRAM_ORIGIN / "TurnH264.py"), '--startup-profile'],
+                             cwd=cwd, env=env, capture_output=True, text=True, check=True).stdout
+        # the app's own measurement, without interpreter start up
+        total = next((line.split()[1] for line in out.splitlines() if line.startswith("total")), None)
+        return {'app_ms': float(total) if total else None}
+
+    runs, extra = timed(ctx.repeat, start)
+    return [Result("startup/gui", statistics.median(runs), runs, extra)]
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@benchmark("installer")
+def bench_installer(ctx: Context) -> list[Result]:
+    '''download() and extraction against an archive served from localhost'''
+    import installer
+
+    serve = ctx.workdir / "serve"
+    (serve / "pkg" / "bin").mkdir(parents=True, exist_ok=True)
+    size = (8 if ctx.quick else 64) * 2**20
+    members = {}
+    for name in ('ffmpeg', 'ffprobe'):
+        member = serve / "pkg" / "bin" / name
+        with open(member, 'wb') as file:
+            file.write(os.urandom(size // 16) * 16)  # compresses, like a real binary
+        members[name] = f"pkg/bin/{name}"
+    archive = serve / "ffmpeg.tar.xz"
+    if not archive.exists():
+        with tarfile.open(archive, 'w:xz', preset=0) as tar:
+            tar.add(serve / "pkg", arcname="pkg")
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_QuietHandler, directory=str(serve)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/ffmpeg.tar.xz"
+    out = ctx.workdir / "installed"
+    out.mkdir(exist_ok=True)
+    quiet = lambda message: None  # noqa: E731
+    results = []
+    try:
+        def download():
+            dest = out / "ffmpeg.tar.xz"
+            dest.unlink(missing_ok=True)
+            installer.download(url, dest, status=quiet)
+            return {'bytes': dest.stat().st_size}
+
+        runs, extra = timed(ctx.repeat, download)
+        results.append(Result("installer/download", statistics.median(runs), runs, extra))
+
+        def extract():
+            with installer.TFile(out / "ffmpeg.tar.xz") as file:
+                installer.extract_all(file, {str(out / "bin" / name): src for name, src in members.items()},
+                                      status=quiet, overwrite=True)
+            return {'bytes': 2 * size}
+
+        runs, extra = timed(ctx.repeat, extract)
+        results.append(Result("installer/extract", statistics.median(runs), runs, extra))
+
+        def stream():
+            installer.stream_extract(url, {str(out / "stream" / name): src for name, src in members.items()},
+                                     status=quiet)
+            return {'bytes': 2 * size}
+
+        runs, extra = timed(ctx.repeat, stream)
+        results.append(Result("installer/stream_extract", statistics.median(runs), runs, extra))
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(results: list[Result], baseline: dict, threshold: float, thresholds: dict[str, float]) -> list[str]:
+    '''lists every result that got slower than its baseline by more than its threshold'''
+    before = {result['name']: result['seconds'] for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        if result.name not in before or not before[result.name]:
+            continue
+        # the most specific prefix wins, ie. "conversion/1920x1080" over "conversion"
+        limit = max(((prefix, value) for prefix, value in thresholds.items() if result.name.startswith(prefix)),
+                    key=lambda item: len(item[0]), default=(None, threshold))[1]
+        change = result.seconds / before[result.name] - 1
+        line = f"{result.name}: {before[result.name]:.3f}s -> {result.seconds:.3f}s ({change:+.1%}, limit {limit:+.0%})"
+        print(line)
+        if change > limit:
+            regressions.append(line)
+    return regressions
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="benchmark", description="Offline performance benchmarks for TurnH264.")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case, the median is reported")
+    parser.add_argument('--quick', action='store_true', help="smaller inputs, for a fast sanity check")
+    parser.add_argument('--speed', default='veryfast', help="x264 preset of the conversion benchmarks")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="a previous --output to compare against")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="allowed slowdown against the baseline, 0.15 is 15%%")
+    parser.add_argument('--thresholds', help='JSON file of per benchmark limits, ie. {"startup": 0.3}')
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_parser().parse_args(argv)
+    ffmpeg_path = find_ffmpeg()[0]
+    if ffmpeg_path is None:
+        print("ffmpeg was not found in ./bin or PATH, the benchmarks that need it are skipped")
+
+    with tempfile.TemporaryDirectory(prefix="turnh264-bench-") as workdir:
+        engine.set_data_dir(workdir)  # keep the caches and history of the runs out of the real ones
+        ctx = Context(Path(workdir), max(args.repeat, 1), args.quick, args.speed, ffmpeg_path)
+        results, skipped = [], {}
+        for name in args.only or BENCHMARKS:
+            if ffmpeg_path is None and name in NEEDS_FFMPEG:
+                skipped[name] = "ffmpeg was not found"
+                print(f"{name}: skipped, {skipped[name]}")
+                continue
+            print(f"running {name}...")
+            try:
+                cases = BENCHMARKS[name](ctx)
+            except Skipped as e:
+                skipped[name] = str(e)
+                print(f"{name}: skipped, {skipped[name]}")
+                continue
+            for result in cases:
+                print(f"  {result.name:<36} {result.seconds * 1000:10.1f} ms  {result.extra}")
+                results.append(result)
+
+    report = {
+        'created': time.time(),
+        'machine': {'node': platform.node(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                    'python': platform.python_version()},
+        'repeat': ctx.repeat,
+        'quick': args.quick,
+        'results': [asdict(result) for result in results],
+        'skipped': skipped,  # benchmark name -> why it didn't run
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        thresholds = {}
+        if args.thresholds:
+            with open(args.thresholds) as file:
+                thresholds = json.load(file)
+        regressions = compare(results, baseline, args.threshold, thresholds)
+        if regressions:
+            print(f"{len(regressions)} regression(s):\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,522 @@
+#!/usr/bin/python
+'''Headless entry point for TurnH264. Reuses the config.json keys of the gui,
+but never imports Qt.
+
+    python cli.py convert clip1.mkv clip2.mkv --workers 2
+    python cli.py convert clip.mkv -o out.mp4 --set video_bitrate=20 --set speed=fast
+    python cli.py daemon --spool ./spool
+    python cli.py watch /mnt/camera
+    python cli.py resume
+    python cli.py predict long.mkv --set speed=veryslow
+    python cli.py history
+    python cli.py tune --presets medium,fast,veryfast
+    python cli.py thumbs ~/Videos/*.mkv --grid 4x4
+    python cli.py worker --listen 0.0.0.0:8264
+    python cli.py convert movie.mkv --cluster render1:8264,render2:8264
+'''
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from pathlib import Path
+
+from cfg_argparser import CfgDict
+
+import engine
+from autotune import MAX_SIZE_RATIO, REFERENCE_LENGTH, autotune, thread_grid
+from engine import DEFAULTS, PRESETS, VIDEO_EXTENSIONS, Encoder, find_ffmpeg, get_encoder, resolve_threads
+from governor import GOVERNOR
+from jobs import Job, JobQueue, JobState, converted_path
+from journal import get_journal
+from predict import SAMPLE_COUNT, SAMPLE_LENGTH, Predictor
+from thumbnails import COLUMNS, ROWS, TILE_WIDTH, contact_sheet
+from watchfolder import SETTLE_TIME, WatchFolder
+
+
+def load_config(path: str | Path, overrides: list[str] = ()) -> dict:
+    '''reads config.json on top of the engine defaults, then applies KEY=VALUE overrides'''
+    config = dict(DEFAULTS)
+    if os.path.exists(path):
+        config.update(CfgDict(path, save_on_change=False))
+    for item in overrides:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value  # plain strings, ie. speed=fast
+    return config
+
+
+class Runner:
+    '''Drains a JobQueue, running each job's Encoder on its own thread.
+
+    `kill -USR1` pauses every running encode and `kill -USR2` resumes them.
+    '''
+
+    def __init__(self, queue: JobQueue, printer: Callable[[str], None] = print,
+                 verbose: bool = False, on_finish: Callable[[Job], None] | None = None):
+        self.queue = queue
+        self.queue.admit = GOVERNOR.admit
+        self.printer = printer
+        self.verbose = verbose
+        self.on_finish = on_finish
+        self.encoders: dict[int, Encoder] = {}
+        self.wakeup = threading.Event()
+        self.paused = False
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *_: self.pause_all())
+            signal.signal(signal.SIGUSR2, lambda *_: self.resume_all())
+
+    def pump(self):
+        '''starts pending jobs until the pool is full'''
+        while not self.paused and (job := self.queue.next_job()) is not None:
+            encoder = get_encoder(job.config, job.input)
+            encoder.max_prog = lambda val, job=job: setattr(job, 'max_prog', val)
+            encoder.progress = lambda val, job=job: self.queue.progress(job, val)
+            encoder.checkpoint = lambda data, job=job: self.queue.checkpoint(job, data)
+            encoder.change_title = lambda s, job=job: self.printer(f"[{job.name}] {s}")
+            if self.verbose:
+                encoder.status = lambda s, job=job: self.printer(f"[{job.name}] {' | '.join(s.splitlines())}")
+            self.encoders[job.id] = encoder
+            self.printer(f"[{job.name}] started with {job.threads} threads -> {job.output}")
+            threading.Thread(target=self._work, args=(job, encoder), daemon=True).start()
+
+    def _work(self, job: Job, encoder: Encoder):
+        try:
+            encoder.run()
+            job.verification = encoder.verification.to_dict() if encoder.verification else {}
+            if encoder.stopped:
+                self.queue.finish(job, JobState.CANCELLED, "stopped early, the output so far was kept")
+                self.printer(f"[{job.name}] {job.message}")
+            else:
+                self.queue.finish(job, JobState.DONE, encoder.summary())
+                self.printer(f"[{job.name}] done" + (f", {job.message}" if job.message else ""))
+        except Exception as e:
+            traceback.print_exception(e)
+            job.verification = encoder.verification.to_dict() if encoder.verification else {}
+            self.queue.finish(job, JobState.FAILED, f"{type(e).__name__}: {e}")
+            self.printer(f"[{job.name}] failed: {job.message}")
+        finally:
+            self.encoders.pop(job.id, None)
+            if self.on_finish:
+                self.on_finish(job)
+            self.wakeup.set()
+
+    def run_until_empty(self):
+        while self.queue.pending or self.queue.running:
+            self.pump()
+            self.wakeup.wait(0.5)
+            self.wakeup.clear()
+
+    def drain(self) -> int:
+        '''Runs the queue until it's empty, returns 130 if it was interrupted, otherwise 0.
+
+        The first ctrl+c stops the running jobs early, keeping their outputs,
+        and drops the queued ones. A second one cancels them.
+        '''
+        try:
+            self.run_until_empty()
+            return 0
+        except KeyboardInterrupt:
+            pass
+        self.printer("stopping, the outputs so far are kept (ctrl+c again to cancel)")
+        self.stop_all()
+        try:
+            self.run_until_empty()
+        except KeyboardInterrupt:
+            self.kill_all()
+        return 130
+
+    def pause_all(self):
+        self.paused = True
+        for encoder in list(self.encoders.values()):
+            encoder.pause()
+        self.printer(f"paused {len(self.encoders)} jobs")
+
+    def resume_all(self):
+        self.paused = False
+        for encoder in list(self.encoders.values()):
+            encoder.resume()
+        self.printer(f"resumed {len(self.encoders)} jobs")
+        self.wakeup.set()
+
+    def stop_all(self):
+        '''stops the running jobs early, keeping what they encoded, and cancels the queued ones'''
+        for job in self.queue.pending:
+            self.queue.cancel(job.id)
+        self.paused = False
+        for encoder in list(self.encoders.values()):
+            encoder.stop()
+
+    def kill_all(self):
+        for job_id, encoder in list(self.encoders.items()):
+            self.queue.cancel(job_id)
+            encoder.kill()
+
+
+def convert(args: argparse.Namespace, config: dict) -> int:
+    if args.output and len(args.inputs) > 1:
+        sys.exit("--output can only be used with a single input")
+
+    queue = JobQueue(args.workers or config['workers'], args.threads or resolve_threads(config['threads']),
+                     journal=get_journal())
+    for input in args.inputs:
+        if not os.path.exists(input):
+            sys.exit(f"{input} does not exist")
+        queue.add(input, args.output or converted_path(input, config), config)
+
+    runner = Runner(queue, verbose=args.verbose)
+    if runner.drain():
+        return 130
+    return int(any(job.state != JobState.DONE for job in queue))
+
+
+def daemon(args: argparse.Namespace, config: dict) -> int:
+    '''Watches a spool directory for job files.
+
+    A job file is a `<name>.json` holding at least {"input": ...}, plus any
+    config.json keys to override for that job. Write it under another name
+    and rename it into place, so a half-written file is never picked up.
+    The daemon claims a job by renaming it to `<name>.running`, and leaves
+    `<name>.done` or `<name>.failed` (with an "error" key) behind.
+    '''
+    spool = Path(args.spool)
+    spool.mkdir(parents=True, exist_ok=True)
+    queue = JobQueue(args.workers or config['workers'], args.threads or resolve_threads(config['threads']))
+    claimed: dict[int, Path] = {}
+
+    def finished(job: Job):
+        running = claimed.pop(job.id)
+        result = dict(json.loads(running.read_text()), state=job.state.name.lower())
+        if job.message:
+            result['error'] = job.message
+        running.with_suffix('.done' if job.state == JobState.DONE else '.failed').write_text(
+            json.dumps(result, indent=4))
+        running.unlink()
+
+    runner = Runner(queue, verbose=args.verbose, on_finish=finished)
+    print(f"Watching {spool.resolve()} for jobs")
+    try:
+        while True:
+            # only pull in as many files as can be started, the rest wait in the spool
+            free = queue.workers - len(queue.running) - len(queue.pending)
+            for file in sorted(spool.glob('*.json'), key=lambda f: f.stat().st_mtime)[:max(free, 0)]:
+                running = file.with_suffix('.running')
+                try:
+                    file.rename(running)  # atomic, so several daemons can share a spool
+                except OSError as e:  # another daemon got to it first
+                    print(f"skipping {file.name}: {e}")
+                    continue
+                job_config = None
+                try:
+                    job_config = json.loads(running.read_text())
+                    if not isinstance(job_config, dict) or 'input' not in job_config:
+                        raise ValueError('a job file holds at least {"input": ...}')
+                    merged = dict(config, **job_config)
+                    output = merged.get('output') or converted_path(merged['input'], merged)
+                except (OSError, ValueError, TypeError, KeyError) as e:
+                    # a bad file fails on its own, it doesn't take the daemon down with it
+                    error = f"{type(e).__name__}: {e}"
+                    print(f"rejecting {file.name}: {error}")
+                    result = job_config if isinstance(job_config, dict) else {}
+                    running.with_suffix('.failed').write_text(
+                        json.dumps(dict(result, state='failed', error=error), indent=4))
+                    running.unlink()
+                    continue
+                job = queue.add(merged['input'], output, merged)
+                claimed[job.id] = running
+            runner.pump()
+            runner.wakeup.wait(args.poll)
+            runner.wakeup.clear()
+            queue.clear_finished()
+    except KeyboardInterrupt:
+        runner.kill_all()
+        return 130
+
+
+def resume(args: argparse.Namespace, config: dict) -> int:
+    '''Runs the jobs a crash interrupted again, segmented ones from their last finished segment.'''
+    journal = get_journal()
+    entries = journal.unfinished()
+    if not entries:
+        print("no interrupted jobs")
+        return 0
+    for entry in entries:
+        print(entry)
+    if args.list:
+        return 0
+    if args.discard:
+        for entry in entries:
+            journal.discard(entry)
+        print(f"discarded {len(entries)} jobs")
+        return 0
+
+    queue = JobQueue(args.workers or config['workers'], args.threads or resolve_threads(config['threads']),
+                     journal=journal)
+    for entry in entries:
+        journal.restore(entry, queue)
+    runner = Runner(queue, verbose=args.verbose)
+    if runner.drain():
+        return 130
+    return int(any(job.state != JobState.DONE for job in queue))
+
+
+def watch(args: argparse.Namespace, config: dict) -> int:
+    '''Converts videos dropped into a folder with the settings in config.json.'''
+    folder = Path(args.folder)
+    if not folder.is_dir():
+        sys.exit(f"{folder} is not a directory")
+    queue = JobQueue(args.workers or config['workers'], args.threads or resolve_threads(config['threads']),
+                     journal=get_journal())
+    # jobs a crash interrupted are picked up again before anything new
+    for entry in queue.journal.unfinished():
+        print(f"resuming {entry}")
+        queue.journal.restore(entry, queue)
+    watcher = WatchFolder(folder, config, queue, settle=args.settle, max_pending=args.max_pending,
+                          polling=args.polling)
+    runner = Runner(queue, verbose=args.verbose)
+    print(f"Watching {watcher.root} ({type(watcher.source).__name__}), {watcher.backlog} files found")
+    try:
+        while True:
+            watcher.step(args.poll)
+            runner.pump()
+            queue.clear_finished()
+    except KeyboardInterrupt:
+        runner.kill_all()
+        return 130
+    finally:
+        watcher.close()
+
+
+def predict(args: argparse.Namespace, config: dict) -> int:
+    '''Encodes a few samples of every input and prints the projected size and encode time.'''
+    failed = False
+    for input in args.inputs:
+        if not os.path.exists(input):
+            sys.exit(f"{input} does not exist")
+        job_config = dict(config, input=input, output=converted_path(input, config))
+        if args.threads:
+            job_config['threads'] = args.threads
+        predictor = Predictor(job_config, count=args.samples, length=args.length)
+        if args.verbose:
+            predictor.status = lambda s: print(s.splitlines()[0])
+        try:
+            print(f"[{Path(input).name}]\n{predictor.run()}")
+        except KeyboardInterrupt:
+            predictor.kill()
+            return 130
+        except Exception as e:
+            print(f"[{Path(input).name}] failed: {type(e).__name__}: {e}")
+            failed = True
+    return int(failed)
+
+
+def tune(args: argparse.Namespace, config: dict) -> int:
+    '''Times a reference clip across presets and thread counts and stores the best for "auto".'''
+
+    presets = args.presets.split(',') if args.presets else PRESETS
+    unknown = set(presets) - set(PRESETS)
+    if unknown:
+        sys.exit(f"unknown presets: {', '.join(sorted(unknown))}")
+    threads = [int(count) for count in args.grid_threads.split(',')] if args.grid_threads else thread_grid()
+    try:
+        tuning = autotune(config, presets, threads, source=args.source, length=args.length,
+                          max_size_ratio=args.max_size_ratio)
+    except KeyboardInterrupt:
+        return 130
+    print(f"fastest within {args.max_size_ratio:g}x of the smallest output: "
+          f"{tuning['speed']} with {tuning['threads']} threads"
+          "\nuse --set speed=auto --set threads=0, or \"auto\" in the gui, to encode with it")
+    return 0
+
+
+def history(args: argparse.Namespace, config: dict) -> int:
+    '''Prints the throughput of past jobs per preset and thread count, fastest first.'''
+    from history import get_history
+
+    rows = get_history().report()
+    if not rows:
+        print("no finished encodes yet")
+        return 0
+    print(f"{'preset':<10} {'threads':>7} {'split':>5} {'jobs':>5} {'fps':>8} {'Mpx/s':>8} {'time':>8}")
+    for row in rows:
+        print(f"{row['preset']:<10} {row['threads']:>7} {'yes' if row['segmented'] else 'no':>5} {row['jobs']:>5}"
+              f" {row['fps']:>8.1f} {row['mpixels_per_second']:>8.2f} {row['wall']:>7.0f}s")
+    return 0
+
+
+def scan(args: argparse.Namespace, config: dict) -> int:
+    '''Probes every video under the given paths. Unchanged files come from the probe cache.'''
+    import ffmpeg
+    from probe_cache import get_cache
+
+    cache = get_cache()
+    ffprobe_path = find_ffmpeg()[1] or 'ffprobe'
+    start = time.perf_counter()
+    for root in args.paths:
+        files = [Path(root)] if os.path.isfile(root) else sorted(Path(root).rglob('*'))
+        for file in files:
+            if file.suffix.lower() not in VIDEO_EXTENSIONS:
+                continue
+            try:
+                data = cache.probe(file, lambda path: ffmpeg.probe(path, cmd=ffprobe_path))
+            except ffmpeg.Error:
+                print(f"{file}: could not be probed")
+                continue
+            video = next((s for s in data['streams'] if s['codec_type'] == 'video'), {})
+            print(f"{file}: {video.get('codec_name', '?')} {video.get('width', '?')}x{video.get('height', '?')}"
+                  f" {float(data['format'].get('duration', 0)):.1f}s")
+    cache.flush()
+    print(f"{cache.hits + cache.misses} files in {time.perf_counter() - start:.2f}s"
+          f" ({cache.hits} cached, {cache.misses} probed)")
+    return 0
+
+
+def thumbs(args: argparse.Namespace, config: dict) -> int:
+    '''Writes a contact sheet of every input, next to it or into --output.'''
+    columns, _, rows = args.grid.partition('x')
+    failed = False
+    for input in args.inputs:
+        if not os.path.exists(input):
+            sys.exit(f"{input} does not exist")
+        output = Path(args.output or Path(input).parent) / f"{Path(input).stem}-sheet.jpg"
+        start = time.perf_counter()
+        try:
+            contact_sheet(input, int(columns), int(rows or columns), args.width, output)
+        except Exception as e:
+            print(f"[{Path(input).name}] failed: {type(e).__name__}: {e}")
+            failed = True
+            continue
+        print(f"{output} ({time.perf_counter() - start:.2f}s)")
+    return int(failed)
+
+
+def worker(args: argparse.Namespace, config: dict) -> int:
+    '''Encodes segments for coordinators on other machines, see cluster.py.'''
+    from cluster import WorkerServer, parse_address
+
+    host, port = parse_address(args.listen or '0.0.0.0')
+    server = WorkerServer(config, host, port, slots=args.slots, workdir=args.workdir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        server.close()
+    return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    # options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default='config.json', help="config file shared with the gui")
+    common.add_argument('--set', action='append', default=[], metavar="KEY=VALUE",
+                        help="overrides a config key for this run, ie. --set speed=fast")
+    common.add_argument('--workers', type=int, help="concurrent ffmpeg processes")
+    common.add_argument('--threads', type=int, help="thread budget split across the workers")
+    common.add_argument('--force-encode', action='store_true',
+                        help="re-encode even when the input could just be remuxed")
+    common.add_argument('--metrics', metavar="NAMES",
+                        help="measure these on samples of every output, comma separated: ssim, psnr, vmaf")
+    common.add_argument('--no-verify', action='store_true', help="don't check outputs once they're written")
+    common.add_argument('--cluster', metavar="HOSTS",
+                        help="encode segments on these workers (host:port, comma separated)")
+    common.add_argument('--no-cache', action='store_true',
+                        help="encode even if the same input was converted with the same settings before")
+    common.add_argument('-v', '--verbose', action='store_true', help="print every progress update")
+
+    parser = argparse.ArgumentParser(prog="turnh264", description="Converts video into H264 using FFmpeg.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', parents=[common], help="convert one or more files")
+    convert_parser.add_argument('inputs', nargs='+')
+    convert_parser.add_argument('-o', '--output', help="output path, defaults to <input>-converted.<extension>")
+    convert_parser.set_defaults(func=convert)
+
+    daemon_parser = subparsers.add_parser('daemon', parents=[common], help="run jobs dropped into a spool directory")
+    daemon_parser.add_argument('--spool', default='spool')
+    daemon_parser.add_argument('--poll', type=float, default=1.0, help="seconds between spool scans")
+    daemon_parser.set_defaults(func=daemon)
+
+    resume_parser = subparsers.add_parser('resume', parents=[common], help="run jobs a crash interrupted again")
+    resume_parser.add_argument('--list', action='store_true', help="only list them")
+    resume_parser.add_argument('--discard', action='store_true', help="give up on them and remove partial outputs")
+    resume_parser.set_defaults(func=resume)
+
+    watch_parser = subparsers.add_parser('watch', parents=[common], help="convert videos dropped into a folder")
+    watch_parser.add_argument('folder')
+    watch_parser.add_argument('--settle', type=float, default=SETTLE_TIME,
+                              help="seconds a file has to stay unchanged before it's converted")
+    watch_parser.add_argument('--max-pending', type=int, help="jobs queued at most, the rest wait")
+    watch_parser.add_argument('--poll', type=float, default=1.0, help="seconds between checks")
+    watch_parser.add_argument('--polling', action='store_true', help="poll even if inotify is available")
+    watch_parser.set_defaults(func=watch)
+
+    predict_parser = subparsers.add_parser('predict', parents=[common],
+                                           help="project output size and encode time from a few samples")
+    predict_parser.add_argument('inputs', nargs='+')
+    predict_parser.add_argument('--samples', type=int, default=SAMPLE_COUNT, help="number of samples to encode")
+    predict_parser.add_argument('--length', type=float, default=SAMPLE_LENGTH, help="seconds per sample")
+    predict_parser.set_defaults(func=predict)
+
+    tune_parser = subparsers.add_parser('tune', parents=[common],
+                                        help="find the fastest preset and thread count for this machine")
+    tune_parser.add_argument('--source', help="cut the reference clip from this file instead of generating one")
+    tune_parser.add_argument('--length', type=float, default=REFERENCE_LENGTH, help="reference clip length")
+    tune_parser.add_argument('--presets', help="comma separated, defaults to all of them")
+    tune_parser.add_argument('--grid-threads', metavar="THREADS", help="comma separated thread counts to try")
+    tune_parser.add_argument('--max-size-ratio', type=float, default=MAX_SIZE_RATIO,
+                             help="how much bigger than the smallest output the pick may be")
+    tune_parser.set_defaults(func=tune)
+
+    history_parser = subparsers.add_parser('history', parents=[common],
+                                           help="show which presets and thread counts were fastest")
+    history_parser.set_defaults(func=history)
+
+    scan_parser = subparsers.add_parser('scan', parents=[common], help="probe a library of videos")
+    scan_parser.add_argument('paths', nargs='+')
+    scan_parser.set_defaults(func=scan)
+
+    thumbs_parser = subparsers.add_parser('thumbs', parents=[common], help="make a contact sheet of each file")
+    thumbs_parser.add_argument('inputs', nargs='+')
+    thumbs_parser.add_argument('-o', '--output', help="directory for the sheets, defaults to next to each input")
+    thumbs_parser.add_argument('--grid', default=f"{COLUMNS}x{ROWS}", help="columns x rows")
+    thumbs_parser.add_argument('--width', type=int, default=TILE_WIDTH, help="width of a tile")
+    thumbs_parser.set_defaults(func=thumbs)
+
+    worker_parser = subparsers.add_parser('worker', parents=[common],
+                                          help="encode segments for a coordinator on another machine")
+    worker_parser.add_argument('--listen', metavar="HOST:PORT", help="defaults to port 8264 on every interface")
+    worker_parser.add_argument('--slots', type=int, default=1, help="segments encoded at once")
+    worker_parser.add_argument('--workdir', help="where segments are kept while they're encoded")
+    worker_parser.set_defaults(func=worker)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = get_parser().parse_args(argv)
+    engine.set_data_dir(Path(args.config).parent)
+    config = load_config(args.config, args.set)
+    if args.force_encode:
+        config['force_encode'] = True
+    if args.metrics is not None:
+        config['verify_metrics'] = args.metrics
+    if args.no_verify:
+        config['verify'] = False
+    if args.no_cache:
+        config['output_cache'] = False
+    if args.cluster is not None:
+        config['cluster_workers'] = args.cluster
+    GOVERNOR.configure(config)
+    return args.func(args, config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
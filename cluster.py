@@ -0,0 +1,548 @@
+'''Segment-parallel encoding spread over other machines.
+
+A worker (`python cli.py worker`) listens on a TCP port and encodes whatever
+segments it's sent. A job with `cluster_workers` set to "host:port,..." is the
+coordinator: it cuts the input's video at keyframes like segments.py, ships each
+segment to a free worker, and joins what comes back with the audio, locally.
+
+Every message is a 4 byte length and a json header. When the header has a
+"size", that many bytes of a file follow it. Workers send a heartbeat every
+HEARTBEAT_INTERVAL seconds; one that's silent for HEARTBEAT_TIMEOUT, or whose
+segment made no progress for STALL_TIMEOUT, is dropped and its segment goes to
+another worker, MAX_ATTEMPTS times at most. Once a
+worker's speed is known, the last few segments are left for faster workers if
+they'd finish them sooner.
+
+There's no authentication, run workers on a network you trust.
+'''
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import ffmpeg
+
+from engine import DEFAULTS, Encoder, frame_rate, resolve_threads
+from jobs import partition_threads
+from progress import SUPERVISOR, ProgressRecord
+from segments import SegmentedEncoder
+
+DEFAULT_PORT = 8264
+PROTOCOL = 1
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 15.0
+# a segment that hasn't made progress for this long is given up on, heartbeats or not
+STALL_TIMEOUT = 120.0
+MAX_ATTEMPTS = 3
+# a node is only waited for if it's at least this much faster
+FASTER = 1.25
+MAX_HEADER = 16 * 1024 * 1024
+BLOCK = 1024 * 1024
+# the keys a worker takes from its own config instead of the coordinator's
+LOCAL_KEYS = ('threads', 'nice', 'ionice', 'pin_cpus')
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+class SegmentFailed(RuntimeError):
+    '''ffmpeg failed on a worker, the worker itself is fine'''
+
+
+def parse_address(address: str, default_port: int = DEFAULT_PORT) -> tuple[str, int]:
+    '''"host:port" -> ("host", port), the port is optional
+
+    >>> parse_address("10.0.0.2:9000"), parse_address("render1")
+    (('10.0.0.2', 9000), ('render1', 8264))
+    '''
+    host, _, port = address.strip().rpartition(':')
+    if not host:
+        return port, default_port
+    return host.strip('[]'), int(port)
+
+
+class Connection:
+    '''A socket speaking the protocol above, safe to send on from several threads.'''
+
+    def __init__(self, sock: socket.socket, name: str = ""):
+        self.sock = sock
+        self.name = name
+        self._send_lock = threading.Lock()
+
+    def send(self, message: dict, file: Path | None = None):
+        if file is not None:
+            message = dict(message, size=os.path.getsize(file))
+        header = json.dumps(message).encode()
+        with self._send_lock:
+            self.sock.sendall(struct.pack('>I', len(header)) + header)
+            if file is not None:
+                with open(file, 'rb') as data:
+                    self.sock.sendfile(data)
+
+    def recv(self) -> dict:
+        size, = struct.unpack('>I', self._recv_exactly(4))
+        if size > MAX_HEADER:
+            raise ProtocolError(f"a {size} byte header, is this a TurnH264 worker?")
+        try:
+            return json.loads(self._recv_exactly(size))
+        except ValueError as e:
+            raise ProtocolError(f"unreadable message: {e}") from e
+
+    def recv_file(self, size: int, path: Path):
+        with open(path, 'wb') as file:
+            while size > 0:
+                data = self.sock.recv(min(BLOCK, size))
+                if not data:
+                    raise ConnectionError("connection closed mid-file")
+                file.write(data)
+                size -= len(data)
+
+    def _recv_exactly(self, size: int) -> bytes:
+        buffer = bytearray()
+        while len(buffer) < size:
+            data = self.sock.recv(size - len(buffer))
+            if not data:
+                raise ConnectionError("connection closed")
+            buffer += data
+        return bytes(buffer)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# worker
+
+
+class WorkerServer:
+    '''Encodes segments for any coordinator that connects, `slots` at once.
+
+    The thread budget in `config` is split across the slots, and nice, ionice
+    and pinning come from it too, everything else from the coordinator.
+    '''
+
+    def __init__(self, config: dict, host: str = '0.0.0.0', port: int = DEFAULT_PORT, slots: int = 1,
+                 workdir: str | Path | None = None):
+        self.config = {**DEFAULTS, **config}
+        self.slots = max(int(slots), 1)
+        self.threads = partition_threads(resolve_threads(self.config['threads']), self.slots)[-1]
+        self.workdir = Path(workdir or tempfile.mkdtemp(prefix='turnh264-worker-'))
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self._free = threading.Semaphore(self.slots)
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.closed = threading.Event()
+
+    def serve_forever(self):
+        print(f"Worker listening on {self.address[0]}:{self.address[1]}, "
+              f"{self.slots} slots of {self.threads} threads")
+        while not self.closed.is_set():
+            try:
+                sock, address = self.server.accept()
+            except OSError:  # close() was called
+                break
+            threading.Thread(target=self._serve, args=(sock, f"{address[0]}:{address[1]}"), daemon=True).start()
+
+    def close(self):
+        self.closed.set()
+        self.server.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _serve(self, sock: socket.socket, name: str):
+        connection = Connection(sock, name)
+        # what the coordinator asked for, applied to the encode that's running or the next one
+        state = {'encoder': None, 'paused': False, 'stopped': False}
+        gone = threading.Event()
+        try:
+            hello = connection.recv()
+            if hello.get('type') != 'hello' or hello.get('protocol') != PROTOCOL:
+                connection.send({'type': 'error', 'message': f"this worker speaks protocol {PROTOCOL}"})
+                return
+            connection.send({'type': 'hello', 'protocol': PROTOCOL, 'name': socket.gethostname(),
+                             'slots': self.slots, 'threads': self.threads})
+            threading.Thread(target=self._heartbeat, args=(connection, gone), daemon=True).start()
+            while True:
+                message = connection.recv()
+                kind = message.get('type')
+                if kind == 'encode':
+                    token = uuid.uuid4().hex
+                    chunk = self.workdir / f"{token}.in.mkv"
+                    connection.recv_file(int(message['size']), chunk)
+                    threading.Thread(target=self._encode, args=(connection, message, chunk, token, state),
+                                     daemon=True).start()
+                elif kind in ('pause', 'resume', 'stop'):
+                    state['paused'] = kind == 'pause'
+                    state['stopped'] = state['stopped'] or kind == 'stop'
+                    if state['encoder'] is not None:
+                        getattr(state['encoder'], kind)()
+        except (OSError, ValueError):  # the coordinator went away, or cancelled
+            pass
+        finally:
+            gone.set()
+            if state['encoder'] is not None:
+                state['encoder'].kill()
+            connection.close()
+
+    @staticmethod
+    def _heartbeat(connection: Connection, gone: threading.Event):
+        while not gone.wait(HEARTBEAT_INTERVAL):
+            try:
+                connection.send({'type': 'heartbeat'})
+            except (OSError, ValueError):
+                break
+
+    def _encode(self, connection: Connection, message: dict, chunk: Path, token: str, state: dict):
+        output = self.workdir / f"{token}.out{message.get('suffix', '.mp4')}"
+        try:
+            # the coordinator's deadline only counts once there's a slot
+            while not self._free.acquire(timeout=HEARTBEAT_INTERVAL):
+                connection.send({'type': 'waiting'})
+            try:
+                self._run(connection, message, chunk, output, state)
+            finally:
+                self._free.release()
+        except Exception as e:  # anything, or the coordinator would only ever hear heartbeats
+            print(f"segment {message.get('idx')} for {connection.name} failed: {type(e).__name__}: {e}")
+            try:
+                connection.send({'type': 'error', 'message': f"{type(e).__name__}: {e}"})
+            except (OSError, ValueError):  # a closed socket raises ValueError
+                pass
+        finally:
+            state['encoder'] = None
+            chunk.unlink(missing_ok=True)
+            output.unlink(missing_ok=True)
+
+    def _run(self, connection: Connection, message: dict, chunk: Path, output: Path, state: dict):
+        '''encodes one segment and sends it back'''
+        # only the keys the engine knows, whatever else the coordinator sent is dropped
+        config = {key: message['config'][key] for key in DEFAULTS if key in message['config']}
+        config.update({key: self.config[key] for key in LOCAL_KEYS},
+                      threads=self.threads, input=str(chunk), output=str(output))
+        encoder = Encoder(config)
+        encoder.check_for_ffmpeg()
+        state['encoder'] = encoder
+        if state['paused']:
+            encoder.pause()
+        if state['stopped']:
+            encoder.stop()
+        started = time.monotonic()
+        frames = [0]
+
+        def report(record: ProgressRecord):
+            frames[0] = record.frame
+            try:
+                connection.send({'type': 'progress', 'frame': record.frame, 'fps': record.fps,
+                                 'total_size': record.total_size, 'out_time_us': record.out_time_us})
+            except (OSError, ValueError):
+                pass
+
+        # keep the source timestamps, a constant frame rate would pad every segment's end
+        output_kwargs = {} if config['fps'] else {'vsync': 'passthrough'}
+        encoder.stream = encoder.get_ffmpeg_stream(
+            message['video'], audio=False, threads=self.threads, output_kwargs=output_kwargs, log=False
+        ).run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, cmd=encoder.ffmpeg_path)
+        encoder._started(encoder.stream, self.threads)
+        watch = SUPERVISOR.watch(encoder.stream, report)
+        watch.wait()
+        if encoder.cancelled:
+            return
+        if not encoder.exited_ok(watch.returncode):
+            connection.send({'type': 'error',
+                             'message': f"ffmpeg exited with code {watch.returncode}: {watch.stderr}"})
+            return
+        print(f"segment {message.get('idx')} for {connection.name}: {frames[0]} frames "
+              f"in {time.monotonic() - started:.1f}s")
+        connection.send({'type': 'done', 'frames': frames[0], 'stopped': encoder.stopped}, file=output)
+
+
+# coordinator
+
+
+@dataclass
+class Task:
+    idx: int
+    start: float
+    end: float | None
+    attempts: int = 0
+
+
+@dataclass
+class Node:
+    '''One connection to a worker, a worker with several slots gets one per slot.'''
+    address: str
+    connection: Connection
+    name: str
+    threads: int
+    frames: int = 0  # encoded on it so far
+    busy: float = 0.0  # seconds spent on them, transfers included
+    current: Task | None = None
+    lost: bool = False
+
+    @property
+    def throughput(self) -> float | None:
+        '''frames per second, None until it finished a segment'''
+        return self.frames / self.busy if self.frames and self.busy > 0 else None
+
+
+def _handshake(address: str) -> tuple[Connection, dict]:
+    host, port = parse_address(address)
+    sock = socket.create_connection((host, port), timeout=HEARTBEAT_TIMEOUT)
+    connection = Connection(sock, address)
+    try:
+        connection.send({'type': 'hello', 'protocol': PROTOCOL})
+        hello = connection.recv()
+        if hello.get('type') != 'hello':
+            raise ProtocolError(hello.get('message', f"unexpected {hello.get('type')}"))
+    except Exception:
+        connection.close()
+        raise
+    return connection, hello
+
+
+def connect(addresses: list[str]) -> list[Node]:
+    '''Connects to every worker, once per slot. The ones that don't answer are left out.'''
+    nodes = []
+    for address in addresses:
+        try:
+            connection, hello = _handshake(address)
+            slots = int(hello['slots'])
+            nodes.append(Node(address, connection, address if slots == 1 else f"{address}#1", hello['threads']))
+            for slot in range(2, slots + 1):
+                connection, _ = _handshake(address)
+                nodes.append(Node(address, connection, f"{address}#{slot}", hello['threads']))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"cluster worker {address} is unavailable: {e}")
+    return nodes
+
+
+class DistributedEncoder(SegmentedEncoder):
+    '''SegmentedEncoder with the segments encoded by `cluster_workers` instead
+    of local ffmpeg processes.
+
+    The input's video is cut into one file per segment by ffmpeg's segment
+    muxer, a single stream copy pass, so every part starts on its keyframe
+    and no worker needs the whole input. The audio, the join and the
+    verification stay local. Pause, finish now and cancel are passed on to
+    the workers.
+    '''
+    cache_tag = 'distributed'
+
+    def __init__(self, config: dict, path: str | None = None):
+        super().__init__(config, path)
+        self.nodes: list[Node] = []
+        self.todo: deque[Task] = deque()
+        self.error: Exception | None = None
+        self._cond = threading.Condition()
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            for node in self.nodes:
+                node.connection.close()
+
+    def worker_count(self) -> int:
+        if not self.nodes:
+            addresses = [address for address in str(self.config['cluster_workers']).split(',') if address.strip()]
+            self.nodes = connect(addresses)
+            if not self.nodes:
+                raise ConnectionError(f"none of the cluster workers answered: {', '.join(addresses)}")
+        return len(self.nodes)
+
+    def _encode_segments(self, segments: list[tuple[float, float | None]], finished: set[int], paths: list[Path],
+                         half_frame: float, video_stream: dict, workers: int):
+        self.framerate = float(frame_rate(video_stream) or 25)
+        names = ", ".join(node.name for node in self.nodes)
+        self.status(f"Cutting {len(segments)} segments for {len(self.nodes)} cluster workers ({names})")
+        chunks = self._cut(segments, half_frame)
+        self.todo = deque(Task(idx, start, end) for idx, (start, end) in enumerate(segments) if idx not in finished)
+        self.status(f"Encoding {len(self.todo)} segments on {len(self.nodes)} cluster workers ({names})")
+        with ThreadPoolExecutor(len(self.nodes)) as pool:
+            futures = [pool.submit(self._drive, node, chunks, paths, video_stream) for node in self.nodes]
+            for future in futures:
+                future.result()
+        if self.cancelled:
+            return
+        if self.error is not None:
+            raise self.error
+        if self.todo and not self.stopped:
+            raise ConnectionError(f"every cluster worker was lost, {len(self.todo)} segments weren't encoded")
+
+    def _cut(self, segments: list[tuple[float, float | None]], half_frame: float) -> list[Path]:
+        '''Copies the video of each segment into a file of its own, in one pass.
+
+        The segment muxer splits at the first keyframe after each time, and
+        ffmpeg starts the input at 0, so the times are moved back by the
+        input's start and half a frame.
+        '''
+        offset = float(self.metadata['format'].get('start_time') or 0) + half_frame
+        times = ",".join(f"{start - offset:.6f}" for start, _ in segments[1:])
+        kwargs = {'segment_times': times} if times else {}
+        pattern = self.workdir / "chunk_%04d.mkv"
+        self.stream = (
+            ffmpeg.input(self.config['input'])['v:0']
+            .output(str(pattern), c='copy', f='segment', segment_format='matroska', reset_timestamps=1,
+                    loglevel='error', **kwargs)
+            .overwrite_output()
+            .global_args('-nostats', '-hide_banner')
+            .run_async(pipe_stderr=True, cmd=self.ffmpeg_path)
+        )
+        watch = SUPERVISOR.watch(self.stream)
+        if watch.wait() != 0:
+            raise RuntimeError(f"cutting the segments failed with exit code {watch.returncode}: {watch.stderr}")
+        chunks = [self.workdir / f"chunk_{idx:04d}.mkv" for idx in range(len(segments))]
+        if not all(chunk.exists() for chunk in chunks):
+            raise RuntimeError(f"the input was cut into {len(list(self.workdir.glob('chunk_*.mkv')))} parts "
+                               f"instead of {len(segments)}")
+        return chunks
+
+    def _frames(self, task: Task) -> float:
+        end = task.end if task.end is not None else float(self.metadata['format']['duration'])
+        return (end - task.start) * self.framerate
+
+    def _defer(self, node: Node, task: Task) -> bool:
+        '''whether a faster worker would be done with `task` sooner, once it's finished its own'''
+        mine = node.throughput
+        if mine is None:
+            return False
+        faster = [other for other in self.nodes
+                  if other is not node and not other.lost and (other.throughput or 0) > mine * FASTER]
+        # with more segments left than faster workers, there's work enough for this one too
+        if len(self.todo) > len(faster):
+            return False
+        frames = self._frames(task)
+        for other in faster:
+            left = 0.0
+            if other.current is not None:
+                left = max(self._frames(other.current) - self.frames[other.current.idx], 0)
+            if (left + frames) / other.throughput < frames / mine:
+                return True
+        return False
+
+    def _take(self, node: Node) -> Task | None:
+        with self._cond:
+            while True:
+                if self.cancelled or self.stopped or self.error is not None:
+                    return None
+                if self.todo and not self._defer(node, self.todo[0]):
+                    node.current = self.todo.popleft()
+                    return node.current
+                if not self.todo and not any(other.current for other in self.nodes):
+                    return None
+                # a lost worker's segment may come back, or a faster one may not take it after all
+                self._cond.wait(1.0)
+
+    def _drive(self, node: Node, chunks: list[Path], paths: list[Path], video_stream: dict):
+        '''feeds segments to one worker until there are none left or it's lost'''
+        while (task := self._take(node)) is not None:
+            try:
+                self._unpaused.wait()
+                self._encode_remote(node, task, chunks[task.idx], paths[task.idx], video_stream)
+            except SegmentFailed as e:
+                self._retry(node, task, str(e))
+            except (OSError, ValueError) as e:
+                node.lost = True
+                node.connection.close()
+                if not self.cancelled:
+                    print(f"cluster worker {node.name} was lost: {e}")
+                self._retry(node, task, f"{node.name} was lost")
+                return
+            else:
+                with self._cond:
+                    node.current = None
+                    self._cond.notify_all()
+
+    def _retry(self, node: Node, task: Task, reason: str):
+        with self._cond:
+            node.current = None
+            self.frames[task.idx] = 0
+            self.fps[task.idx] = 0.0
+            self.times[task.idx] = 0.0
+            if not self.cancelled and not self.stopped:
+                task.attempts += 1
+                if task.attempts >= MAX_ATTEMPTS:
+                    self.error = RuntimeError(f"segment {task.idx} failed {task.attempts} times, last: {reason}")
+                else:
+                    self.status(f"{reason}, segment {task.idx} is sent again")
+                    self.todo.appendleft(task)
+            self._cond.notify_all()
+
+    def _encode_remote(self, node: Node, task: Task, chunk: Path, path: Path, video_stream: dict):
+        started = time.monotonic()
+        node.connection.send({'type': 'encode', 'idx': task.idx, 'config': self.config, 'video': video_stream,
+                              'suffix': path.suffix}, file=chunk)
+        deadline = time.monotonic() + STALL_TIMEOUT
+        while True:
+            if self.paused:
+                deadline = time.monotonic() + STALL_TIMEOUT
+            elif time.monotonic() > deadline:
+                # dropping the connection stops the worker's ffmpeg too
+                raise TimeoutError(f"segment {task.idx} made no progress for {STALL_TIMEOUT:.0f}s")
+            message = node.connection.recv()
+            kind = message.get('type')
+            if kind in ('progress', 'waiting'):
+                deadline = time.monotonic() + STALL_TIMEOUT
+            if kind == 'progress':
+                # the chunks start at 0, so out_time is how far into the segment the worker is
+                record = ProgressRecord(frame=int(message['frame']), fps=message['fps'],
+                                        total_size=message['total_size'],
+                                        out_time_us=int(message.get('out_time_us') or 0))
+                self._segment_progress(task.idx, record)
+            elif kind == 'error':
+                raise SegmentFailed(f"{node.name}: {message['message']}")
+            elif kind == 'done':
+                break
+            elif kind not in ('heartbeat', 'waiting'):
+                raise ProtocolError(f"unexpected {kind}")
+        partial = path.with_name(f"{path.stem}.partial{path.suffix}")
+        node.connection.recv_file(int(message['size']), partial)
+        node.frames += int(message['frames'])
+        node.busy += time.monotonic() - started
+        self.frames[task.idx] = int(message['frames'])
+        self.fps[task.idx] = 0.0
+        chunk.unlink(missing_ok=True)
+        if message['stopped']:  # cut short, it stays partial
+            return
+        self._finish_segment(task.idx, partial, path)
+
+    def _broadcast(self, kind: str):
+        for node in self.nodes:
+            if not node.lost:
+                try:
+                    node.connection.send({'type': kind})
+                except OSError:  # its driver finds out too
+                    pass
+
+    def pause(self):
+        super().pause()
+        self._broadcast('pause')
+
+    def resume(self):
+        super().resume()
+        self._broadcast('resume')
+
+    def stop(self):
+        super().stop()
+        self._broadcast('stop')
+
+    def kill(self):
+        super().kill()
+        for node in self.nodes:
+            node.connection.close()
+        with self._cond:
+            self._cond.notify_all()
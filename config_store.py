@@ -0,0 +1,93 @@
+'''Write-behind persistence for config.json.'''
+from __future__ import annotations
+
+import os
+import threading
+import time
+from pathlib import Path
+
+from cfg_argparser import CfgDict
+
+# seconds of quiet before pending changes are written
+DEBOUNCE = 0.5
+
+
+class WriteBehindConfig(CfgDict):
+    '''A CfgDict whose save() only marks it dirty.
+
+    Changes are coalesced in memory and written once the config has been quiet
+    for `delay` seconds, or when flush() is called (on close, or by the save
+    button). Writes go to a temporary file that is renamed over the config, so
+    a crash can never leave a truncated config.json behind.
+    '''
+
+    def __init__(self, cfg_path: str | Path, *args, delay: float = DEBOUNCE, **kwargs):
+        # CfgDict.__init__ may already call save(), so these come first
+        self.delay = delay
+        self.dirty = False
+        self.requests = 0  # save() calls
+        self.saves = 0  # actual writes
+        self._lock = threading.RLock()
+        self._timer: threading.Timer | None = None
+        self._deadline = 0.0
+        super().__init__(cfg_path, *args, **kwargs)
+
+    @property
+    def saves_avoided(self) -> int:
+        return max(self.requests - self.saves, 0)
+
+    def save(self, out_dict=None):
+        '''schedules a write, restarting the debounce timer'''
+        if isinstance(out_dict, dict) and out_dict is not self:
+            # saving some other dict, ie. CfgDict.load() creating a missing file, is done right away
+            with self._lock:
+                self._write(out_dict)
+            return self
+        with self._lock:
+            self.requests += 1
+            self.dirty = True
+            # one timer is re-armed against a moving deadline instead of a new one per keystroke
+            self._deadline = time.monotonic() + self.delay
+            if self._timer is None:
+                self._start_timer(self.delay)
+        return self
+
+    def _start_timer(self, delay: float):
+        self._timer = threading.Timer(delay, self._timer_fired)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timer_fired(self):
+        with self._lock:
+            remaining = self._deadline - time.monotonic()
+            if remaining > 0:
+                self._start_timer(remaining)
+                return
+            self._timer = None
+        self.flush()
+
+    def flush(self) -> bool:
+        '''writes pending changes now, returns whether anything was written'''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.dirty:
+                return False
+            self.dirty = False
+            self._write(dict(self))
+            self.saves += 1
+            return True
+
+    def _write(self, out_dict: dict):
+        if self.sort_on_save:
+            out_dict = dict(sorted(out_dict.items()))
+        path = Path(self.cfg_path)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        type(self.save_handler)(tmp).save(out_dict)
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
@@ -0,0 +1,734 @@
+'''The conversion engine. Nothing in here imports Qt, so it can be driven
+by the gui's worker threads, the command line or the daemon alike.'''
+from __future__ import annotations
+
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from fractions import Fraction
+from pathlib import Path
+
+from governor import GOVERNOR, available_cpus
+from progress import SUPERVISOR, ProgressRecord
+
+# the affinity mask and cgroup quota, not the host's cores, see governor.py
+CPU_COUNT = available_cpus()
+PROGRAM_ORIGIN = Path(os.path.dirname(__file__))
+# where config.json lives, caches and other local state are kept next to it
+DATA_DIR = Path('.')
+VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.ts', '.mov', '.webm', '.m4v', '.flv', '.wmv', '.mpg', '.mpeg'}
+# x264's presets, fastest last. "auto" picks the tuned one, see autotune.py
+PRESETS = ["veryslow", "slower", "slow", "medium", "fast", "faster", "veryfast", "ultrafast"]
+AUTO = "auto"
+# extensions that export an image sequence instead of a video, see images.py
+IMAGE_FORMATS = ['png', 'bmp', 'webp', 'jpg']
+# swscale's algorithms, fast_bilinear is the quickest and lanczos the sharpest
+SCALERS = ["bicubic", "fast_bilinear", "bilinear", "area", "spline", "lanczos"]
+# containers an h264 stream can be copied into as is
+REMUX_CONTAINERS = {'.mp4', '.mkv', '.avi', '.ts', '.mov', '.m4v'}
+
+# the config.json keys the engine reads, with the gui's defaults
+DEFAULTS = {
+    'input': '',
+    'output': '',
+    'extension': 'mp4',
+    'video_dropdown': 'crf',
+    'video_bitrate': 16,
+    'audio_dropdown': 'copy',
+    'audio_bitrate': 192,
+    'threads': max(int(CPU_COUNT * 0.75), 1),
+    'workers': 1,
+    'speed': 'slow',
+    'fps': 0,
+    'res_dropdown': 'copy',
+    'resolution': 0,
+    'fit_size': '1920x1080',  # the box res_dropdown 'fit' scales into, WxH
+    'scaler': 'bicubic',  # see SCALERS
+    'segmented': False,
+    'segment_workers': 4,
+    'force_encode': False,
+    # image sequences
+    'compression_level': 3,  # png: zlib level 0-9, webp: effort 0-6
+    'jpeg_quality': 90,  # 1-100
+    'frame_start': 0,
+    'frame_end': 0,  # exclusive, 0 is the last frame
+    'frame_step': 1,  # every Nth frame
+    'shard_size': 1000,  # frames per subdirectory, 0 writes them all into one
+    'image_workers': 4,
+    # checking the output once it's written, see verify.py
+    'verify': True,
+    'verify_metrics': '',  # comma separated, any of ssim, psnr, vmaf
+    'verify_samples': 8,  # windows the metrics are measured on
+    # how ffmpeg shares the machine, see governor.py
+    'nice': 0,  # 0-19
+    'ionice': '',  # '', 'low' or 'idle'
+    'pin_cpus': False,  # each job gets CPUs of its own
+    'max_load': 0.0,  # no new jobs while the load per CPU is over this, 0 is off
+    'min_free_memory': 0,  # MiB, the newest encode is paused below it, 0 is off
+    'max_memory_pressure': 0.0,  # % stalled on memory (PSI), pauses like min_free_memory
+    # reusing earlier outputs of the same input and settings, see output_cache.py
+    'output_cache': True,
+    'output_cache_hardlink': False,  # ffmpeg -y overwrites through a hardlink, so both copies would change
+    'cluster_workers': '',  # host:port,... to encode segments on, see cluster.py
+}
+
+
+def _ignore(*_): pass
+
+
+def set_data_dir(path: str | Path):
+    global DATA_DIR
+    DATA_DIR = Path(path)
+
+
+def data_path(name: str) -> Path:
+    return DATA_DIR / name
+
+
+def byte_format(size, suffix="B"):
+    '''modified version of: https://stackoverflow.com/a/1094933'''
+    size = "".join([val for val in size if val.isnumeric()])
+    if size != "":
+        size = int(size)
+        for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti']:
+            if abs(size) < 2**10:
+                return f"{size:3.1f}{unit}{suffix}"
+            size /= 2**10
+        return f"{size:3.1f}{unit}{suffix}"
+    else:
+        return f"N/A{suffix}"
+
+
+def stream_bitrate(stream: dict, fmt: dict) -> float | None:
+    '''the video bitrate in kbit/s, mkv only has it in the stream tags and some files only have the overall rate'''
+    for value in (stream.get('bit_rate'), stream.get('tags', {}).get('BPS'), fmt.get('bit_rate')):
+        try:
+            return int(value) / 1000
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def frame_rate(stream: dict, key: str = 'r_frame_rate') -> Fraction | None:
+    '''Parses one of ffprobe's rates, ie. "30000/1001". None for "0/0" and anything else that isn't a rate.
+
+    >>> frame_rate({'r_frame_rate': '30000/1001'}), frame_rate({'avg_frame_rate': '0/0'}, 'avg_frame_rate')
+    (Fraction(30000, 1001), None)
+    '''
+    try:
+        rate = Fraction(str(stream.get(key) or ''))
+    except (ValueError, ZeroDivisionError):
+        return None
+    return rate if rate > 0 else None
+
+
+def media_duration(metadata: dict) -> float | None:
+    '''the container's duration in seconds, or the video's if the container has none. None if neither is known'''
+    videos = [stream for stream in metadata['streams'] if stream['codec_type'] == 'video']
+    for value in (metadata['format'].get('duration'), videos[0].get('duration') if videos else None):
+        try:
+            duration = float(value)
+        except (TypeError, ValueError):
+            continue
+        if 0 < duration < float('inf'):
+            return duration
+    return None
+
+
+def estimate_frames(config: dict, metadata: dict) -> tuple[int, bool]:
+    '''The number of frames to encode, and whether that's good enough to show.
+
+    nb_frames is exact where the container stores it. Otherwise it's the
+    duration times the configured fps, or the average frame rate, which
+    unlike r_frame_rate is right for variable frame rate video too. When the
+    duration or the rate is unknown it's 0, and the second value is False for
+    those and variable frame rate inputs, which are worth counting.
+    '''
+    video = [stream for stream in metadata['streams'] if stream['codec_type'] == 'video'][0]
+    duration = media_duration(metadata)
+    if config['fps']:
+        return (int(duration * Fraction(config['fps'])), True) if duration else (0, False)
+    if str(video.get('nb_frames', '')).isdigit() and int(video['nb_frames']) > 0:
+        return int(video['nb_frames']), True
+    average, base = frame_rate(video, 'avg_frame_rate'), frame_rate(video)
+    rate = average or base
+    if not duration or rate is None:
+        return 0, False
+    return int(duration * rate), average == base
+
+
+def even(value: float) -> int:
+    '''the nearest even integer of at least 2, yuv420p can't have odd sides'''
+    return max(round(value / 2) * 2, 2)
+
+
+def sample_aspect_ratio(video: dict) -> Fraction:
+    '''the pixel aspect ratio of a probed video stream, 1 for square or unknown pixels'''
+    num, _, den = str(video.get('sample_aspect_ratio', '1:1')).partition(':')
+    try:
+        return Fraction(int(num), int(den)) if int(num) > 0 and int(den) > 0 else Fraction(1)
+    except ValueError:
+        return Fraction(1)
+
+
+def plan_resolution(width: int, height: int, config: dict, sar: Fraction = Fraction(1)) -> tuple[int, int] | None:
+    '''Works out the output size for the res_dropdown/resolution settings.
+
+    'max' and 'min' scale the longer or shorter side to `resolution`, 'fit'
+    scales down into the `fit_size` box and never up. Both sides are rounded to
+    even numbers, keeping the aspect ratio as close as that allows. None means
+    the video keeps its size, so no scale filter is needed.
+
+    Non square pixels (`sar`) are planned on the displayed size, and the
+    output has square ones.
+
+    >>> plan_resolution(1920, 1080, {'res_dropdown': 'max', 'resolution': 1000})
+    (1000, 562)
+    >>> plan_resolution(1920, 1080, {'res_dropdown': 'fit', 'fit_size': '1280x1280'})
+    (1280, 720)
+    '''
+    mode = config['res_dropdown']
+    width = width * sar  # the displayed width
+    if mode == 'fit':
+        box_width, _, box_height = str(config.get('fit_size', '')).lower().partition('x')
+        if not (box_width.strip().isdigit() and box_height.strip().isdigit()):
+            raise ValueError(f"fit_size should look like 1920x1080, not {config.get('fit_size')!r}")
+        scale = min(int(box_width) / width, int(box_height) / height, 1.0)
+    elif mode in ('max', 'min') and config['resolution'] > 0:
+        scale = config['resolution'] / {'max': max, 'min': min}[mode](width, height)
+    else:
+        return None
+    dims = even(width * scale), even(height * scale)
+    if mode == 'fit':  # rounding up mustn't poke out of the box
+        dims = min(dims[0], max(int(box_width) // 2 * 2, 2)), min(dims[1], max(int(box_height) // 2 * 2, 2))
+    if dims == (width, height):
+        return None
+    return dims
+
+
+def remux_blockers(config: dict, metadata: dict) -> list[str]:
+    '''Lists the reasons the input has to be re-encoded.
+
+    An empty list means the video is already H.264 and the requested settings
+    wouldn't change it, so it can be stream copied into the new container.
+    '''
+    video = [stream for stream in metadata['streams'] if stream['codec_type'] == 'video'][0]
+    blockers = []
+    if video.get('codec_name') != 'h264':
+        blockers.append(f"video is {video.get('codec_name')}, not h264")
+    if Path(config['output']).suffix.lower() not in REMUX_CONTAINERS:
+        blockers.append(f"{Path(config['output']).suffix} output")
+
+    if config['video_dropdown'] != 'crf':
+        target = config['video_bitrate'] * {'KB/s': 1, 'MB/s': 1000}[config['video_dropdown']]
+        bitrate = stream_bitrate(video, metadata['format'])
+        if bitrate is None:
+            blockers.append("unknown input bitrate")
+        elif bitrate > target * 1.05:  # a bit of slack, the rate limit is never exact anyway
+            blockers.append(f"input bitrate {bitrate:.0f}kbits/s is above {target}kbits/s")
+
+    if plan_resolution(video['width'], video['height'], config, sample_aspect_ratio(video)) is not None:
+        blockers.append("resolution changes")
+
+    if config['fps']:
+        framerate = frame_rate(video) or Fraction(0)
+        if abs(float(framerate) - float(config['fps'])) > 0.01:
+            blockers.append("frame rate changes")
+    return blockers
+
+
+def resolve_threads(value) -> int:
+    '''0 threads means auto: the tuned count, or 3/4 of the cores before any tuning'''
+    if int(value or 0) > 0:
+        return int(value)
+    from autotune import load_tuning
+    return int((load_tuning() or {}).get('threads', DEFAULTS['threads']))
+
+
+def resolve_auto(config: dict) -> dict:
+    '''a copy of `config` with "auto" speed and 0 threads replaced by this machine's tuning'''
+    if config.get('speed') != AUTO and int(config.get('threads') or 0) > 0:
+        return config
+    from autotune import load_tuning
+    tuning = load_tuning() or {}
+    config = dict(config)
+    if config.get('speed') == AUTO:
+        config['speed'] = tuning.get('speed', DEFAULTS['speed'])
+    config['threads'] = resolve_threads(config.get('threads'))
+    return config
+
+
+def get_encoder(config: dict, path: str | None = None) -> Encoder:
+    '''picks the encoder for a job's settings'''
+    if Path(config['output']).suffix.lstrip('.').lower() in IMAGE_FORMATS:
+        from images import ImageSequenceEncoder
+        return ImageSequenceEncoder(config, path)
+    if config.get('cluster_workers'):
+        from cluster import DistributedEncoder
+        return DistributedEncoder(config, path)
+    if config.get('segmented'):
+        from segments import SegmentedEncoder
+        return SegmentedEncoder(config, path)
+    return Encoder(config, path)
+
+
+def find_ffmpeg() -> tuple[str | None, str | None]:
+    '''looks for ffmpeg and ffprobe in ./bin first, then in PATH'''
+    return (
+        shutil.which('ffmpeg', path=PROGRAM_ORIGIN / 'bin') or shutil.which('ffmpeg'),
+        shutil.which('ffprobe', path=PROGRAM_ORIGIN / 'bin') or shutil.which('ffprobe'),
+    )
+
+
+class Encoder:
+    '''Converts a single input with the settings in `config`.
+
+    Progress is reported through the `progress`, `max_prog`, `change_title` and
+    `status` callables, which mirror the signals of the gui's FfmpegThread.
+    A running job can be paused and resumed, stopped early keeping what was
+    encoded so far (stop), or cancelled (kill), from any thread.
+    '''
+    metadata: dict
+    ffmpeg_path: str = 'ffmpeg'
+    ffprobe_path: str = 'ffprobe'
+    stream: subprocess.Popen = None
+
+    def __init__(self, config: dict, path: str | None = None):
+        # keys added since the config was saved get their defaults
+        self.config = resolve_auto({**DEFAULTS, **config})
+        self.path = path or config['input']
+        self.progress: Callable[[int], None] = _ignore
+        self.max_prog: Callable[[int], None] = _ignore
+        self.change_title: Callable[[str], None] = _ignore
+        self.status: Callable[[str], None] = _ignore
+        # called with what a resumed job could continue from, see journal.py
+        self.checkpoint: Callable[[dict], None] = _ignore
+        self.remux = False
+        self.cancelled = False
+        self.stopped = False  # stop() was called, the output so far is kept
+        self.paused = False
+        self.paused_seconds = 0.0  # time spent paused, not counted in speeds
+        self._paused_at = 0.0
+        self._unpaused = threading.Event()  # waited on before starting another process
+        self._unpaused.set()
+        self.recording = None  # history.Recording of the running encode
+        self.estimate = None  # history.Estimate, if there are similar past jobs
+        self.verification = None  # verify.Verification of the finished output
+        self.duration: float | None = None
+        self.frame_count = 0  # 0 while it's unknown
+        self.frames_exact = False  # the frame count was counted, not estimated
+        self._last_title = -1
+        self.reused = None  # the earlier output put in place instead of encoding, see output_cache.py
+
+    def should_remux(self) -> bool:
+        '''whether the video can be stream copied, needs self.metadata'''
+        if self.config.get('force_encode'):
+            return False
+        blockers = remux_blockers(self.config, self.metadata)
+        if blockers:
+            print(f"re-encoding: {', '.join(blockers)}")
+        return not blockers
+
+    def run(self):
+        self.check_for_ffmpeg()
+        self.metadata = self._get_metadata(self.ffprobe_path)
+        self.remux = self.should_remux()
+        video_stream = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'video'][0]
+
+        # progress goes by the output time against the duration, the frame count is only shown
+        self.duration = media_duration(self.metadata)
+        self.frame_count, reliable = estimate_frames(self.config, self.metadata)
+        self.max_prog(self.frame_count)
+
+        self.status("Gathered metadata.")
+        key = self.cache_key(video_stream)
+        if self.reuse_cached(key, self.frame_count):
+            return
+
+        with self.recorded(self.frame_count):
+            self.stream: subprocess.Popen = self.get_ffmpeg_stream(video_stream, copy_video=self.remux).run_async(
+                pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, cmd=self.ffmpeg_path)
+            self._started(self.stream)
+            if not reliable:
+                self.count_frames(video_stream)
+            self.status("configured ffmpeg." if not self.remux else
+                        "Remux only: the video is already h264 with these settings, copying it.")
+
+            watch = SUPERVISOR.watch(self.stream, self._report)
+            if not self.exited_ok(watch.wait()):
+                self.discard_output()
+                if self.cancelled:
+                    return
+                raise RuntimeError(f"ffmpeg exited with code {watch.returncode}: {watch.stderr}")
+            if self.stopped:
+                self.status(f"Stopped early, {self.config['output']} has what was encoded so far")
+                return
+            self.verify_output()
+        self.cache_output(key)
+        print(f"{self.config['output']} has been created")
+
+    @contextmanager
+    def recorded(self, frame_count: int) -> Iterator[None]:
+        '''records the encode in the job history, and looks up an eta from the jobs before it'''
+        from history import get_history, output_size
+        history = get_history()
+        self.recording = history.start(self.config, self.metadata, frame_count, self.remux)
+        if self.paused:
+            self.recording.pause()
+        self.estimate = history.estimate(self.recording)
+        if self.estimate is not None:
+            self.status(f"Expected to take {self.estimate.eta()}")
+        state = 'failed'
+        try:
+            yield
+            state = 'done'
+        finally:
+            if self.cancelled:
+                state = 'cancelled'
+            elif self.stopped and state == 'done':
+                state = 'stopped'
+            history.finish(self.recording, state,
+                           output_size(self.config['output']) if state in ('done', 'stopped') else None)
+
+    def count_frames(self, video_stream: dict):
+        '''Counts the input's video packets in a thread of its own, and updates max_prog once that's done.
+
+        It only reads the container, and the encode doesn't wait for it.
+        '''
+        def count():
+            from verify import count_packets
+            packets, _ = count_packets(self.path, self.ffprobe_path)
+            if packets <= 0 or self.cancelled:
+                return
+            rate = frame_rate(video_stream, 'avg_frame_rate') or frame_rate(video_stream)
+            if self.config['fps'] and rate:
+                packets = round(packets * Fraction(self.config['fps']) / rate)
+            self.frame_count, self.frames_exact = packets, True
+            if self.recording is not None:
+                self.recording.frame_count = packets
+            self.max_prog(packets)
+
+        threading.Thread(target=count, daemon=True).start()
+
+    def fraction(self, record: ProgressRecord) -> float | None:
+        '''How far along the encode is, 0-1, None when there's nothing to tell by.
+
+        The output time against the duration is right for variable frame
+        rates, and known from the first progress update on.
+        '''
+        if record.finished:
+            return 1.0
+        if self.duration:
+            return min(record.out_time_us / 1e6 / self.duration, 1.0)
+        if self.frame_count > 0:
+            return min(record.frame / self.frame_count, 1.0)
+        return None
+
+    def _report(self, record: ProgressRecord):
+        fraction = self.fraction(record)
+        if fraction is not None and int(20 * fraction) != self._last_title:
+            self._last_title = int(20 * fraction)
+            self.change_title(f"%{100 * fraction:.2f}")
+
+        self.progress(round(fraction * self.frame_count) if self.frame_count > 0 else record.frame)
+        fps, speed = record.fps, record.speed
+        if self.paused_seconds and self.recording is not None and self.recording.elapsed > 0:
+            # ffmpeg's averages count the time it was paused too
+            scale = (self.recording.elapsed + self.recording.paused) / self.recording.elapsed
+            fps = round(fps * scale, 1) if fps is not None else None
+            speed = round(speed * scale, 2) if speed is not None else None
+        speed = f"{speed}x" if speed is not None else "N/A"
+        bitrate = f"{record.bitrate}kbits/s" if record.bitrate is not None else "N/A"
+        frames = f"[{record.frame}" + (f" / {'' if self.frames_exact else '~'}{self.frame_count}]"
+                                       if self.frame_count > 0 else " frames]")
+        dlg = [
+            ("Remuxing (remux only)" if self.remux else "Converting") if not record.finished else "Finished",
+            (f"%{100 * fraction:.2f}   " if fraction is not None else "") + frames,
+            f"Total size: {byte_format(str(record.total_size or ''))}",
+            f"speed: {speed}, fps: {fps if fps is not None else 'N/A'}",
+            f"bitrate: {bitrate}",
+        ]
+        if record.drop_frames:
+            dlg.append(f"dropped frames: {record.drop_frames}")
+        if record.dup_frames:
+            dlg.append(f"duped framed: {record.dup_frames}")
+        if self.estimate is not None and fraction is not None and not record.finished:
+            dlg.append(f"eta: {self.estimate.eta(fraction)}")
+        if self.recording is not None:
+            self.recording.sample(record)
+        if readings := GOVERNOR.describe(self):
+            dlg.append(readings)
+
+        self.status("\n".join(dlg))
+
+    def verify_output(self):
+        '''Checks the finished output against the input, see verify.py.
+
+        Raises verify.VerificationError if it's broken. The output is kept so
+        it can be looked at.
+        '''
+        if not self.config.get('verify') or self.cancelled:
+            return
+        from verify import SAMPLE_COUNT, VerificationError, verify
+        metrics = [name.strip() for name in str(self.config.get('verify_metrics') or '').split(',') if name.strip()]
+        self.status("Verifying the output..." + (f" ({', '.join(metrics)})" if metrics else ""))
+        self.verification = verify(self.config, self.metadata, self.config['output'], self.ffmpeg_path,
+                                   self.ffprobe_path, metrics, int(self.config.get('verify_samples') or SAMPLE_COUNT),
+                                   threads=int(self.config['threads']))
+        self.status(str(self.verification))
+        if not self.verification.ok:
+            raise VerificationError(f"{self.config['output']}: {'; '.join(self.verification.problems)}")
+
+    def cache_key(self, video_data: dict, extra: list | None = None) -> str | None:
+        '''the job's output_cache key, None when the cache is off'''
+        if not self.config.get('output_cache'):
+            return None
+        from output_cache import cache_key
+        args = self.get_ffmpeg_stream(video_data, copy_video=self.remux, log=False).get_args()
+        return cache_key(self.config['input'], args, self.config['output'], self.ffmpeg_path, self.metadata, extra)
+
+    def reuse_cached(self, key: str | None, frame_count: int) -> bool:
+        '''puts an earlier output of the same input and settings in place, returns False if there's none'''
+        if key is None:
+            return False
+        from output_cache import get_output_cache, place
+        cache = get_output_cache()
+        found = cache.lookup(key)
+        if found is None:
+            return False
+        output = os.path.abspath(self.config['output'])
+        how = place(found, output, bool(self.config.get('output_cache_hardlink'))) if found != output else "in place"
+        cache.put(key, output)
+        self.reused = found
+        self.progress(frame_count)
+        self.status(f"Reused {found} ({how}), it was converted from the same input with the same settings")
+        print(f"{self.config['output']} reused from {found} ({how})")
+        return True
+
+    def cache_output(self, key: str | None):
+        '''adds the finished output to the output_cache'''
+        if key is None or self.stopped or self.cancelled:
+            return
+        from output_cache import get_output_cache
+        get_output_cache().put(key, self.config['output'])
+
+    def summary(self) -> str:
+        '''a line on how the finished job went, for the job list'''
+        if self.reused is not None:
+            return f"reused {self.reused}"
+        return str(self.verification or "")
+
+    def _started(self, process: subprocess.Popen, threads: int | None = None):
+        '''hands a new ffmpeg to the governor, and catches it up on a kill(), stop() or pause() that came first'''
+        GOVERNOR.manage(process, self.config, threads, owner=self)
+        if self.cancelled:
+            process.kill()
+        elif self.stopped:
+            self._quit(process)
+        elif self.paused:
+            self._signal(process, signal.SIGSTOP)
+
+    def processes(self) -> list[subprocess.Popen]:
+        '''the job's running ffmpeg processes'''
+        return [self.stream] if self.stream is not None and self.stream.poll() is None else []
+
+    def pause(self):
+        '''Stops the job's ffmpeg processes (SIGSTOP), freeing the CPU without losing any work.
+
+        The time until resume() doesn't count towards the job's speed, fps or
+        history. Not available on windows.
+        '''
+        if not hasattr(signal, 'SIGSTOP'):
+            raise NotImplementedError("pausing needs SIGSTOP, which windows doesn't have")
+        if self.paused or self.cancelled:
+            return
+        self.paused = True
+        self._paused_at = time.monotonic()
+        self._unpaused.clear()
+        for process in self.processes():
+            self._signal(process, signal.SIGSTOP)
+        if self.recording is not None:
+            self.recording.pause()
+        self.status("Paused")
+
+    def resume(self):
+        if not self.paused:
+            return
+        for process in self.processes():
+            self._signal(process, signal.SIGCONT)
+        self.paused_seconds += time.monotonic() - self._paused_at
+        self.paused = False
+        self._unpaused.set()
+        if self.recording is not None:
+            self.recording.resume()
+        self.status("Resumed")
+
+    @staticmethod
+    def _signal(process: subprocess.Popen, signum: int):
+        GOVERNOR.hold(process, signum == signal.SIGSTOP)
+        try:
+            os.kill(process.pid, signum)
+        except OSError:  # it exited meanwhile
+            pass
+
+    def stop(self):
+        '''Stops early, keeping the output.
+
+        ffmpeg is asked to quit with a `q` on its stdin, which makes it finish
+        the container properly, so the part encoded so far plays.
+        '''
+        if self.stopped or self.cancelled:
+            return
+        self.stopped = True
+        self.resume()  # a stopped process can't read its stdin
+        for process in self.processes():
+            self._quit(process)
+
+    def exited_ok(self, returncode: int) -> bool:
+        '''ffmpeg stopped by a signal (ie. a ctrl+c in the terminal) still finishes the output, but exits with 255'''
+        return returncode == 0 or (self.stopped and returncode == 255)
+
+    @staticmethod
+    def _quit(process: subprocess.Popen):
+        try:
+            process.stdin.write(b"q")
+            process.stdin.close()
+        except (AttributeError, OSError, ValueError):  # no stdin pipe, or it's exiting already
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)  # which ffmpeg handles the same way
+
+    def kill(self):
+        self.cancelled = True
+        self._unpaused.set()
+        if self.stream is not None:
+            self.stream.kill()
+
+    def discard_output(self):
+        '''removes a half written output, ffmpeg was started with -y so it's ours either way'''
+        try:
+            Path(self.config['output']).unlink(missing_ok=True)
+        except OSError as e:
+            print(f"couldn't remove {self.config['output']}: {e}")
+
+    def get_ffmpeg_stream(self, video_data, output: str | None = None, input_kwargs: dict | None = None,
+                          audio: bool = True, threads: int | None = None, output_kwargs: dict | None = None,
+                          copy_video: bool = False, log: bool = True):
+        '''Builds the ffmpeg command for the configured settings.
+
+        Parameters
+        ----------
+        video_data : dict
+            the probed video stream
+        output : str, optional
+            overrides config['output'], by default None
+        input_kwargs : dict, optional
+            input options, ie. {'ss': 10, 'to': 20} to encode a part of the input, by default None
+        audio : bool, optional
+            if False the output has no audio, by default True
+        threads : int, optional
+            overrides config['threads'], by default None
+        output_kwargs : dict, optional
+            extra output options, by default None
+        copy_video : bool, optional
+            stream copy the video instead of encoding it, see remux_blockers(), by default False
+        log : bool, optional
+            print the command, by default True
+        '''
+        import ffmpeg  # only needed once a job starts
+
+        source = ffmpeg.input(self.config['input'], **(input_kwargs or {}))
+        kwargs = {}
+
+        # video
+        if copy_video:
+            kwargs['c:v'] = 'copy'
+        else:
+            kwargs.update({
+                "crf":  {'crf': self.config['video_bitrate']},
+                "KB/s": {'video_bitrate': f"{self.config['video_bitrate']}K"},
+                "MB/s": {'video_bitrate': f"{self.config['video_bitrate']}M"}
+            }.get(self.config['video_dropdown']))
+
+        # audio
+        if audio:
+            kwargs.update(self.audio_kwargs())
+        else:
+            kwargs['an'] = None
+        # threads, speed
+        kwargs['threads'] = threads or self.config['threads']
+        if not copy_video:
+            kwargs['preset'] = self.config['speed']
+
+        # resolution
+        streams = [source]
+        if not copy_video and self.scaled_size(video_data) is not None:
+            # a filtered video has to be mapped by hand, and the audio with it
+            streams = [self.scale(source.video, video_data)] + ([source['a?']] if audio else [])
+
+        # fps
+        if self.config['fps'] and not copy_video:
+            kwargs['r'] = self.config['fps']
+
+        kwargs.update(output_kwargs or {})
+
+        # misc args
+        kwargs.update({
+            'progress': '-',
+            'loglevel': 'error'
+        })
+        video = (
+            ffmpeg
+            .output(*streams, output or self.config['output'], **kwargs)
+            .overwrite_output()
+            .global_args('-nostats',
+                         '-hide_banner')
+        )
+        if log:
+            print(video.get_args())
+        return video
+
+    def scaled_size(self, video_data: dict) -> tuple[int, int] | None:
+        '''the output resolution, None when the video keeps its size'''
+        return plan_resolution(int(video_data['width']), int(video_data['height']), self.config,
+                               sample_aspect_ratio(video_data))
+
+    def scale(self, video, video_data: dict):
+        '''adds the scale filter to an ffmpeg-python stream, if the size changes at all'''
+        if (dims := self.scaled_size(video_data)) is None:
+            return video
+        video = video.filter('scale', dims[0], dims[1], flags=self.config.get('scaler') or 'bicubic')
+        if sample_aspect_ratio(video_data) != 1:
+            video = video.filter('setsar', 1)
+        return video
+
+    def audio_kwargs(self) -> dict:
+        if self.config['audio_dropdown'] != "copy":
+            return {'audio_bitrate': f"{self.config['audio_bitrate']}k"}
+        return {'c:a': "copy"}
+
+    def _get_metadata(self, cmd):
+        import ffmpeg
+        from probe_cache import get_cache
+        return get_cache().probe(self.path, lambda path: ffmpeg.probe(path, cmd=cmd))
+
+    def check_for_ffmpeg(self, attempts=0):
+        if attempts > 3:
+            raise FileNotFoundError("Ffmpeg failed to download")
+        self.ffmpeg_path, self.ffprobe_path = find_ffmpeg()
+        if not (
+            (
+                (self.ffmpeg_path and os.path.exists(self.ffmpeg_path))
+                or
+                (self.ffprobe_path and os.path.exists(self.ffprobe_path))
+            )
+            # and False  # uncomment to test downloader
+        ):
+            self.status("An ffmpeg binary is missing, attempting to download...")
+            from installer import download_ffmpeg  # requests & co. are only needed here
+            download_ffmpeg(self.status)
+            self.check_for_ffmpeg(attempts + 1)
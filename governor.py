@@ -0,0 +1,338 @@
+'''Keeps the ffmpeg children within the CPUs this process is really allowed to
+use, and out of the way of everything else on the machine.
+
+available_cpus() counts the affinity mask and the cgroup cpu quota instead of
+the host's cores, so a 4 CPU container on a 64 core host gets 4. The
+ResourceGovernor samples the CPU time and memory of every running ffmpeg from
+/proc once a second, applies nice, ionice and CPU pinning to their threads,
+holds back new jobs while the load is too high, and stops (SIGSTOP) the newest
+encode while memory runs low. Off Linux only nice is applied.
+'''
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import math
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+CGROUP_ROOT = Path('/sys/fs/cgroup')
+SAMPLE_INTERVAL = 1.0
+# a paused encode is only continued once memory is this much better than the limit
+RECOVERY = 0.8
+MIB = 1024 * 1024
+
+# ioprio_set(2) isn't wrapped by python or libc
+_IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+# the config's ionice values -> (class, level)
+IONICE = {'': None, 'low': (2, 7), 'idle': (3, 0)}
+
+
+def _ancestors(path: str) -> list[str]:
+    '''/a/b -> ['a/b', 'a', ''], a limit on any parent cgroup applies too'''
+    parts = [part for part in path.split('/') if part]
+    return ['/'.join(parts[:idx]) for idx in range(len(parts), -1, -1)]
+
+
+def _read(path: Path) -> str | None:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit(root: Path = CGROUP_ROOT, cgroup_file: str | Path = '/proc/self/cgroup') -> float | None:
+    '''The cpu quota of this process' cgroup and its parents, in CPUs. None if there's no quota.
+
+    Reads cpu.max on cgroup v2, cpu.cfs_quota_us and cpu.cfs_period_us on v1.
+    '''
+    text = _read(Path(cgroup_file))
+    if text is None:
+        return None
+    limits = []
+    for line in text.splitlines():
+        _, controllers, path = line.split(':', 2)
+        if not controllers:  # v2, every controller in one hierarchy
+            for cgroup in _ancestors(path):
+                quota, _, period = (_read(root / cgroup / 'cpu.max') or 'max').partition(' ')
+                if quota != 'max' and period:
+                    limits.append(int(quota) / int(period))
+        elif 'cpu' in controllers.split(','):
+            for directory in {root / controllers, root / 'cpu'}:
+                for cgroup in _ancestors(path):
+                    quota = _read(directory / cgroup / 'cpu.cfs_quota_us')
+                    period = _read(directory / cgroup / 'cpu.cfs_period_us')
+                    if quota and period and int(quota) > 0:
+                        limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+
+def available_cpus() -> int:
+    '''the CPUs in this process' affinity mask, capped by its cgroup's cpu quota'''
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on linux
+        count = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit:
+        # rounded up, like the jvm does: a 1.5 CPU quota still runs two threads at once
+        count = min(count, max(math.ceil(limit), 1))
+    return count
+
+
+@dataclass
+class ProcessReading:
+    pid: int
+    cpu: float = 0.0  # percent of one CPU, over the last sample
+    rss: int = 0  # bytes
+    threads: int = 0
+    paused: bool = False
+
+
+@dataclass
+class SystemReading:
+    load: float = 0.0  # 1 minute load average
+    available_memory: int | None = None  # bytes, MemAvailable
+    memory_pressure: float | None = None  # % of time stalled on memory over 10s, from PSI
+
+
+@dataclass
+class _Managed:
+    process: subprocess.Popen
+    owner: object
+    nice: int
+    ioprio: tuple[int, int] | None
+    cpus: set[int] | None  # pinned to these
+    held: bool = False  # paused by the user, the governor doesn't touch it
+    started: float = field(default_factory=time.monotonic)
+    ticks: int | None = None
+    sampled: float = 0.0
+    tids: set[int] = field(default_factory=set)  # threads that got the nice and pinning
+    reading: ProcessReading = None
+
+
+class ResourceGovernor:
+    '''Samples and restrains every ffmpeg child handed to manage().
+
+    The limits are the config keys max_load, min_free_memory and
+    max_memory_pressure, set through configure(). Niceness, ionice and
+    pinning are per job and come from the config passed to manage().
+    '''
+
+    def __init__(self):
+        self.cpus = available_cpus()
+        self.limits = {'max_load': 0.0, 'min_free_memory': 0, 'max_memory_pressure': 0.0}
+        self.system = SystemReading()
+        self.low_memory = False
+        self._managed: dict[int, _Managed] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._sampled = 0.0
+        self._linux = os.path.exists('/proc/self/stat')
+        self._tick = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self._libc = None
+
+    def configure(self, config: dict):
+        for key, default in self.limits.items():
+            self.limits[key] = type(default)(config.get(key) or 0)
+
+    def manage(self, process: subprocess.Popen, config: dict, threads: int | None = None, owner: object = None):
+        '''Applies the job's nice, ionice and pinning to `process` and samples it until it exits.
+
+        Parameters
+        ----------
+        process : subprocess.Popen
+            a running ffmpeg
+        config : dict
+            the job's settings, see nice, ionice and pin_cpus in engine.DEFAULTS
+        threads : int, optional
+            how many CPUs it's pinned to, by default config['threads']
+        owner : object, optional
+            what readings() and describe() group the processes by, usually the Encoder
+        '''
+        nice = min(max(int(config.get('nice') or 0), 0), 19)
+        if not self._linux:
+            if nice and hasattr(os, 'setpriority'):
+                try:
+                    os.setpriority(os.PRIO_PROCESS, process.pid, nice)
+                except OSError:
+                    pass
+            return
+        managed = _Managed(process, owner, nice, IONICE.get(config.get('ionice') or ''), None)
+        managed.reading = ProcessReading(process.pid)
+        with self._lock:
+            if config.get('pin_cpus'):
+                managed.cpus = self._pick_cpus(int(threads or config.get('threads') or 1))
+            self._managed[process.pid] = managed
+            self._apply(managed)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="ResourceGovernor", daemon=True)
+                self._thread.start()
+
+    def _pick_cpus(self, count: int) -> set[int]:
+        '''the `count` allowed CPUs the fewest other encodes are pinned to'''
+        allowed = sorted(os.sched_getaffinity(0))
+        usage = {cpu: 0 for cpu in allowed}
+        for managed in self._managed.values():
+            for cpu in managed.cpus or ():
+                if cpu in usage:
+                    usage[cpu] += 1
+        return set(sorted(allowed, key=lambda cpu: (usage[cpu], cpu))[:min(count, len(allowed))])
+
+    def _apply(self, managed: _Managed):
+        '''sets the nice, ionice and affinity of the process' threads that don't have them yet
+
+        They're all per thread on linux, and ffmpeg keeps starting threads after it's launched.
+        '''
+        if not (managed.nice or managed.ioprio or managed.cpus):
+            return
+        try:
+            tids = {int(tid) for tid in os.listdir(f"/proc/{managed.process.pid}/task")}
+        except OSError:
+            return
+        for tid in tids - managed.tids:
+            try:
+                if managed.nice:
+                    os.setpriority(os.PRIO_PROCESS, tid, managed.nice)
+                if managed.ioprio:
+                    self._ioprio_set(tid, *managed.ioprio)
+                if managed.cpus:
+                    os.sched_setaffinity(tid, managed.cpus)
+            except OSError:  # gone already
+                pass
+        managed.tids = tids
+
+    def _ioprio_set(self, tid: int, ioclass: int, level: int):
+        number = _IOPRIO_SYSCALLS.get(platform.machine())
+        if number is None:
+            return
+        if self._libc is None:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc.syscall(number, _IOPRIO_WHO_PROCESS, tid, (ioclass << _IOPRIO_CLASS_SHIFT) | level)
+
+    def _loop(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            with self._lock:
+                self._sample()
+                if not self._managed:
+                    self._thread = None
+                    return
+
+    def _sample(self):
+        now = time.monotonic()
+        for pid, managed in list(self._managed.items()):
+            if managed.process.poll() is not None:
+                del self._managed[pid]
+                continue
+            stat = _read(Path(f"/proc/{pid}/stat"))
+            if stat is None:
+                continue
+            # the name in parentheses may have spaces, the fields after it don't
+            fields = stat.rpartition(')')[2].split()
+            ticks = int(fields[11]) + int(fields[12])
+            if managed.ticks is not None and now > managed.sampled:
+                managed.reading.cpu = 100 * (ticks - managed.ticks) / self._tick / (now - managed.sampled)
+            managed.ticks, managed.sampled = ticks, now
+            managed.reading.threads = int(fields[17])
+            managed.reading.rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+            self._apply(managed)
+        self._sample_system()
+        self._throttle()
+
+    def _sample_system(self):
+        self._sampled = time.monotonic()
+        self.system.load = os.getloadavg()[0]
+        for line in (_read(Path('/proc/meminfo')) or '').splitlines():
+            if line.startswith('MemAvailable:'):
+                self.system.available_memory = int(line.split()[1]) * 1024
+        for line in (_read(Path('/proc/pressure/memory')) or '').splitlines():
+            if line.startswith('some '):
+                self.system.memory_pressure = float(line.split()[1].partition('=')[2])
+
+    def _memory_state(self, margin: float = 1.0) -> bool:
+        '''whether memory is below the limits, with the limits moved by `margin`'''
+        min_free, max_pressure = self.limits['min_free_memory'], self.limits['max_memory_pressure']
+        if min_free and self.system.available_memory is not None \
+                and self.system.available_memory < min_free * MIB / margin:
+            return True
+        return bool(max_pressure and self.system.memory_pressure is not None
+                    and self.system.memory_pressure > max_pressure * margin)
+
+    def _throttle(self):
+        '''stops the newest encode while memory is low, and continues one once it has recovered'''
+        self.low_memory = self._memory_state()
+        governed = sorted((managed for managed in self._managed.values() if not managed.held),
+                          key=lambda managed: managed.started)
+        running = [managed for managed in governed if not managed.reading.paused]
+        paused = [managed for managed in governed if managed.reading.paused]
+        # one step per sample, and the oldest encode always keeps going
+        if self.low_memory and len(running) > 1:
+            self._signal(running[-1], signal.SIGSTOP)
+        elif paused and not self._memory_state(RECOVERY):
+            self._signal(paused[0], signal.SIGCONT)
+
+    @staticmethod
+    def _signal(managed: _Managed, signum: int):
+        try:
+            os.kill(managed.process.pid, signum)
+        except OSError:
+            return
+        managed.reading.paused = signum == signal.SIGSTOP
+        print(f"{'paused' if managed.reading.paused else 'continued'} ffmpeg {managed.process.pid}, "
+              f"memory is {'low' if managed.reading.paused else 'back'}")
+
+    def hold(self, process: subprocess.Popen, held: bool):
+        '''marks a process the user paused (or continued), the governor leaves held ones alone'''
+        with self._lock:
+            if (managed := self._managed.get(process.pid)) is not None:
+                managed.held = held
+                managed.reading.paused = False
+
+    def admit(self) -> bool:
+        '''whether another job may start, there's always room for the first one'''
+        with self._lock:
+            if not self._linux:
+                return True
+            if time.monotonic() - self._sampled > SAMPLE_INTERVAL:
+                self._sample_system()
+            max_load = self.limits['max_load']
+            if max_load and self.system.load / self.cpus > max_load:
+                return False
+            return not self._memory_state()
+
+    def readings(self, owner: object = None) -> list[ProcessReading]:
+        with self._lock:
+            return [managed.reading for managed in self._managed.values()
+                    if owner is None or managed.owner is owner]
+
+    def describe(self, owner: object = None) -> str:
+        '''one line of readings for the status panel, empty off linux'''
+        if not self._linux:
+            return ""
+        from engine import byte_format
+        readings = self.readings(owner)
+        text = ""
+        if readings:
+            text = f"cpu: {sum(reading.cpu for reading in readings):.0f}%, " \
+                   f"memory: {byte_format(str(sum(reading.rss for reading in readings)))}"
+            if len(readings) > 1:
+                text += f" ({len(readings)} processes)"
+            if paused := sum(reading.paused for reading in readings):
+                text += f", {paused} paused for memory"
+            text += " | "
+        text += f"load: {self.system.load:.1f}/{self.cpus}"
+        if self.system.available_memory is not None:
+            text += f", {byte_format(str(self.system.available_memory))} free"
+        return text
+
+
+GOVERNOR = ResourceGovernor()
@@ -0,0 +1,199 @@
+'''A local record of every encode: a coarse progress time series and a summary
+per job. The summaries give new jobs an ETA before they start, and show which
+preset and thread counts are actually fastest on this machine.'''
+from __future__ import annotations
+
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import engine
+from progress import ProgressRecord
+
+DEFAULT_NAME = "history.sqlite"
+# seconds between stored progress samples
+SAMPLE_INTERVAL = 1.0
+# how many recent jobs an estimate is based on
+ESTIMATE_JOBS = 20
+
+
+@dataclass
+class Recording:
+    '''An encode in progress. Samples are kept in memory and stored with the summary.'''
+    config: dict
+    width: int
+    height: int
+    codec: str
+    duration: float
+    frame_count: int
+    remux: bool
+    started: float = field(default_factory=time.time)
+    samples: list[tuple] = field(default_factory=list)
+    frame: int = 0
+    paused: float = 0.0  # seconds spent paused, they don't count as encoding time
+    _paused_at: float | None = None
+    _last: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        '''seconds spent encoding so far'''
+        return (self._paused_at or time.time()) - self.started - self.paused
+
+    def pause(self):
+        if self._paused_at is None:
+            self._paused_at = time.time()
+
+    def resume(self):
+        if self._paused_at is not None:
+            self.paused += time.time() - self._paused_at
+            self._paused_at = None
+
+    def sample(self, record: ProgressRecord, frame: int | None = None):
+        '''keeps at most one record per SAMPLE_INTERVAL, `frame` overrides record.frame for segmented jobs'''
+        self.frame = record.frame if frame is None else frame
+        now = time.time()
+        if now - self._last < SAMPLE_INTERVAL and not record.finished:
+            return
+        self._last = now
+        self.samples.append((round(self.elapsed, 3), self.frame, record.fps, record.speed,
+                             record.bitrate, record.total_size, record.out_time_us))
+
+
+@dataclass
+class Estimate:
+    seconds: float
+    jobs: int  # how many past jobs it's based on
+
+    def remaining(self, fraction: float) -> float:
+        return max(self.seconds * (1 - min(max(fraction, 0.0), 1.0)), 0.0)
+
+    def eta(self, fraction: float = 0.0) -> str:
+        return f"{format_eta(self.remaining(fraction))} (from {self.jobs} past jobs)"
+
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+
+class History:
+    '''Job summaries and their progress samples in an sqlite file.
+
+    Throughput is stored in pixels per second, so a 4k job can be estimated from
+    the history of 1080p ones with the same preset.
+    '''
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY, started REAL, input TEXT, width INTEGER, height INTEGER, codec TEXT,"
+            " duration REAL, preset TEXT, threads INTEGER, rate_mode TEXT, rate REAL, segmented INTEGER,"
+            " remux INTEGER, frames INTEGER, wall REAL, fps REAL, pixel_rate REAL, size INTEGER, state TEXT);"
+            "CREATE INDEX IF NOT EXISTS jobs_preset ON jobs (preset, threads);"
+            "CREATE TABLE IF NOT EXISTS samples ("
+            " job_id INTEGER, t REAL, frame INTEGER, fps REAL, speed REAL, bitrate REAL, total_size INTEGER,"
+            " out_time_us INTEGER);"
+            "CREATE INDEX IF NOT EXISTS samples_job ON samples (job_id);"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def start(config: dict, metadata: dict, frame_count: int, remux: bool = False) -> Recording:
+        video = [stream for stream in metadata['streams'] if stream['codec_type'] == 'video'][0]
+        return Recording(dict(config), int(video.get('width', 0)), int(video.get('height', 0)),
+                         video.get('codec_name', ''), float(metadata['format'].get('duration', 0)),
+                         frame_count, remux)
+
+    def finish(self, recording: Recording, state: str, size: int | None = None) -> int:
+        '''stores a finished (or failed, or cancelled) job, returns its id'''
+        config = recording.config
+        wall = recording.elapsed
+        fps = recording.frame / wall if wall > 0 else 0.0
+        with self._lock:
+            job_id = self.db.execute(
+                "INSERT INTO jobs (started, input, width, height, codec, duration, preset, threads, rate_mode, rate,"
+                " segmented, remux, frames, wall, fps, pixel_rate, size, state)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (recording.started, config.get('input'), recording.width, recording.height, recording.codec,
+                 recording.duration, config.get('speed'), int(config.get('threads', 0)),
+                 config.get('video_dropdown'), config.get('video_bitrate'), int(bool(config.get('segmented'))),
+                 int(recording.remux), recording.frame, wall, fps, fps * recording.width * recording.height,
+                 size, state)
+            ).lastrowid
+            self.db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(job_id, *sample) for sample in recording.samples])
+            self.db.commit()
+        return job_id
+
+    def estimate(self, recording: Recording) -> Estimate | None:
+        '''Predicts the wall time of a job from past ones with the same preset.
+
+        Jobs with the same thread count are preferred. Otherwise the throughput
+        of the closest thread count is scaled linearly, which overestimates a
+        little since x264 doesn't scale perfectly.
+        '''
+        config = recording.config
+        if recording.remux or recording.frame_count <= 0 or not recording.width:
+            return None
+        threads = int(config.get('threads', 1))
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT threads, pixel_rate FROM jobs WHERE state = 'done' AND remux = 0 AND pixel_rate > 0"
+                " AND preset = ? AND rate_mode = ? AND segmented = ? ORDER BY started DESC LIMIT ?",
+                (config.get('speed'), config.get('video_dropdown'), int(bool(config.get('segmented'))),
+                 ESTIMATE_JOBS * 4)
+            ).fetchall()
+        if not rows:
+            return None
+        nearest = min(abs(row_threads - threads) for row_threads, _ in rows)
+        rates = [rate * threads / max(row_threads, 1) for row_threads, rate in rows
+                 if abs(row_threads - threads) == nearest][:ESTIMATE_JOBS]
+        pixel_rate = statistics.median(rates)
+        return Estimate(recording.frame_count * recording.width * recording.height / pixel_rate, len(rates))
+
+    def report(self) -> list[dict]:
+        '''throughput per preset and thread count, fastest first'''
+        with self._lock:
+            cursor = self.db.execute(
+                "SELECT preset, threads, segmented, COUNT(*), AVG(fps), AVG(pixel_rate) / 1e6, SUM(wall)"
+                " FROM jobs WHERE state = 'done' AND remux = 0 AND wall > 0"
+                " GROUP BY preset, threads, segmented ORDER BY AVG(pixel_rate) DESC"
+            )
+            keys = ('preset', 'threads', 'segmented', 'jobs', 'fps', 'mpixels_per_second', 'wall')
+            return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    def samples(self, job_id: int) -> list[tuple]:
+        with self._lock:
+            return self.db.execute(
+                "SELECT t, frame, fps, speed, bitrate, total_size, out_time_us FROM samples"
+                " WHERE job_id = ? ORDER BY t", (job_id,)
+            ).fetchall()
+
+
+_histories: dict[Path, History] = {}
+_histories_lock = threading.Lock()
+
+
+def get_history() -> History:
+    '''the shared history next to the current config.json'''
+    path = engine.data_path(DEFAULT_NAME)
+    with _histories_lock:
+        if path not in _histories:
+            _histories[path] = History(path)
+        return _histories[path]
+
+
+def output_size(path: str) -> int | None:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
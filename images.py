@@ -0,0 +1,185 @@
+'''Image sequence export: the selected frames are split into shards that are
+written by several ffmpeg processes at once, one subdirectory per shard.'''
+from __future__ import annotations
+
+import math
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from pathlib import Path
+
+from engine import Encoder, frame_rate, media_duration
+from governor import GOVERNOR
+from jobs import partition_threads, wait_all
+from progress import SUPERVISOR, ProgressRecord
+
+
+def codec_kwargs(config: dict, extension: str) -> dict:
+    '''ffmpeg output options for each image format'''
+    extension = extension.lower()
+    if extension == 'png':
+        return {'c:v': 'png', 'compression_level': min(max(int(config['compression_level']), 0), 9)}
+    if extension == 'webp':
+        return {'c:v': 'libwebp', 'lossless': 1, 'compression_level': min(max(int(config['compression_level']), 0), 6)}
+    if extension == 'jpg':
+        # 1-100 onto ffmpeg's 31 (worst) to 2 (best)
+        quality = min(max(int(config['jpeg_quality']), 1), 100)
+        return {'c:v': 'mjpeg', 'q:v': round(31 - (quality - 1) * 29 / 99), 'pix_fmt': 'yuvj420p'}
+    return {'c:v': 'bmp'}
+
+
+def plan_shards(total: int | None, shard_size: int, workers: int) -> list[tuple[int, int | None]]:
+    '''Splits `total` selected frames into (first, count) pairs. An unknown total
+    gets one open ended shard. Without sharding the frames are still split so
+    every worker gets a couple of chunks.
+
+    >>> plan_shards(2500, 1000, 4)
+    [(0, 1000), (1000, 1000), (2000, 500)]
+    '''
+    if not total:
+        return [(0, None)]
+    size = shard_size if shard_size > 0 else max(math.ceil(total / (workers * 2)), 1)
+    return [(first, min(size, total - first)) for first in range(0, total, size)]
+
+
+class ImageSequenceEncoder(Encoder):
+    '''Writes the frames from `frame_start` to `frame_end`, every `frame_step`th
+    one, as images. The output is a pattern like `clip-converted/%06d.png`;
+    with a `shard_size` the files go into numbered subdirectories of it, ie.
+    `clip-converted/000001/001000.png`. Files are numbered by their position
+    in the selection.'''
+
+    def __init__(self, config: dict, path: str | None = None):
+        super().__init__(config, path)
+        self.streams: list[subprocess.Popen] = []
+        self._lock = threading.Lock()
+        self.failed = False  # a shard failed, the others are given up
+
+    def run(self):
+        self.check_for_ffmpeg()
+        self.metadata = self._get_metadata(self.ffprobe_path)
+        video_stream = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'video'][0]
+        rate = Fraction(self.config['fps']) if self.config['fps'] else frame_rate(video_stream)
+        duration = media_duration(self.metadata)
+
+        start = max(int(self.config['frame_start']), 0)
+        end = int(self.config['frame_end']) or (int(duration * rate) if duration and rate else 0)
+        step = max(int(self.config['frame_step']), 1)
+        total = math.ceil((end - start) / step) if end > start else None
+        if total is None and self.config['frame_end']:
+            raise ValueError(f"frame_end ({end}) has to be after frame_start ({start})")
+
+        workers = max(int(self.config['image_workers']), 1)
+        shard_size = max(int(self.config['shard_size']), 0)
+        shards = plan_shards(total, shard_size, workers)
+        workers = min(workers, len(shards))
+        threads = partition_threads(int(self.config['threads']), workers)[-1]
+
+        output = Path(self.config['output'])
+        self.frame_count = total or 0
+        self.max_prog(self.frame_count)
+        self.frames = [0] * len(shards)
+        self.done = 0
+        self.started = time.perf_counter()
+        self.status(f"Exporting {total or 'all'} frames as {output.suffix[1:]} in {len(shards)} shards"
+                    f" on {workers} workers")
+
+        half_frame = 1 / rate / 2 if rate else 0
+        # ffmpeg adds the container's start time to -ss, which can be before the video's (ie. audio priming)
+        offset = float(video_stream.get('start_time', 0)) - float(self.metadata['format'].get('start_time', 0))
+        with self.recorded(self.frame_count):
+            with ThreadPoolExecutor(workers) as pool:
+                futures = []
+                for idx, (first, count) in enumerate(shards):
+                    directory = output.parent / f"{first // shard_size:06d}" if shard_size else output.parent
+                    # seek to the shard's first source frame, half a frame early to land on it
+                    seek = offset + float((start + first * step) / rate - half_frame) if rate else 0.0
+                    futures.append(pool.submit(self._export_shard, idx, video_stream, max(seek, 0.0), first,
+                                               count, step, directory / output.name, threads))
+                wait_all(pool, futures, self._give_up)
+            if self.cancelled:
+                return
+            self.progress(sum(self.frames))
+            if self.stopped:
+                self.status(f"Stopped early, exported {sum(self.frames)} frames")
+                return
+            self.status(f"Exported {sum(self.frames)} frames at {self.throughput():.1f} frames/s")
+        print(f"{output.parent} has been created")
+
+    def _export_shard(self, idx: int, video_stream: dict, seek: float, first: int, count: int | None,
+                      step: int, pattern: Path, threads: int):
+        import ffmpeg
+
+        self._unpaused.wait()
+        if self.cancelled or self.stopped or self.failed:
+            return
+        pattern.parent.mkdir(parents=True, exist_ok=True)
+        video = ffmpeg.input(self.path, **({'ss': f"{seek:.6f}"} if seek > 0 else {})).video
+        video = self.scale(video, video_stream)
+        if self.config['fps']:
+            video = video.filter('fps', self.config['fps'])
+        if step > 1:
+            video = video.filter('framestep', step)
+        kwargs = codec_kwargs(self.config, pattern.suffix[1:])
+        if count is not None:
+            kwargs['frames:v'] = count
+        stream = (
+            # passthrough, or the image2 muxer would duplicate frames to fill the gaps framestep leaves
+            video.output(str(pattern), start_number=first, vsync='passthrough', threads=threads,
+                         progress='-', loglevel='error', **kwargs)
+            .overwrite_output()
+            .global_args('-nostats', '-hide_banner')
+            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, cmd=self.ffmpeg_path)
+        )
+        with self._lock:
+            self.streams.append(stream)
+            if self.failed:  # started while the others were being killed
+                stream.kill()
+        self._started(stream, threads)
+        watch = SUPERVISOR.watch(stream, lambda record: self._shard_progress(idx, record))
+        if not self.exited_ok(watch.wait()) and not self.cancelled:
+            raise RuntimeError(f"shard {idx} failed with exit code {watch.returncode}: {watch.stderr}")
+        with self._lock:
+            self.done += 1
+
+    def throughput(self) -> float:
+        elapsed = time.perf_counter() - self.started - self.paused_seconds
+        return sum(self.frames) / elapsed if elapsed > 0 else 0.0
+
+    def _shard_progress(self, idx: int, record: ProgressRecord):
+        self.frames[idx] = record.frame
+        progress = sum(self.frames)
+        self.progress(min(progress, self.frame_count) if self.frame_count > 0 else progress)
+        dlg = [
+            f"Exporting {len(self.frames)} shards ({self.done} done)",
+            f"%{100 * progress / self.frame_count:.2f}   [{progress} / {self.frame_count}]"
+            if self.frame_count > 0 else f"[{progress} frames]",
+            f"throughput: {self.throughput():.1f} frames/s",
+        ]
+        if self.estimate is not None and self.frame_count > 0:
+            dlg.append(f"eta: {self.estimate.eta(progress / self.frame_count)}")
+        if self.recording is not None:
+            self.recording.sample(record, frame=progress)
+        if readings := GOVERNOR.describe(self):
+            dlg.append(readings)
+        self.status("\n".join(dlg))
+
+    def processes(self) -> list[subprocess.Popen]:
+        with self._lock:
+            return [stream for stream in self.streams if stream.poll() is None]
+
+    def _give_up(self):
+        '''kills the running shards after another one failed'''
+        with self._lock:
+            self.failed = True
+            for stream in self.streams:
+                stream.kill()
+
+    def kill(self):
+        self.cancelled = True
+        self._unpaused.set()
+        with self._lock:
+            for stream in self.streams:
+                stream.kill()
@@ -0,0 +1,440 @@
+'''Downloads and extracts ffmpeg builds when none are installed.'''
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from collections.abc import Callable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
+
+import requests
+import urllib3
+
+from engine import byte_format
+
+PROGRAM_ORIGIN = Path(os.path.dirname(__file__))
+# BtbN's rolling release, override it to test against a local server
+RELEASE_URL = "https://github.com/BtbN/FFmpeg-Builds/releases/download/latest"
+CHECKSUMS = "checksums.sha256"
+EXECUTABLE = 0o755
+# reads start small and grow while the connection keeps up
+MIN_CHUNK = 64 * 2**10
+MAX_CHUNK = 4 * 2**20
+# buffer size for copying extracted members
+COPY_BUFFER = 2**20
+
+
+class File:
+    def __init__(self, txt):
+        self.path = txt
+        self.data = txt
+
+    def read(self, file) -> BinaryIO:
+        '''an open binary stream of a member'''
+        raise NotImplementedError
+
+    def size(self, file) -> int:
+        raise NotImplementedError
+
+    def raw_span(self, file) -> tuple[int, int] | None:
+        '''(offset, size) of a member stored uncompressed in the archive file, so it can be sendfile()d'''
+        return None
+
+    def members(self) -> list[str]:
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.data.close()
+        pass
+
+
+class TFile(File):
+    parallel = False  # compressed tars can only be read front to back
+
+    def __init__(self, txt):
+        self.path = txt
+        self.data = tarfile.open(txt)
+
+    def read(self, file) -> BinaryIO:
+        return self.data.extractfile(file)
+
+    def size(self, file) -> int:
+        return self.data.getmember(file).size
+
+    def raw_span(self, file) -> tuple[int, int] | None:
+        member = self.data.getmember(file)
+        # only a plain .tar keeps members as contiguous bytes of the file on disk
+        if not isinstance(self.data.fileobj, io.BufferedReader) or not member.isreg() or member.sparse:
+            return None
+        return member.offset_data, member.size
+
+    def members(self) -> list[str]:
+        return self.data.getnames()
+
+
+class ZFile(File):
+    parallel = True  # every member is compressed on its own
+
+    def __init__(self, txt):
+        self.path = txt
+        self.data = zipfile.ZipFile(txt)
+
+    def read(self, file) -> BinaryIO:
+        return self.data.open(file)
+
+    def size(self, file) -> int:
+        return self.data.getinfo(file).file_size
+
+    def members(self) -> list[str]:
+        return self.data.namelist()
+
+
+@dataclass
+class FileInfo:  # small dataclass used in download_ffmpeg
+    paths: dict
+    type: File
+    out: Path
+    src: str  # the archive's name in the release
+
+
+EXE_INFO = {
+    'linux': FileInfo(
+        {'bin/ffmpeg':  'ffmpeg-master-latest-linux64-gpl/bin/ffmpeg',
+         'bin/ffprobe': 'ffmpeg-master-latest-linux64-gpl/bin/ffprobe'},
+        type=TFile, out=PROGRAM_ORIGIN / 'ffmpeg.tar.xz',
+        src="ffmpeg-master-latest-linux64-gpl.tar.xz"
+    ),
+    'win32': FileInfo(
+        {'bin/ffmpeg.exe': 'ffmpeg-master-latest-win64-gpl/bin/ffmpeg.exe',
+         'bin/ffprobe.exe': 'ffmpeg-master-latest-win64-gpl/bin/ffprobe.exe'},
+        type=ZFile, out=PROGRAM_ORIGIN / 'ffmpeg.zip',
+        src="ffmpeg-master-latest-win64-gpl.zip"
+    ),
+}
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def _ignore_progress(size: int):
+    pass
+
+
+class _Progress:
+    '''turns byte counts into at most a couple of status updates per second'''
+
+    def __init__(self, status: Callable[[str], None], total: int | None, done: int = 0,
+                 label: str = "Downloading ffmpeg"):
+        self.status = status
+        self.total = total
+        self.done = done
+        self.label = label
+        self._last = 0.0
+        self._lock = threading.Lock()  # zip members are extracted from several threads
+
+    def __call__(self, size: int):
+        with self._lock:
+            self.done += size
+            now = time.monotonic()
+            if now - self._last < 0.5 and self.done != self.total:
+                return
+            self._last = now
+        if self.total:
+            self.status(f"{self.label}: {byte_format(str(self.done))} / {byte_format(str(self.total))}"
+                        f" (%{100 * self.done / self.total:.1f})")
+        else:
+            self.status(f"{self.label}: {byte_format(str(self.done))}")
+
+
+class _HashingReader:
+    '''A file-like view of a response that hashes and counts everything read through it'''
+
+    def __init__(self, response: requests.Response, progress: Callable[[int], None]):
+        self.raw = response.raw
+        self.sha256 = hashlib.sha256()
+        self.progress = progress
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(None if size is None or size < 0 else size, decode_content=True)
+        self.sha256.update(data)
+        self.progress(len(data))
+        return data
+
+
+def fetch_checksum(name: str, base_url: str = RELEASE_URL) -> str | None:
+    '''looks up the published sha256 of a release file, None if there are no published sums'''
+    try:
+        r = requests.get(f"{base_url}/{CHECKSUMS}", timeout=30)
+        r.raise_for_status()
+    except requests.RequestException:
+        return None
+    for line in r.text.splitlines():
+        digest, _, filename = line.strip().partition(" ")
+        if filename.strip().lstrip("*") == name:
+            return digest.lower()
+    return None
+
+
+def _copy_adaptive(r: requests.Response, file, sha256, progress: Callable[[int], None]):
+    '''copies a response into a file, doubling the read size while reads are quick and halving it when they stall'''
+    chunk = MIN_CHUNK
+    while True:
+        start = time.monotonic()
+        try:
+            data = r.raw.read(chunk, decode_content=True)
+        except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError) as e:
+            # raw reads skip requests' wrapping, and download only retries on its exceptions
+            raise requests.exceptions.ChunkedEncodingError(e) from e
+        if not data:
+            return
+        file.write(data)
+        sha256.update(data)
+        progress(len(data))
+        took = time.monotonic() - start
+        if took < 0.05 and chunk < MAX_CHUNK:
+            chunk *= 2
+        elif took > 0.5 and chunk > MIN_CHUNK:
+            chunk //= 2
+
+
+def download(url: str, dest: Path, sha256: str | None = None,
+             status: Callable[[str], None] = print, attempts: int = 3) -> Path:
+    '''Downloads `url` to `dest`, resuming from `dest.part` after an interruption.
+
+    The file is only renamed to `dest` once it is complete and, if `sha256` is
+    given, verified, so a killed download can never be mistaken for a finished one.
+    '''
+    dest = Path(dest)
+    part = dest.with_name(dest.name + ".part")
+    for attempt in range(attempts):
+        digest = hashlib.sha256()
+        done = part.stat().st_size if part.exists() else 0
+        if done:
+            with open(part, 'rb') as file:  # the hash has to cover what's already there
+                while data := file.read(MAX_CHUNK):
+                    digest.update(data)
+        headers = {'Range': f"bytes={done}-"} if done else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=30) as r:
+                if r.status_code == 416:  # nothing left to fetch
+                    pass
+                else:
+                    r.raise_for_status()
+                    if done and r.status_code != 206:  # the server ignored the range, start over
+                        done, digest = 0, hashlib.sha256()
+                    length = r.headers.get('Content-Length')
+                    total = done + int(length) if length else None
+                    if done:
+                        status(f"Resuming download at {byte_format(str(done))}")
+                    with open(part, 'ab' if done else 'wb') as file:
+                        _copy_adaptive(r, file, digest, _Progress(status, total, done))
+        except requests.RequestException as e:
+            status(f"Download interrupted ({e}), retrying...")
+            continue
+
+        if sha256 and digest.hexdigest() != sha256:
+            part.unlink()
+            if attempt + 1 < attempts:
+                status("Checksum mismatch, downloading again...")
+                continue
+            raise ChecksumError(f"{dest.name} does not match its published sha256")
+        os.replace(part, dest)
+        return dest
+    raise ConnectionError(f"could not download {url}")
+
+
+def stream_extract(url: str, paths: dict[str, str], sha256: str | None = None,
+                   status: Callable[[str], None] = print) -> None:
+    '''Extracts members of a .tar.xz while it downloads, so the archive never touches the disk.
+
+    `paths` maps output paths to member names. The members are written under
+    hidden names next to their outputs, and only renamed into place once the
+    whole archive matched `sha256` and had all of them, so a bad archive
+    never replaces, or leaves behind, a binary.
+    '''
+    wanted = {src: PROGRAM_ORIGIN / out for out, src in paths.items()}
+    staged: dict[Path, Path] = {}  # output -> where it's written until then
+    try:
+        with requests.get(url, stream=True, timeout=30) as r:
+            r.raise_for_status()
+            length = r.headers.get('Content-Length')
+            reader = _HashingReader(r, _Progress(status, int(length) if length else None))
+            with tarfile.open(fileobj=reader, mode='r|xz', bufsize=MIN_CHUNK) as tar:
+                for member in tar:
+                    if member.name not in wanted or wanted[member.name] in staged:
+                        continue
+                    out = wanted[member.name]
+                    out.parent.mkdir(parents=True, exist_ok=True)
+                    staged[out] = _temporary_path(out)
+                    with open(staged[out], 'wb') as file:
+                        _copy(tar.extractfile(member), file)
+                    if sys.platform != 'win32':
+                        os.chmod(staged[out], EXECUTABLE)
+            while reader.read(MAX_CHUNK):  # the rest of the archive still counts towards the checksum
+                pass
+            if sha256 and reader.sha256.hexdigest() != sha256:
+                raise ChecksumError(f"{url} does not match its published sha256")
+        missing = set(wanted.values()) - set(staged)
+        if missing:
+            raise FileNotFoundError(f"{', '.join(map(str, missing))} not found in the archive")
+        for out, tmp in staged.items():
+            os.replace(tmp, out)
+    finally:
+        for tmp in staged.values():
+            tmp.unlink(missing_ok=True)
+
+
+def download_ffmpeg(status: Callable[[str], None] = print, base_url: str = RELEASE_URL,
+                    streaming: bool = True):
+    '''Fetches ffmpeg and ffprobe into ./bin.
+
+    With `streaming`, a .tar.xz build is extracted while it downloads. Zip builds
+    (windows) can't be read front to back, so they are downloaded first,
+    resumably, and extracted afterwards.
+    '''
+    print("Downloading Ffmpeg")
+    exe_info = EXE_INFO[sys.platform]
+    url = f"{base_url}/{exe_info.src}"
+    sha256 = fetch_checksum(exe_info.src, base_url)
+    if sha256 is None:
+        status("Warning: no published checksum found, the download can't be verified")
+
+    if streaming and exe_info.type is TFile and not os.path.exists(exe_info.out):
+        stream_extract(url, exe_info.paths, sha256, status)
+        return
+
+    if not os.path.exists(exe_info.out):
+        download(url, exe_info.out, sha256, status)
+
+    status("File downloaded. Extracting...")
+
+    with exe_info.type(exe_info.out) as f:
+        extract_all(
+            f,
+            {str(PROGRAM_ORIGIN / out): src for out, src in exe_info.paths.items()
+             if not (PROGRAM_ORIGIN / out).exists()},
+            chmod=EXECUTABLE if sys.platform != 'win32' else None,
+            status=status
+        )
+
+
+def _temporary_path(outpath: Path) -> Path:
+    '''a hidden name next to `outpath` that no other thread or process writes to'''
+    return outpath.with_name(f".{outpath.name}.{os.getpid()}.{threading.get_ident()}.part")
+
+
+@contextmanager
+def _atomic_output(outpath: str | Path, chmod: int | None = None):
+    '''An output file that only appears under its real name once it is complete.
+
+    Everything is written to a hidden temporary name next to it and renamed
+    over `outpath` at the end, so check_for_ffmpeg can never find half a binary.
+    '''
+    outpath = Path(outpath)
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temporary_path(outpath)
+    try:
+        with open(tmp, 'wb') as out:
+            yield out
+        if chmod is not None:
+            os.chmod(tmp, chmod)
+        os.replace(tmp, outpath)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, progress: Callable[[int], None] = _ignore_progress) -> None:
+    '''copyfileobj with a large buffer and a byte count'''
+    while data := src.read(COPY_BUFFER):
+        dst.write(data)
+        progress(len(data))
+
+
+def _sendfile(archive: str | Path, span: tuple[int, int], dst: BinaryIO,
+              progress: Callable[[int], None] = _ignore_progress) -> None:
+    '''copies a stored member without passing it through python'''
+    offset, size = span
+    with open(archive, 'rb') as src:
+        while size > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, min(size, 2**30))
+            if sent == 0:
+                raise EOFError(f"{archive} is truncated")
+            offset += sent
+            size -= sent
+            progress(sent)
+
+
+def extract_and_save(
+        file: File,
+        pth: str,
+        outpath: str,
+        chmod=None,
+        overwrite=False,
+        progress: Callable[[int], None] = _ignore_progress
+) -> None:
+    '''Extracts a file from an archive and saves it.
+
+    Parameters
+    ----------
+    file : File
+        The archive to extract from
+    pth : str
+        The path in the object to extract
+    outpath : str
+        The path to save to
+    chmod : int, optional
+        The mode of the resulting file, by default None
+    overwrite : bool, optional
+        If exists, overwrite, by default False
+    progress : Callable[[int], None], optional
+        Called with the number of bytes written after every chunk
+
+    Raises
+    ------
+    FileExistsError
+        If the file exists and overwrite is not called.
+    '''
+    if os.path.exists(outpath) and not overwrite:
+        raise FileExistsError(outpath)
+
+    with _atomic_output(outpath, chmod) as out:
+        span = file.raw_span(pth) if hasattr(os, 'sendfile') else None
+        if span is not None:
+            _sendfile(file.path, span, out, progress)
+        elif isinstance(file, ZFile):
+            # each thread gets its own handle, so members decompress in parallel
+            with zipfile.ZipFile(file.path) as archive, archive.open(pth) as src:
+                _copy(src, out, progress)
+        else:
+            _copy(file.read(pth), out, progress)
+
+
+def extract_all(file: File, paths: dict[str, str], chmod=None, status: Callable[[str], None] = print,
+                overwrite=False) -> None:
+    '''Extracts several members, in parallel when the archive allows it.
+
+    `paths` maps output paths to member names.
+    '''
+    if not paths:
+        return
+    progress = _Progress(status, sum(file.size(src) for src in paths.values()), label="Extracting ffmpeg")
+    workers = min(len(paths), os.cpu_count() or 1) if file.parallel else 1
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(extract_and_save, file, src, out, chmod, overwrite, progress)
+                   for out, src in paths.items()]
+        for future in futures:
+            future.result()
@@ -0,0 +1,224 @@
+'''A small job queue shared by the gui and the worker pool.'''
+from __future__ import annotations
+
+import itertools
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import FIRST_EXCEPTION, Executor, Future, wait
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from engine import CPU_COUNT, IMAGE_FORMATS
+
+if TYPE_CHECKING:
+    from journal import Journal
+
+_job_ids = itertools.count(1)
+
+
+class JobState(Enum):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    CANCELLED = 4
+
+
+@dataclass
+class Job:
+    input: str
+    output: str
+    # a snapshot of the config at the time the job was added
+    config: dict
+    id: int = field(default_factory=lambda: next(_job_ids))
+    state: JobState = JobState.PENDING
+    # threads handed to ffmpeg, assigned when the job is started
+    threads: int = 0
+    progress: int = 0
+    max_prog: int = 0
+    message: str = ""
+    # the job's row in the journal, if the queue has one
+    journal_id: int | None = None
+    # verify.Verification.to_dict() of the output, empty if it wasn't checked
+    verification: dict = field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.input)
+
+    @property
+    def percent(self) -> float:
+        if self.max_prog <= 0:
+            return 0.0
+        return min(100 * self.progress / self.max_prog, 100.0)
+
+    def __str__(self):
+        text = f"[{self.state.name.lower()}] {self.name}"
+        if self.state == JobState.RUNNING:
+            text += f"  %{self.percent:.1f}  ({self.threads} threads)"
+        elif self.message:
+            text += f"  {self.message}"
+        return text
+
+
+def converted_path(path: str | Path, config: dict) -> Path:
+    '''Gets the default output path of an input, ie. `clip.mkv` -> `clip-converted-30fps.mp4`
+
+    Image sequences get a directory of their own, `clip.mkv` -> `clip-converted/%06d.png`
+    '''
+    path = Path(path)
+    path = path.with_stem(f"{path.stem}-converted")
+    if config['fps'] != 0:
+        if config['fps'] % 1 == 0:
+            path = path.with_stem(f"{path.stem}-{int(config['fps'])}fps")
+        else:
+            path = path.with_stem(f"{path.stem}-{config['fps']}fps")
+
+    if config['extension'] in IMAGE_FORMATS:
+        return path.with_suffix('') / f"%06d.{config['extension']}"
+    return path.with_suffix(f".{config['extension']}")
+
+
+def partition_threads(budget: int, slots: int) -> list[int]:
+    '''Splits a thread budget into `slots` near-equal shares, each at least 1.
+
+    >>> partition_threads(32, 3)
+    [11, 11, 10]
+    '''
+    budget, slots = max(int(budget), 1), max(int(slots), 1)
+    share, extra = divmod(budget, slots)
+    return [max(share + (i < extra), 1) for i in range(slots)]
+
+
+def wait_all(pool: Executor, futures: list[Future], abort: Callable[[], None]):
+    '''Waits for every one of `futures`, or only until the first of them fails.
+
+    On a failure the ones that haven't started are dropped and `abort` is
+    called to stop the running ones, then the failure is raised.'''
+    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+    failed = [future for future in futures if future in done and future.exception() is not None]
+    if failed:
+        pool.shutdown(wait=False, cancel_futures=True)
+        abort()
+        failed[0].result()
+
+
+class JobQueue:
+    '''An ordered list of jobs, drained by up to `workers` concurrent encodes.
+
+    The global `budget` of threads is split across the running jobs instead of
+    being handed whole to every ffmpeg process. With a `journal` every change
+    is written down, so interrupted jobs can be resumed after a crash.
+    '''
+
+    def __init__(self, workers: int = 1, budget: int = CPU_COUNT, journal: Journal | None = None):
+        self.workers = workers
+        self.budget = budget
+        self.journal = journal
+        # asked before a job starts next to running ones, see governor.ResourceGovernor.admit
+        self.admit: Callable[[], bool] = lambda: True
+        self.jobs: list[Job] = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(list(self.jobs))
+
+    def add(self, input: str, output: str, config: dict, journal_id: int | None = None) -> Job:
+        '''queues a job, `journal_id` takes over an interrupted job's journal entry'''
+        job = Job(str(input), str(output), dict(config, input=str(input), output=str(output)))
+        if self.journal is not None:
+            if journal_id is None:
+                self.journal.add(job)
+            else:
+                self.journal.reopen(job, journal_id)
+        with self._lock:
+            self.jobs.append(job)
+        return job
+
+    def get(self, job_id: int) -> Job | None:
+        return next((job for job in self.jobs if job.id == job_id), None)
+
+    def move(self, job_id: int, offset: int) -> None:
+        '''moves a job up (negative) or down (positive) the list'''
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                return
+            idx = self.jobs.index(job)
+            new_idx = min(max(idx + offset, 0), len(self.jobs) - 1)
+            self.jobs.insert(new_idx, self.jobs.pop(idx))
+
+    def cancel(self, job_id: int) -> Job | None:
+        '''cancels a job. Stopping the process of a running job is up to the caller.'''
+        with self._lock:
+            job = self.get(job_id)
+            if job is not None and job.state in (JobState.PENDING, JobState.RUNNING):
+                job.state = JobState.CANCELLED
+                self._journal(job)
+            return job
+
+    def clear_finished(self) -> None:
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job.state in (JobState.PENDING, JobState.RUNNING)]
+
+    @property
+    def pending(self) -> list[Job]:
+        return [job for job in self.jobs if job.state == JobState.PENDING]
+
+    @property
+    def running(self) -> list[Job]:
+        return [job for job in self.jobs if job.state == JobState.RUNNING]
+
+    def thread_share(self) -> int:
+        '''the thread count the next job would get.
+
+        The budget left over by running jobs is split evenly across the slots that
+        are about to be filled, so starting a full pool at once partitions the budget,
+        and a job started later takes whatever the finished one gave back.
+        '''
+        with self._lock:
+            running = self.running
+            free = self.budget - sum(job.threads for job in running)
+            slots = min(self.workers - len(running), len(self.pending))
+            return partition_threads(free, slots)[0] if slots > 0 else 0
+
+    def next_job(self) -> Job | None:
+        '''pops the next pending job if a worker slot is free, and marks it as running'''
+        with self._lock:
+            if len(self.running) >= self.workers or not self.pending:
+                return None
+            if self.running and not self.admit():
+                return None
+            job = self.pending[0]
+            job.threads = self.thread_share()
+            job.config['threads'] = job.threads
+            job.state = JobState.RUNNING
+            self._journal(job)
+            return job
+
+    def finish(self, job: Job, state: JobState = JobState.DONE, message: str = "") -> None:
+        with self._lock:
+            if job.state == JobState.RUNNING:
+                job.state = state
+            job.message = message
+            self._journal(job)
+
+    def progress(self, job: Job, value: int) -> None:
+        job.progress = value
+        if self.journal is not None:
+            self.journal.progress(job)
+
+    def checkpoint(self, job: Job, data: dict) -> None:
+        '''stores what the job's encoder could be resumed from'''
+        if self.journal is not None:
+            self.journal.checkpoint(job, data)
+
+    def _journal(self, job: Job):
+        if self.journal is not None:
+            self.journal.update(job)
@@ -0,0 +1,206 @@
+'''A crash-safe record of the job queue, so jobs interrupted by a crash (of the
+app or the whole machine) can be picked up again on the next start.
+
+Every job is written down when it's queued, and again whenever its state
+changes. Progress is written at most every PROGRESS_INTERVAL seconds. A job
+that is still pending or running in here, while the process that queued it is
+gone, was interrupted.
+'''
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import engine
+
+if TYPE_CHECKING:
+    from jobs import Job
+
+DEFAULT_NAME = "journal.sqlite"
+# seconds between progress writes of a job
+PROGRESS_INTERVAL = 2.0
+# finished jobs kept around, older ones are dropped
+KEEP_FINISHED = 500
+
+
+@dataclass
+class JournalEntry:
+    id: int
+    input: str
+    output: str
+    config: dict
+    state: str
+    progress: int = 0
+    max_prog: int = 0
+    message: str = ""
+    # what the encoder left to resume from, see Encoder.checkpoint
+    checkpoint: dict = field(default_factory=dict)
+    created: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.input)
+
+    @property
+    def resumable(self) -> bool:
+        '''whether finished work is kept, otherwise the job starts over'''
+        return bool(self.checkpoint.get('done'))
+
+    def __str__(self):
+        if self.resumable:
+            return f"{self.name}: {self.checkpoint['done']}/{self.checkpoint['segments']} segments done"
+        percent = f" at %{100 * self.progress / self.max_prog:.1f}" if self.max_prog > 0 else ""
+        return f"{self.name}: {self.state}{percent}, starts over"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Journal:
+    '''The job queue's states, settings and progress in an sqlite file.'''
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._written: dict[int, float] = {}  # journal id -> when its progress was last written
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # WAL keeps it consistent through power loss
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY, input TEXT, output TEXT, config TEXT, state TEXT, progress INTEGER,"
+            " max_prog INTEGER, message TEXT, checkpoint TEXT, pid INTEGER, created REAL, updated REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        # added after the first release, older journals get the column on open
+        if 'verification' not in {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN verification TEXT")
+        self.db.commit()
+
+    def add(self, job: Job) -> int:
+        with self._lock:
+            job.journal_id = self.db.execute(
+                "INSERT INTO jobs (input, output, config, state, progress, max_prog, message, checkpoint, pid,"
+                " created, updated) VALUES (?, ?, ?, ?, 0, 0, '', '{}', ?, ?, ?)",
+                (job.input, job.output, json.dumps(job.config), job.state.name.lower(), os.getpid(),
+                 time.time(), time.time())
+            ).lastrowid
+            self.db.commit()
+        return job.journal_id
+
+    def reopen(self, job: Job, journal_id: int):
+        '''takes over an interrupted entry for a job queued again'''
+        job.journal_id = journal_id
+        with self._lock:
+            self.db.execute("UPDATE jobs SET state = ?, pid = ?, updated = ? WHERE id = ?",
+                            (job.state.name.lower(), os.getpid(), time.time(), journal_id))
+            self.db.commit()
+
+    def update(self, job: Job):
+        '''writes the job's state, progress and message'''
+        if job.journal_id is None:
+            return
+        with self._lock:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, progress = ?, max_prog = ?, message = ?, config = ?, verification = ?,"
+                " updated = ? WHERE id = ?",
+                (job.state.name.lower(), job.progress, job.max_prog, job.message, json.dumps(job.config),
+                 json.dumps(job.verification), time.time(), job.journal_id)
+            )
+            self.db.commit()
+            self._written[job.journal_id] = time.monotonic()
+            if job.state.name.lower() in ('done', 'failed', 'cancelled'):
+                self._written.pop(job.journal_id, None)
+                self._prune()
+
+    def progress(self, job: Job):
+        '''like update(), but at most every PROGRESS_INTERVAL seconds per job'''
+        if job.journal_id is None or time.monotonic() - self._written.get(job.journal_id, 0) < PROGRESS_INTERVAL:
+            return
+        self.update(job)
+
+    def checkpoint(self, job: Job, data: dict):
+        if job.journal_id is None:
+            return
+        with self._lock:
+            self.db.execute("UPDATE jobs SET checkpoint = ?, updated = ? WHERE id = ?",
+                            (json.dumps(data), time.time(), job.journal_id))
+            self.db.commit()
+
+    def unfinished(self) -> list[JournalEntry]:
+        '''jobs left pending or running by processes that are gone, oldest first'''
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, input, output, config, state, progress, max_prog, message, checkpoint, created, pid"
+                " FROM jobs WHERE state IN ('pending', 'running') ORDER BY id"
+            ).fetchall()
+        return [JournalEntry(id, input, output, json.loads(config), state, progress, max_prog, message,
+                             json.loads(checkpoint or '{}'), created)
+                for id, input, output, config, state, progress, max_prog, message, checkpoint, created, pid
+                in rows if pid != os.getpid() and not _alive(pid)]
+
+    def restore(self, entry: JournalEntry, queue) -> Job:
+        '''Queues an interrupted job again.
+
+        A half written output is removed. Segmented jobs keep their finished
+        segments and only encode the rest, everything else starts over.
+        '''
+        if entry.state == 'running':
+            self._remove_partial(entry)
+        return queue.add(entry.input, entry.output, entry.config, journal_id=entry.id)
+
+    def discard(self, entry: JournalEntry):
+        '''gives up on an interrupted job, removing whatever it left behind'''
+        if entry.state == 'running':
+            self._remove_partial(entry)
+            if entry.checkpoint.get('workdir'):
+                shutil.rmtree(entry.checkpoint['workdir'], ignore_errors=True)
+        with self._lock:
+            self.db.execute("UPDATE jobs SET state = 'cancelled', message = 'discarded', updated = ? WHERE id = ?",
+                            (time.time(), entry.id))
+            self.db.commit()
+
+    @staticmethod
+    def _remove_partial(entry: JournalEntry):
+        output = Path(entry.output)
+        try:
+            # only if it was written after the job was queued, an older file isn't ours
+            if output.is_file() and output.stat().st_mtime >= entry.created:
+                output.unlink()
+        except OSError:
+            pass
+
+    def _prune(self):
+        self.db.execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed', 'cancelled') AND id NOT IN"
+            " (SELECT id FROM jobs WHERE state IN ('done', 'failed', 'cancelled') ORDER BY id DESC LIMIT ?)",
+            (KEEP_FINISHED,)
+        )
+        self.db.commit()
+
+
+_journals: dict[Path, Journal] = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal() -> Journal:
+    '''the shared journal next to the current config.json'''
+    path = engine.data_path(DEFAULT_NAME)
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
@@ -0,0 +1,226 @@
+'''An index of finished outputs by what they were made from, so converting a
+file again with the same settings reuses the earlier output instead.
+
+The key is a sampled content fingerprint of the input (its size and a few
+chunks read through mmap, never the whole file), the ffmpeg arguments with the
+paths and everything that doesn't change the output taken out, and the ffmpeg
+version. A copy of a file on another share gets the same key as the original.
+A hit is reflinked or copied into place, or hardlinked if the config
+allows it. Entries whose output was deleted or changed are dropped when
+they're looked up.
+'''
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+from functools import cache
+from pathlib import Path
+
+import engine
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+DEFAULT_NAME = "output_cache.sqlite"
+MAX_ENTRIES = 5000
+SAMPLE_CHUNKS = 16
+CHUNK_SIZE = 64 * 1024
+# ioctl(FICLONE), a copy-on-write clone on btrfs, xfs and the like
+_FICLONE = 0x40049409
+
+# arguments that don't change the output, the ones in _VALUED take a value
+_IGNORED = {'-y', '-nostats', '-hide_banner', '-nostdin'}
+_VALUED = {'-threads', '-progress', '-loglevel', '-stats_period'}
+
+
+def content_fingerprint(path: str | Path, chunks: int = SAMPLE_CHUNKS, chunk_size: int = CHUNK_SIZE) -> str:
+    '''A hash of the size and `chunks` evenly spaced pieces of the file.
+
+    About a MiB is read however big the file is. Files smaller than the
+    sample are hashed whole.
+    '''
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as file:
+        if size <= chunks * chunk_size:
+            digest.update(file.read())
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for idx in range(chunks):
+                    offset = (size - chunk_size) * idx // (chunks - 1)
+                    digest.update(view[offset:offset + chunk_size])
+    return digest.hexdigest()
+
+
+def canonical_args(args: list[str], input: str, output: str) -> list[str]:
+    '''ffmpeg's arguments without the paths, threads, logging and progress
+
+    >>> canonical_args(['-i', 'a.mkv', '-crf', '16', '-threads', '4', '-y', 'b.mp4'], 'a.mkv', 'b.mp4')
+    ['-i', '<input>', '-crf', '16', '<output>.mp4']
+    '''
+    canonical = []
+    args = iter(args)
+    for arg in args:
+        if arg in _IGNORED:
+            continue
+        if arg in _VALUED:
+            next(args, None)
+            continue
+        if arg == input:
+            arg = '<input>'
+        elif arg == output:
+            arg = f"<output>{Path(output).suffix}"
+        canonical.append(arg)
+    return canonical
+
+
+@cache
+def ffmpeg_version(ffmpeg_path: str = 'ffmpeg') -> str:
+    '''another build may encode differently'''
+    result = subprocess.run([ffmpeg_path, '-version'], capture_output=True, text=True)
+    return result.stdout.partition('\n')[0]
+
+
+def cache_key(input: str, args: list[str], output: str, ffmpeg_path: str = 'ffmpeg', metadata: dict | None = None,
+              extra: list | None = None) -> str:
+    '''Combines the input's fingerprint, the canonical arguments and the ffmpeg version.
+
+    The probed duration and streams are mixed in too, when given, which
+    catches files that only differ where the fingerprint didn't sample.
+    '''
+    probed = None
+    if metadata is not None:
+        probed = [metadata['format'].get('duration'), metadata['format'].get('bit_rate'),
+                  [(stream.get('codec_name'), stream.get('nb_frames')) for stream in metadata['streams']]]
+    return hashlib.sha256(json.dumps([
+        content_fingerprint(input), canonical_args(args, input, output), ffmpeg_version(ffmpeg_path), probed,
+        extra or [],
+    ]).encode()).hexdigest()
+
+
+def place(source: str | Path, destination: str | Path, hardlink: bool = False) -> str:
+    '''Puts a copy of `source` at `destination`, returns how: reflink, hardlink or copy.
+
+    A reflink shares the data until either file is written to, where the
+    filesystem supports it. A hardlink is only tried when asked for, since
+    overwriting either path later would change both. It's written under a
+    temporary name and renamed, so a half written copy is never at
+    `destination`.
+    '''
+    destination = Path(destination)
+    tmp = destination.with_name(f".{destination.name}.{os.getpid()}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        try:
+            if fcntl is None:
+                raise OSError("no reflinks without fcntl")
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            how = 'reflink'
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            how = 'copy'
+            if hardlink:
+                try:
+                    os.link(source, tmp)
+                    how = 'hardlink'
+                except OSError:  # another filesystem, or no links on this one
+                    pass
+            if how == 'copy':
+                shutil.copyfile(source, tmp)
+        os.replace(tmp, destination)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return how
+
+
+class OutputCache:
+    '''Cache keys -> the output files made with them.
+
+    The outputs aren't copied anywhere, the index only points at them. It's
+    trimmed least recently used first once there are more than `max_entries`.
+    '''
+
+    def __init__(self, path: str | Path, max_entries: int = MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            " key TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, last_used REAL, PRIMARY KEY (key, path))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+        self.db.commit()
+
+    def lookup(self, key: str) -> str | None:
+        '''an output made with `key` that's still there unchanged, None if there's none'''
+        with self._lock:
+            rows = self.db.execute("SELECT path, size, mtime_ns FROM outputs WHERE key = ?", (key,)).fetchall()
+            found = None
+            for path, size, mtime_ns in rows:
+                try:
+                    st = os.stat(path)
+                    valid = (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+                except OSError:
+                    valid = False
+                if not valid:  # deleted or overwritten since
+                    self.db.execute("DELETE FROM outputs WHERE key = ? AND path = ?", (key, path))
+                elif found is None:
+                    found = path
+                    self.db.execute("UPDATE outputs SET last_used = ? WHERE key = ? AND path = ?",
+                                    (time.time(), key, path))
+            self.db.commit()
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return found
+
+    def put(self, key: str, path: str | Path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            # whatever was made at this path before is gone now
+            self.db.execute("DELETE FROM outputs WHERE path = ?", (path,))
+            self.db.execute("INSERT INTO outputs VALUES (?, ?, ?, ?, ?)",
+                            (key, path, st.st_size, st.st_mtime_ns, time.time()))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        count = self.db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM outputs WHERE rowid IN (SELECT rowid FROM outputs ORDER BY last_used LIMIT ?)",
+                (count - int(self.max_entries * 0.9),)
+            )
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM outputs")
+            self.db.commit()
+
+
+_caches: dict[Path, OutputCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_output_cache() -> OutputCache:
+    '''the shared index next to the current config.json'''
+    path = engine.data_path(DEFAULT_NAME)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = OutputCache(path)
+        return _caches[path]
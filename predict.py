@@ -0,0 +1,159 @@
+'''Predicts the size and encode time of a job by encoding a few short samples
+spread through the input with the job's exact settings.'''
+from __future__ import annotations
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from engine import Encoder, byte_format, stream_bitrate
+from jobs import partition_threads
+from progress import SUPERVISOR
+
+SAMPLE_COUNT = 5
+# seconds
+SAMPLE_LENGTH = 4.0
+
+
+@dataclass
+class Prediction:
+    duration: float  # of the input, seconds
+    size: int  # projected output size, bytes
+    encode_time: float  # projected wall time, seconds
+    bitrate: float  # projected video bitrate, kbit/s
+    samples: int
+    remux: bool = False
+
+    @property
+    def speed(self) -> float:
+        return self.duration / self.encode_time if self.encode_time else 0.0
+
+    def __str__(self):
+        minutes, seconds = divmod(int(self.encode_time), 60)
+        return "\n".join([
+            f"Predicted from {self.samples} samples" if not self.remux else "Remux only",
+            f"size: ~{byte_format(str(self.size))}",
+            f"time: ~{minutes}m {seconds:02d}s ({self.speed:.2f}x)" if not self.remux else "time: i/o bound",
+            f"video bitrate: ~{self.bitrate:.0f}kbits/s",
+        ])
+
+
+def sample_starts(duration: float, count: int = SAMPLE_COUNT, length: float = SAMPLE_LENGTH) -> list[float]:
+    '''Evenly spread sample start times, fewer samples for short inputs.
+
+    >>> sample_starts(100, 4, 5)
+    [10.0, 35.0, 60.0, 85.0]
+    '''
+    count = max(min(count, int(duration // length)), 1)
+    if duration <= length:
+        return [0.0]
+    return [max(duration * (i + 0.5) / count - length / 2, 0.0) for i in range(count)]
+
+
+class Predictor(Encoder):
+    '''Encodes SAMPLE_COUNT samples of SAMPLE_LENGTH seconds at once, splitting the
+    job's thread budget between them, and projects the measurements onto the
+    whole input. run() returns a Prediction.'''
+
+    def __init__(self, config: dict, path: str | None = None,
+                 count: int = SAMPLE_COUNT, length: float = SAMPLE_LENGTH):
+        super().__init__(config, path)
+        self.count = count
+        self.length = length
+        self.streams: list[subprocess.Popen] = []
+        self._lock = threading.Lock()
+
+    def run(self) -> Prediction:
+        self.check_for_ffmpeg()
+        self.metadata = self._get_metadata(self.ffprobe_path)
+        if 'duration' not in self.metadata['format']:
+            raise ValueError("can't predict an input with an unknown duration")
+        duration = float(self.metadata['format']['duration'])
+        video_stream = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'video'][0]
+        audio_size = self.audio_bitrate() * 1000 / 8 * duration
+
+        if self.should_remux():
+            # a stream copy keeps the video as is and only costs i/o
+            bitrate = stream_bitrate(video_stream, {})
+            if bitrate is None:  # the overall rate minus the input's audio
+                bitrate = max((stream_bitrate({}, self.metadata['format']) or 0) - self.audio_bitrate(copy=True), 0)
+            return Prediction(duration, int((bitrate * 1000 / 8) * duration + audio_size), 0.0, bitrate, 0, remux=True)
+
+        starts = sample_starts(duration, self.count, self.length)
+        threads = partition_threads(int(self.config['threads']), len(starts))
+        self.max_prog(len(starts))
+        self.status(f"Encoding {len(starts)} samples of {self.length:g}s...")
+
+        suffix = Path(self.config['output']).suffix or '.mkv'
+        workdir = Path(tempfile.mkdtemp(prefix=".predict-", dir=Path(self.config['output']).parent))
+        self.done = 0
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(len(starts)) as pool:
+                futures = [pool.submit(self._sample, video_stream, at, workdir / f"sample_{idx}{suffix}", threads[idx])
+                           for idx, at in enumerate(starts)]
+                results = [future.result() for future in futures]
+            wall = time.perf_counter() - start
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if self.cancelled:
+            raise InterruptedError("prediction cancelled")
+
+        encoded = sum(length for length, _ in results)
+        size = sum(size for _, size in results)
+        if not encoded:
+            raise RuntimeError("the samples came out empty")
+        video_size = size / encoded * duration
+        prediction = Prediction(
+            duration=duration,
+            size=int(video_size + audio_size),
+            # every sample ran at once on its share of the threads,
+            # so the aggregate rate stands in for one encode using all of them
+            encode_time=wall * duration / encoded,
+            bitrate=video_size * 8 / 1000 / duration,
+            samples=len(results),
+        )
+        self.status(str(prediction))
+        return prediction
+
+    def _sample(self, video_stream: dict, start: float, path: Path, threads: int) -> tuple[float, int]:
+        '''encodes one sample, returns its length in seconds and its size in bytes'''
+        if self.cancelled:
+            return 0.0, 0
+        stream = self.get_ffmpeg_stream(video_stream, output=str(path), input_kwargs={'ss': f"{start:.3f}"},
+                                        audio=False, threads=threads, output_kwargs={'t': self.length}
+                                        ).run_async(pipe_stdout=True, pipe_stderr=True, cmd=self.ffmpeg_path)
+        with self._lock:
+            self.streams.append(stream)
+        watch = SUPERVISOR.watch(stream)
+        if watch.wait() != 0:
+            if self.cancelled:
+                return 0.0, 0
+            raise RuntimeError(f"sample at {start:.1f}s failed with exit code {watch.returncode}: {watch.stderr}")
+        with self._lock:
+            self.done += 1
+            self.progress(self.done)
+        length = watch.last.out_time_us / 1e6 if watch.last else 0.0
+        return length, os.path.getsize(path)
+
+    def audio_bitrate(self, copy: bool = False) -> float:
+        '''the audio bitrate of the output in kbit/s, or of the input with `copy`'''
+        audio = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'audio']
+        if not audio:
+            return 0.0
+        if self.config['audio_dropdown'] != "copy" and not copy:
+            return float(self.config['audio_bitrate'])
+        # ffmpeg only maps the first audio stream
+        return stream_bitrate(audio[0], {}) or 128.0
+
+    def kill(self):
+        self.cancelled = True
+        with self._lock:
+            for stream in self.streams:
+                stream.kill()
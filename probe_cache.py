@@ -0,0 +1,129 @@
+'''An on-disk cache of ffprobe results, so a file is only probed again when it changes.'''
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import engine
+
+DEFAULT_NAME = "probe_cache.sqlite"
+MAX_ENTRIES = 20000
+FLUSH_EVERY = 500  # hits whose last_used is held back before it's written
+
+
+class ProbeCache:
+    '''ffprobe results keyed by absolute path, size and mtime.
+
+    A lookup only costs a stat() and an indexed query. Entries are evicted least
+    recently used first once there are more than `max_entries`. A hit's
+    last_used is kept in memory and written with the next put, every
+    `FLUSH_EVERY` hits or on flush(), rather than committed on every lookup.
+    '''
+
+    def __init__(self, path: str | Path, max_entries: int = MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")  # the gui and the daemon may share it
+        self.db.execute("PRAGMA synchronous=NORMAL")  # a lost entry is only probed again
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, data TEXT, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def _key(path: str | Path) -> tuple[str, int, int]:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime_ns
+
+    def get(self, path: str | Path) -> dict | None:
+        key = self._key(path)
+        with self._lock:
+            row = self.db.execute(
+                "SELECT data FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key[0]] = time.time()
+            if len(self._touched) >= FLUSH_EVERY:
+                self._write_touched()
+                self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, path: str | Path, data: dict) -> None:
+        key = self._key(path)
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                (*key, json.dumps(data), time.time())
+            )
+            self._write_touched()  # before evicting, so what was just used stays
+            self._evict()
+            self.db.commit()
+
+    def probe(self, path: str | Path, prober: Callable[[str], dict]) -> dict:
+        '''returns the cached probe of `path`, or runs `prober` and caches its result'''
+        data = self.get(path)
+        if data is None:
+            data = prober(str(path))
+            self.put(path, data)
+        return data
+
+    def flush(self):
+        '''writes the last_used of the hits since the last write'''
+        with self._lock:
+            if self._touched:
+                self._write_touched()
+                self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def _write_touched(self):
+        self.db.executemany("UPDATE probes SET last_used = ? WHERE path = ?",
+                            [(used, path) for path, used in self._touched.items()])
+        self._touched.clear()
+
+    def _evict(self):
+        count = self.db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+        if count > self.max_entries:
+            # drop a tenth at once so this doesn't run on every insert
+            self.db.execute(
+                "DELETE FROM probes WHERE path IN (SELECT path FROM probes ORDER BY last_used LIMIT ?)",
+                (count - int(self.max_entries * 0.9),)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self.db.execute("DELETE FROM probes")
+            self.db.commit()
+
+
+_caches: dict[Path, ProbeCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache() -> ProbeCache:
+    '''the shared cache next to the current config.json'''
+    path = engine.data_path(DEFAULT_NAME)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ProbeCache(path)
+            atexit.register(_caches[path].flush)
+        return _caches[path]
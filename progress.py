@@ -0,0 +1,230 @@
+'''Reads ffmpeg's `-progress -` output without blocking or polling.
+
+ProgressParser turns the raw bytes of the stdout pipe into one ProgressRecord
+per `progress=` block, and ProgressSupervisor watches the stdout and stderr
+pipes of any number of ffmpeg children from a single thread.
+'''
+from __future__ import annotations
+
+import os
+import selectors
+import subprocess
+import sys
+import threading
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+# how much of stderr is kept for error messages
+STDERR_TAIL = 4096
+
+
+def _int(value: str, default: int = 0) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _float(value: str) -> float | None:
+    '''parses "45.2", "1.2x" and "1234.5kbits/s", N/A becomes None'''
+    value = value.rstrip('x').removesuffix('kbits/s')
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+@dataclass
+class ProgressRecord:
+    frame: int = 0
+    fps: float | None = None
+    # kbit/s
+    bitrate: float | None = None
+    total_size: int | None = None
+    out_time_us: int = 0
+    dup_frames: int = 0
+    drop_frames: int = 0
+    speed: float | None = None
+    progress: str = 'continue'
+    # everything else, ie. stream_0_0_q
+    extra: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def finished(self) -> bool:
+        return self.progress == 'end'
+
+    @classmethod
+    def from_dict(cls, dct: dict[str, str]) -> ProgressRecord:
+        record = cls(extra=dct)
+        record.frame = _int(dct.pop('frame', '0'))
+        record.fps = _float(dct.pop('fps', 'N/A'))
+        record.bitrate = _float(dct.pop('bitrate', 'N/A'))
+        record.total_size = _int(dct.pop('total_size', 'N/A'), None)
+        # out_time_ms is also in microseconds, a long standing ffmpeg quirk
+        out_time_us = dct.pop('out_time_us', None)
+        out_time_ms = dct.pop('out_time_ms', '0')
+        record.out_time_us = max(_int(out_time_us or out_time_ms), 0)
+        record.dup_frames = _int(dct.pop('dup_frames', '0'))
+        record.drop_frames = _int(dct.pop('drop_frames', '0'))
+        record.speed = _float(dct.pop('speed', 'N/A'))
+        record.progress = dct.pop('progress', 'continue')
+        return record
+
+
+class ProgressParser:
+    '''Incremental parser for `-progress` output. Feed it whatever bytes arrived,
+    it returns the blocks that were completed by them.'''
+
+    def __init__(self):
+        self.buffer = b""
+        self.block: dict[str, str] = {}
+
+    def feed(self, data: bytes) -> list[ProgressRecord]:
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()  # an unfinished line waits for the next chunk
+        records = []
+        for line in lines:
+            key, sep, value = line.strip().partition(b"=")
+            if not sep:  # blank or garbled line
+                continue
+            key, value = key.decode('utf-8', 'replace'), value.decode('utf-8', 'replace').strip()
+            self.block[key] = value
+            if key == 'progress':
+                records.append(ProgressRecord.from_dict(self.block))
+                self.block = {}
+        return records
+
+
+class Watch:
+    '''A child process being watched by a ProgressSupervisor.'''
+
+    def __init__(self, process: subprocess.Popen,
+                 on_record: Callable[[ProgressRecord], None] | None = None,
+                 on_stderr: Callable[[bytes], None] | None = None):
+        self.process = process
+        self.on_record = on_record
+        self.on_stderr = on_stderr
+        self.parser = ProgressParser()
+        self.last: ProgressRecord | None = None
+        self.returncode: int | None = None
+        self._stderr = b""
+        self._open = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def stderr(self) -> str:
+        '''the last few KiB ffmpeg wrote to stderr'''
+        return self._stderr.decode('utf-8', 'replace').strip()
+
+    def wait(self, timeout: float | None = None) -> int | None:
+        '''blocks until the process exits and both pipes are drained, returns the exit code'''
+        self._done.wait(timeout)
+        return self.returncode
+
+    def _feed(self, is_stderr: bool, data: bytes):
+        if is_stderr:
+            self._stderr = (self._stderr + data)[-STDERR_TAIL:]
+            if self.on_stderr:
+                self.on_stderr(data)
+            return
+        for record in self.parser.feed(data):
+            self.last = record
+            if self.on_record:
+                self.on_record(record)
+
+    def _closed(self):
+        with self._lock:
+            self._open -= 1
+            if self._open > 0:
+                return
+        # reaping happens off the supervisor thread, so a slow exit never stalls the other watches
+        threading.Thread(target=self._reap, daemon=True).start()
+
+    def _reap(self):
+        self.returncode = self.process.wait()
+        self._done.set()
+
+
+class ProgressSupervisor:
+    '''Watches the pipes of many ffmpeg children from one thread.
+
+    The thread sleeps in select() until a child writes something, so there is no
+    polling, and a single supervisor is shared by every running encode. Windows
+    can't select() on pipes, so there each pipe gets a blocking reader thread.
+    '''
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending: list[tuple[int, Watch, bool]] = []
+        self._thread: threading.Thread | None = None
+        self._wakeup_r = self._wakeup_w = None
+
+    def watch(self, process: subprocess.Popen,
+              on_record: Callable[[ProgressRecord], None] | None = None,
+              on_stderr: Callable[[bytes], None] | None = None) -> Watch:
+        '''Starts watching a process started with stdout and/or stderr piped.
+
+        The callbacks are called from the supervisor's thread.
+        '''
+        watch = Watch(process, on_record, on_stderr)
+        pipes = [(pipe.fileno(), is_stderr) for pipe, is_stderr in ((process.stdout, False), (process.stderr, True))
+                 if pipe is not None]
+        watch._open = len(pipes)
+        if not pipes:
+            threading.Thread(target=watch._reap, daemon=True).start()
+            return watch
+
+        if sys.platform == 'win32':
+            for fd, is_stderr in pipes:
+                threading.Thread(target=self._read_blocking, args=(fd, watch, is_stderr), daemon=True).start()
+            return watch
+
+        with self._lock:
+            self._pending.extend((fd, watch, is_stderr) for fd, is_stderr in pipes)
+            if self._thread is None:
+                self._wakeup_r, self._wakeup_w = os.pipe()
+                self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+                self._thread = threading.Thread(target=self._loop, name="ProgressSupervisor", daemon=True)
+                self._thread.start()
+        os.write(self._wakeup_w, b"\0")
+        return watch
+
+    def _loop(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 512)
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for fd, watch, is_stderr in pending:
+                        self.selector.register(fd, selectors.EVENT_READ, (watch, is_stderr))
+                    continue
+
+                watch, is_stderr = key.data
+                try:
+                    data = os.read(key.fd, 65536)
+                except OSError:
+                    data = b""
+                if data:
+                    self._call(watch._feed, is_stderr, data)
+                else:
+                    self.selector.unregister(key.fd)
+                    self._call(watch._closed)
+
+    def _read_blocking(self, fd: int, watch: Watch, is_stderr: bool):
+        while data := os.read(fd, 65536):
+            self._call(watch._feed, is_stderr, data)
+        self._call(watch._closed)
+
+    @staticmethod
+    def _call(func, *args):
+        # a failing callback must not take down every other watched process
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"progress callback failed: {type(e).__name__}: {e}")
+
+
+SUPERVISOR = ProgressSupervisor()
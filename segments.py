@@ -0,0 +1,338 @@
+'''Segment-parallel encoding: one long input is cut at keyframes, the parts are
+encoded by several ffmpeg processes at once and joined losslessly afterwards.'''
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from pathlib import Path
+
+import ffmpeg
+
+from engine import Encoder, byte_format, estimate_frames, frame_rate, media_duration
+from governor import GOVERNOR
+from jobs import partition_threads, wait_all
+from progress import SUPERVISOR, ProgressRecord
+
+# segments shorter than this are merged into their neighbours
+MIN_SEGMENT_LENGTH = 10.0
+
+
+def keyframe_times(path: str, targets: list[float], ffprobe_path: str = 'ffprobe') -> list[float]:
+    '''Finds the keyframe at or before every target time.
+
+    Instead of reading every packet of the file, ffprobe seeks to each target and
+    reports only the first video packet after it, which is the keyframe it landed on.
+    '''
+    if not targets:
+        return []
+    intervals = ",".join(f"{t:.3f}%+#1" for t in targets)
+    out = subprocess.run(
+        [ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-read_intervals', intervals,
+         '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    times = set()
+    for line in out.splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' in flags and pts not in ('', 'N/A'):
+            times.add(float(pts))
+    return sorted(times)
+
+
+def plan_segments(keyframes: list[float], duration: float,
+                  min_length: float = MIN_SEGMENT_LENGTH) -> list[tuple[float, float | None]]:
+    '''Turns keyframe cut points into (start, end) pairs. The last segment has no end.'''
+    bounds = [0.0]
+    for time in sorted(keyframes):
+        if time - bounds[-1] >= min_length and duration - time >= min_length:
+            bounds.append(time)
+    return [(start, end) for start, end in zip(bounds, bounds[1:] + [None])]
+
+
+class SegmentedEncoder(Encoder):
+    '''Encodes the input in keyframe-aligned segments on `segment_workers` ffmpeg
+    processes, joins them with the concat demuxer and adds the audio once over
+    the whole file. The job's thread budget is split across the workers.
+
+    Segments are kept in `.<output>.segments/` next to the output until the
+    join. If the job is interrupted by a crash, running it again with the same
+    input and settings only encodes the segments that weren't finished. A job
+    stopped early joins the segments up to where the encode got.'''
+    # goes into the output_cache key with the worker count
+    cache_tag = 'segmented'
+
+    def __init__(self, config: dict, path: str | None = None):
+        super().__init__(config, path)
+        self.streams: list[subprocess.Popen] = []
+        self._lock = threading.Lock()
+        self.failed = False  # a segment failed, the others are given up
+
+    def run(self):
+        self.check_for_ffmpeg()
+        self.metadata = self._get_metadata(self.ffprobe_path)
+        if self.should_remux():  # a stream copy is i/o bound, splitting it gains nothing
+            return super().run()
+        video_stream = [stream for stream in self.metadata['streams'] if stream['codec_type'] == 'video'][0]
+        self.duration = duration = media_duration(self.metadata)
+        if duration is None:
+            raise ValueError("segmented encoding needs an input with a known duration")
+
+        framerate = frame_rate(video_stream) or Fraction(0)
+        self.frame_count, reliable = estimate_frames(self.config, self.metadata)
+        self.max_prog(self.frame_count)
+
+        workers = self.worker_count()
+        # the cut points depend on the worker count, so the output does too
+        key = self.cache_key(video_stream, [self.cache_tag, workers])
+        if self.reuse_cached(key, self.frame_count):
+            return
+        # a couple of segments per worker so a slow one doesn't hold up the rest
+        count = workers * 2
+        targets = [duration * i / count for i in range(1, count)]
+        segments = plan_segments(keyframe_times(self.path, targets, self.ffprobe_path), duration)
+
+        output = Path(self.config['output'])
+        self.workdir = output.parent / f".{output.name}.segments"
+        self.plan = self._load_plan(segments)
+        # cut half a frame early so each frame lands in exactly one segment
+        # even when the printed keyframe times are rounded
+        half_frame = float(1 / framerate / 2) if framerate else 0
+        paths = [self.workdir / f"segment_{idx:04d}{output.suffix}" for idx in range(len(segments))]
+        finished = {idx for idx in map(int, self.plan['done']) if paths[idx].exists()}
+        self.frames = [self.plan['done'].get(str(idx), 0) for idx in range(len(segments))]
+        self.fps = [0.0] * len(segments)
+        # progress goes by each segment's output time against its length, like Encoder.fraction
+        self.lengths = [(duration if end is None else end) - start for start, end in segments]
+        self.times = [self.lengths[idx] if idx in finished else 0.0 for idx in range(len(segments))]
+        self.done = len(finished)
+        if finished:
+            self.status(f"Resuming, {len(finished)} of {len(segments)} segments were already encoded")
+        try:
+            with self.recorded(self.frame_count):
+                if not reliable:
+                    self.count_frames(video_stream)
+                self._encode_segments(segments, finished, paths, half_frame, video_stream, workers)
+                if self.cancelled:
+                    return
+                if self.stopped:
+                    self._join_stopped(paths)
+                    return
+                self.status("Joining segments...")
+                try:
+                    self._join(paths, self.workdir)
+                except RuntimeError:
+                    if not self.stopped:  # a ctrl+c can reach ffmpeg before it handles signals
+                        raise
+                if self.cancelled:
+                    return
+                if self.stopped:
+                    # finish now came during the join, every segment is encoded though, so all of them are kept
+                    self.status("Every segment was encoded already, joining all of them...")
+                    self._join(paths, self.workdir)
+                self.progress(self.frame_count)
+                self.verify_output()
+                self.cache_output(key)
+                print(f"{self.config['output']} has been created")
+        finally:
+            # a crash never gets here, which is what leaves the segments for a resume
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def worker_count(self) -> int:
+        return max(int(self.config['segment_workers']), 1)
+
+    def _encode_segments(self, segments: list[tuple[float, float | None]], finished: set[int], paths: list[Path],
+                         half_frame: float, video_stream: dict, workers: int):
+        '''encodes the segments that aren't `finished` yet into `paths`'''
+        workers = min(workers, len(segments))
+        threads = partition_threads(int(self.config['threads']), workers)[-1]
+        self.status(f"Encoding {len(segments)} segments on {workers} workers ({threads} threads each)")
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [
+                pool.submit(self._encode_segment, idx, start, end, half_frame, video_stream, paths[idx], threads)
+                for idx, (start, end) in enumerate(segments) if idx not in finished
+            ]
+            wait_all(pool, futures, self._give_up)
+
+    def _load_plan(self, segments: list[tuple[float, float | None]]) -> dict:
+        '''Reads the segments finished by an earlier, interrupted run.
+
+        They're only reused when the input, the cut points and the settings are
+        all the same, otherwise the work directory starts out empty.
+        '''
+        st = os.stat(self.path)
+        plan = json.loads(json.dumps({
+            'input': [st.st_size, st.st_mtime_ns],
+            'segments': segments,
+            # the thread count doesn't change the output
+            'config': {key: value for key, value in self.config.items() if key != 'threads'},
+        }))
+        try:
+            with open(self.workdir / "plan.json") as file:
+                stored = json.load(file)
+            if {key: stored.get(key) for key in plan} == plan:
+                plan['done'] = stored.get('done', {})
+                return plan
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        self.workdir.mkdir(parents=True)
+        plan['done'] = {}
+        self._save_plan(plan)
+        return plan
+
+    def _save_plan(self, plan: dict):
+        tmp = self.workdir / "plan.json.tmp"
+        with open(tmp, 'w') as file:
+            json.dump(plan, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.workdir / "plan.json")
+
+    def _encode_segment(self, idx: int, start: float, end: float | None, half_frame: float,
+                        video_stream: dict, path: Path, threads: int):
+        self._unpaused.wait()
+        if self.cancelled or self.stopped or self.failed:
+            return
+        input_kwargs = {}
+        if start > 0:
+            input_kwargs['ss'] = f"{start - half_frame:.6f}"
+        if end is not None:
+            input_kwargs['to'] = f"{end - half_frame:.6f}"
+        # keep the source timestamps, a constant frame rate would pad every segment's end
+        output_kwargs = {} if self.config['fps'] else {'vsync': 'passthrough'}
+        # written under another name, a segment only gets its own once it's complete
+        partial = path.with_name(f"{path.stem}.partial{path.suffix}")
+        stream = self.get_ffmpeg_stream(video_stream, output=str(partial), input_kwargs=input_kwargs, audio=False,
+                                        threads=threads, output_kwargs=output_kwargs
+                                        ).run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True,
+                                                    cmd=self.ffmpeg_path)
+        with self._lock:
+            self.streams.append(stream)
+            if self.failed:  # started while the others were being killed
+                stream.kill()
+        self._started(stream, threads)
+        watch = SUPERVISOR.watch(stream, lambda record: self._segment_progress(idx, record))
+        if not self.exited_ok(watch.wait()):
+            if self.cancelled:
+                return
+            raise RuntimeError(f"segment {idx} failed with exit code {watch.returncode}: {watch.stderr}")
+        if self.stopped:  # cut short, it stays partial
+            return
+        self._finish_segment(idx, partial, path)
+
+    def _finish_segment(self, idx: int, partial: Path, path: Path):
+        '''gives a complete segment its name and notes it in the plan'''
+        os.replace(partial, path)
+        with self._lock:
+            self.done += 1
+            self.times[idx] = self.lengths[idx]
+            self.plan['done'][str(idx)] = self.frames[idx]
+            self._save_plan(self.plan)
+            self.checkpoint({'workdir': str(self.workdir), 'segments': len(self.frames), 'done': self.done})
+
+    def _segment_progress(self, idx: int, record: ProgressRecord):
+        self.frames[idx] = record.frame
+        self.fps[idx] = (record.fps or 0.0) if not record.finished else 0.0
+        self.times[idx] = min(max(record.out_time_us / 1e6, 0.0), self.lengths[idx])
+        self._report(record)
+
+    def fraction(self, record: ProgressRecord) -> float:
+        '''the output time of all segments together against the input's duration'''
+        return min(sum(self.times) / self.duration, 1.0)
+
+    def _report(self, record: ProgressRecord):
+        fraction = self.fraction(record)
+        percent = 100 * fraction
+        progress = round(fraction * self.frame_count) if self.frame_count > 0 else sum(self.frames)
+        self.progress(progress)
+        if int(20 * fraction) != self._last_title:
+            self._last_title = int(20 * fraction)
+            self.change_title(f"%{percent:.2f}")
+        frames = f"[{sum(self.frames)}" + (f" / {'' if self.frames_exact else '~'}{self.frame_count}]"
+                                           if self.frame_count > 0 else " frames]")
+        dlg = [
+            f"Converting {len(self.frames)} segments ({self.done} done)",
+            f"%{percent:.2f}   {frames}",
+            f"fps: {sum(self.fps):.1f} (all workers)",
+            f"last segment size: {byte_format(str(record.total_size or ''))}",
+        ]
+        if self.estimate is not None:
+            dlg.append(f"eta: {self.estimate.eta(fraction)}")
+        if self.recording is not None:
+            self.recording.sample(record, frame=progress)
+        if readings := GOVERNOR.describe(self):
+            dlg.append(readings)
+        self.status("\n".join(dlg))
+
+    def _join_stopped(self, paths: list[Path]):
+        '''joins the finished segments from the start, and the one that was cut short after them'''
+        parts = []
+        for path in paths:
+            partial = path.with_name(f"{path.stem}.partial{path.suffix}")
+            if path.exists():
+                parts.append(path)
+            elif partial.exists() and partial.stat().st_size > 0:
+                parts.append(partial)
+                break
+            else:
+                break
+        if not parts:
+            self.discard_output()
+            self.status("Stopped before any of the beginning was encoded, nothing was kept")
+            return
+        self.status(f"Stopped early, joining the first {len(parts)} segments...")
+        self._join(parts, self.workdir, shortest=True)
+        if self.cancelled:
+            return
+        self.status(f"Stopped early, {self.config['output']} has what was encoded so far")
+
+    def _join(self, paths: list[Path], workdir: Path, shortest: bool = False):
+        listing = workdir / "segments.txt"
+        listing.write_text("".join(f"file '{path.name}'\n" for path in paths))
+
+        joined = ffmpeg.input(str(listing), f='concat', safe=0)
+        streams = [joined['v']]
+        kwargs = {'c:v': 'copy'}
+        if any(stream['codec_type'] == 'audio' for stream in self.metadata['streams']):
+            streams.append(ffmpeg.input(self.config['input'])['a'])
+            kwargs.update(self.audio_kwargs())
+            if shortest:  # the audio is the whole input's
+                kwargs['shortest'] = None
+        self.stream = (
+            ffmpeg.output(*streams, self.config['output'], **kwargs, loglevel='error')
+            .overwrite_output()
+            .global_args('-nostats', '-hide_banner')
+            .run_async(pipe_stdin=True, pipe_stderr=True, cmd=self.ffmpeg_path)
+        )
+        watch = SUPERVISOR.watch(self.stream)
+        watch.wait()
+        if self.cancelled:
+            self.discard_output()
+            return
+        if not self.exited_ok(watch.returncode):
+            self.discard_output()
+            raise RuntimeError(f"joining segments failed with exit code {watch.returncode}: {watch.stderr}")
+
+    def processes(self) -> list[subprocess.Popen]:
+        with self._lock:
+            return [stream for stream in self.streams if stream.poll() is None] + super().processes()
+
+    def _give_up(self):
+        '''kills the running segments after another one failed, the job isn't cancelled, it failed'''
+        with self._lock:
+            self.failed = True
+            for stream in self.streams:
+                stream.kill()
+
+    def kill(self):
+        self.cancelled = True
+        self._unpaused.set()
+        with self._lock:
+            for stream in self.streams:
+                stream.kill()
+        super().kill()
@@ -0,0 +1,28 @@
+'''The daemon's handling of the job files dropped into its spool.'''
+import argparse
+import json
+
+import cli
+from engine import DEFAULTS
+
+
+def test_daemon_rejects_bad_job_files(tmp_path, monkeypatch):
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    (spool / "good.json").write_text(json.dumps({'input': str(tmp_path / "in.mkv")}))
+    (spool / "no_input.json").write_text(json.dumps({'output': "out.mp4"}))
+    (spool / "list.json").write_text("[1, 2]")
+    (spool / "broken.json").write_text("{")
+
+    def pump(self):  # one pass over the spool, without starting anything
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(cli.Runner, 'pump', pump)
+    args = argparse.Namespace(spool=str(spool), workers=4, threads=4, verbose=False, poll=0.1)
+    assert cli.daemon(args, dict(DEFAULTS)) == 130
+    assert sorted(path.name for path in spool.iterdir()) == [
+        'broken.failed', 'good.running', 'list.failed', 'no_input.failed']
+    failed = json.loads((spool / "no_input.failed").read_text())
+    assert failed['output'] == "out.mp4" and failed['state'] == 'failed'
+    assert failed['error'].startswith("ValueError: a job file holds at least")
+    assert json.loads((spool / "broken.failed").read_text())['error'].startswith("JSONDecodeError")
@@ -0,0 +1,192 @@
+'''The coordinator against workers on localhost: a real WorkerServer, and fake
+ones speaking the protocol that misbehave on purpose.'''
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cluster
+from cluster import Connection, DistributedEncoder, Node, Task, WorkerServer, connect, parse_address
+
+SEGMENT = 2.0  # seconds
+FRAMERATE = 25.0
+
+
+def fake_worker(handle) -> tuple[str, socket.socket]:
+    '''Listens on a free port and answers the handshake, then calls
+    `handle(connection, message, chunk)` for every segment it's sent.'''
+    server = socket.create_server(('127.0.0.1', 0))
+
+    def serve(sock: socket.socket):
+        connection = Connection(sock, "coordinator")
+        try:
+            connection.recv()
+            connection.send({'type': 'hello', 'protocol': cluster.PROTOCOL, 'name': 'fake', 'slots': 1,
+                             'threads': 1})
+            while True:
+                message = connection.recv()
+                chunk = bytes(connection._recv_exactly(int(message['size'])))
+                handle(connection, message, chunk)
+        except (OSError, ValueError):
+            pass
+
+    def accept():
+        while True:
+            try:
+                sock, _ = server.accept()
+            except OSError:
+                break
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return f"127.0.0.1:{server.getsockname()[1]}", server
+
+
+def coordinator(tmp_path, nodes: list[Node], count: int):
+    '''a DistributedEncoder as _encode_segments leaves it, `count` segments to go and the chunks already cut'''
+    encoder = DistributedEncoder({'input': str(tmp_path / "in.mkv"), 'output': str(tmp_path / "out.mp4")})
+    encoder.nodes = nodes
+    encoder.metadata = {'format': {'duration': str(count * SEGMENT)}, 'streams': []}
+    encoder.duration = count * SEGMENT
+    encoder.framerate = FRAMERATE
+    encoder.workdir = tmp_path / "work"
+    encoder.workdir.mkdir()
+    encoder.plan = {'done': {}}
+    encoder.frames, encoder.fps = [0] * count, [0.0] * count
+    encoder.lengths, encoder.times = [SEGMENT] * count, [0.0] * count
+    encoder.done = 0
+    encoder.todo = deque(Task(idx, idx * SEGMENT, (idx + 1) * SEGMENT) for idx in range(count))
+    chunks = [encoder.workdir / f"chunk_{idx:04d}.mkv" for idx in range(count)]
+    for idx, chunk in enumerate(chunks):
+        chunk.write_bytes(f"chunk {idx}".encode())
+    paths = [encoder.workdir / f"segment_{idx:04d}.mp4" for idx in range(count)]
+    return encoder, chunks, paths
+
+
+def drive(encoder: DistributedEncoder, chunks, paths):
+    with ThreadPoolExecutor(len(encoder.nodes)) as pool:
+        futures = [pool.submit(encoder._drive, node, chunks, paths, {}) for node in encoder.nodes]
+        for future in futures:
+            future.result(timeout=30)
+
+
+def test_parse_address():
+    assert parse_address("10.0.0.2:9000") == ('10.0.0.2', 9000)
+    assert parse_address(" render1 ") == ('render1', cluster.DEFAULT_PORT)
+    assert parse_address("render1", default_port=9000) == ('render1', 9000)
+    assert parse_address("[::1]:9000") == ('::1', 9000)
+
+
+def test_defer(tmp_path):
+    slow = Node("slow", None, "slow", 1, frames=100, busy=10.0)  # 10 fps
+    fast = Node("fast", None, "fast", 1, frames=500, busy=10.0)  # 50 fps
+    encoder, _, _ = coordinator(tmp_path, [slow, fast], 1)
+    task = encoder.todo[0]  # 50 frames, 5s on the slow node, 1s on the fast one
+    assert encoder._defer(slow, task)
+    assert not encoder._defer(fast, task)
+
+    # the fast node is busy for longer than the slow one would take
+    fast.current = Task(9, 0.0, 20.0)
+    encoder.frames.extend([0] * 9)
+    assert not encoder._defer(slow, task)
+    encoder.frames[9] = 400  # 100 frames left, 3s with this one
+    assert encoder._defer(slow, task)
+
+    # more segments than faster workers, or a lost one
+    encoder.todo.append(Task(1, SEGMENT, 2 * SEGMENT))
+    assert not encoder._defer(slow, task)
+    encoder.todo.pop()
+    fast.lost = True
+    assert not encoder._defer(slow, task)
+
+    # nothing is known about a new node, it isn't held back
+    assert not encoder._defer(Node("new", None, "new", 1), task)
+
+
+def test_worker_error_is_retried_then_fails(tmp_path, monkeypatch):
+    def broken(self):
+        raise EOFError("no ffmpeg here")
+
+    # not an OSError, which used to kill the worker's thread and leave the coordinator waiting
+    monkeypatch.setattr(cluster.Encoder, 'check_for_ffmpeg', broken)
+    server = WorkerServer({'threads': 1}, '127.0.0.1', 0, workdir=tmp_path / "worker")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        nodes = connect([f"127.0.0.1:{server.address[1]}"])
+        assert len(nodes) == 1
+        encoder, chunks, paths = coordinator(tmp_path, nodes, 1)
+        drive(encoder, chunks, paths)
+    finally:
+        server.close()
+        for node in nodes:
+            node.connection.close()
+    assert isinstance(encoder.error, RuntimeError)
+    assert f"failed {cluster.MAX_ATTEMPTS} times" in str(encoder.error)
+    assert "EOFError: no ffmpeg here" in str(encoder.error)
+    assert not nodes[0].lost
+    assert not paths[0].exists()
+
+
+def test_lost_worker_segment_is_reassigned(tmp_path):
+    lost = threading.Event()
+    encoded = []
+
+    def good(connection: Connection, message: dict, chunk: bytes):
+        # hold the first segment until the other worker is gone, so it surely got one
+        lost.wait(10)
+        encoded.append(message['idx'])
+        connection.send({'type': 'progress', 'frame': 25, 'fps': 50.0, 'total_size': 100,
+                         'out_time_us': int(SEGMENT * 1e6 / 2)})
+        output = tmp_path / f"encoded_{message['idx']}.mp4"
+        output.write_bytes(chunk)
+        connection.send({'type': 'done', 'frames': 50, 'stopped': False}, file=output)
+
+    def bad(connection: Connection, message: dict, chunk: bytes):
+        connection.close()
+        lost.set()
+
+    (good_address, good_server), (bad_address, bad_server) = fake_worker(good), fake_worker(bad)
+    try:
+        nodes = connect([good_address, bad_address])
+        encoder, chunks, paths = coordinator(tmp_path, nodes, 2)
+        drive(encoder, chunks, paths)
+    finally:
+        good_server.close()
+        bad_server.close()
+    assert encoder.error is None
+    assert not encoder.todo
+    assert nodes[1].lost and not nodes[0].lost
+    assert sorted(encoded) == [0, 1]
+    assert [path.read_bytes() for path in paths] == [b"chunk 0", b"chunk 1"]
+    assert encoder.plan['done'] == {'0': 50, '1': 50}
+    assert encoder.times == encoder.lengths
+    assert nodes[0].frames == 100
+
+
+def test_stalled_segment_is_given_up_on(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cluster, 'STALL_TIMEOUT', 0.3)
+
+    def stalled(connection: Connection, message: dict, chunk: bytes):
+        # alive, but the segment never gets anywhere
+        while True:
+            connection.send({'type': 'heartbeat'})
+            time.sleep(0.05)
+
+    address, server = fake_worker(stalled)
+    try:
+        nodes = connect([address])
+        encoder, chunks, paths = coordinator(tmp_path, nodes, 1)
+        drive(encoder, chunks, paths)
+    finally:
+        server.close()
+    assert nodes[0].lost
+    assert [(task.idx, task.attempts) for task in encoder.todo] == [(0, 1)]
+    assert "made no progress" in capsys.readouterr().out
+
+
+def test_unavailable_worker_is_left_out():
+    server = socket.create_server(('127.0.0.1', 0))
+    address = f"127.0.0.1:{server.getsockname()[1]}"
+    server.close()
+    assert connect([address]) == []
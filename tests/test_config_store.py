@@ -0,0 +1,19 @@
+'''WriteBehindConfig's debouncing and its write counts.'''
+import json
+
+from config_store import WriteBehindConfig
+
+
+def test_changes_are_coalesced(tmp_path):
+    path = tmp_path / "config.json"
+    config = WriteBehindConfig(path, {'threads': 1}, autofill=True, delay=60)
+    config.save_on_change = True  # the gui's autosave checkbox, update() asks for the write
+    for threads in range(2, 12):
+        config.update({'threads': threads})
+    assert json.loads(path.read_text()) == {'threads': 1}  # nothing written yet
+    assert config.flush()
+    assert json.loads(path.read_text()) == {'threads': 11}
+    # every change counted once
+    assert (config.requests, config.saves, config.saves_avoided) == (10, 1, 9)
+    assert not config.flush()
+    assert not list(tmp_path.glob(".*.tmp"))
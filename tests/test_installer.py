@@ -0,0 +1,179 @@
+'''installer.download and stream_extract against a local http server that can
+honour or ignore Range requests, cut a response short and serve a corrupted body.'''
+import hashlib
+import http.server
+import io
+import os
+import tarfile
+import threading
+
+import pytest
+
+import installer
+from installer import ChecksumError, download, stream_extract
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 17)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+        body = server.body
+        if server.corrupt:
+            server.corrupt -= 1
+            body = bytes(reversed(body))
+        start = 0
+        if server.honour_range and (requested := self.headers.get('Range')):
+            start = int(requested.removeprefix('bytes=').rstrip('-'))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(body)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if server.cut:  # dies halfway through
+            server.cut -= 1
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.ranges, server.honour_range, server.corrupt, server.cut = [], True, 0, 0
+    server.body = PAYLOAD
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/ffmpeg.zip"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download(server, tmp_path):
+    dest = tmp_path / "ffmpeg.zip"
+    assert download(server.url, dest, SHA256, status=lambda s: None) == dest
+    assert dest.read_bytes() == PAYLOAD
+    assert not (tmp_path / "ffmpeg.zip.part").exists()
+    assert server.ranges == [None]
+
+
+def test_resumes_from_part(server, tmp_path):
+    dest = tmp_path / "ffmpeg.zip"
+    (tmp_path / "ffmpeg.zip.part").write_bytes(PAYLOAD[:1000])
+    messages = []
+    download(server.url, dest, SHA256, status=messages.append)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == ["bytes=1000-"]
+    assert any(message.startswith("Resuming download") for message in messages)
+
+
+def test_resumes_after_interruption(server, tmp_path):
+    server.cut = 1
+    dest = tmp_path / "ffmpeg.zip"
+    messages = []
+    download(server.url, dest, SHA256, status=messages.append)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges[0] is None
+    # from wherever the file got to, the read that failed is lost
+    assert 0 < int(server.ranges[1].removeprefix('bytes=').rstrip('-')) <= len(PAYLOAD) // 2
+    assert len(server.ranges) == 2
+    assert any(message.startswith("Download interrupted") for message in messages)
+
+
+def test_complete_part_gets_416(server, tmp_path):
+    dest = tmp_path / "ffmpeg.zip"
+    (tmp_path / "ffmpeg.zip.part").write_bytes(PAYLOAD)
+    download(server.url, dest, SHA256, status=lambda s: None)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == [f"bytes={len(PAYLOAD)}-"]
+
+
+def test_ignored_range_starts_over(server, tmp_path):
+    server.honour_range = False
+    dest = tmp_path / "ffmpeg.zip"
+    (tmp_path / "ffmpeg.zip.part").write_bytes(b"x" * 1000)  # not even the right bytes
+    download(server.url, dest, SHA256, status=lambda s: None)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == ["bytes=1000-"]
+
+
+def test_checksum_mismatch_is_downloaded_again(server, tmp_path):
+    server.corrupt = 1
+    dest = tmp_path / "ffmpeg.zip"
+    messages = []
+    download(server.url, dest, SHA256, status=messages.append)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == [None, None]
+    assert "Checksum mismatch, downloading again..." in messages
+
+
+def test_checksum_mismatch_fails(server, tmp_path):
+    server.corrupt = 3
+    dest = tmp_path / "ffmpeg.zip"
+    with pytest.raises(ChecksumError):
+        download(server.url, dest, SHA256, status=lambda s: None, attempts=3)
+    assert not dest.exists()
+    assert not (tmp_path / "ffmpeg.zip.part").exists()
+    assert server.ranges == [None] * 3
+
+
+def archive(members: dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:xz') as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+BINARIES = {'ffmpeg-6.0/bin/ffmpeg': os.urandom(300_000), 'ffmpeg-6.0/bin/ffprobe': os.urandom(200_000),
+            'ffmpeg-6.0/README.txt': b"readme"}
+PATHS = {'bin/ffmpeg': 'ffmpeg-6.0/bin/ffmpeg', 'bin/ffprobe': 'ffmpeg-6.0/bin/ffprobe'}
+
+
+@pytest.fixture
+def origin(tmp_path, monkeypatch):
+    monkeypatch.setattr(installer, 'PROGRAM_ORIGIN', tmp_path)
+    (tmp_path / "bin").mkdir()
+    return tmp_path
+
+
+def test_stream_extract(server, origin):
+    server.body = archive(BINARIES)
+    stream_extract(server.url, PATHS, hashlib.sha256(server.body).hexdigest(), status=lambda s: None)
+    assert sorted(path.name for path in (origin / "bin").iterdir()) == ['ffmpeg', 'ffprobe']
+    assert (origin / "bin/ffmpeg").read_bytes() == BINARIES['ffmpeg-6.0/bin/ffmpeg']
+    assert (origin / "bin/ffprobe").read_bytes() == BINARIES['ffmpeg-6.0/bin/ffprobe']
+    if os.name == 'posix':
+        assert os.access(origin / "bin/ffmpeg", os.X_OK)
+
+
+def test_stream_extract_checksum_mismatch(server, origin):
+    (origin / "bin/ffmpeg").write_bytes(b"the working one")
+    server.body = archive(BINARIES)
+    with pytest.raises(ChecksumError):
+        stream_extract(server.url, PATHS, hashlib.sha256(b"something else").hexdigest(), status=lambda s: None)
+    # nothing from the archive, and the binary that was there is still the same
+    assert [path.name for path in (origin / "bin").iterdir()] == ['ffmpeg']
+    assert (origin / "bin/ffmpeg").read_bytes() == b"the working one"
+
+
+def test_stream_extract_missing_member(server, origin):
+    server.body = archive({name: data for name, data in BINARIES.items() if not name.endswith('ffprobe')})
+    with pytest.raises(FileNotFoundError, match="ffprobe"):
+        stream_extract(server.url, PATHS, hashlib.sha256(server.body).hexdigest(), status=lambda s: None)
+    assert list((origin / "bin").iterdir()) == []
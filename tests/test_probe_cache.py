@@ -0,0 +1,45 @@
+'''ProbeCache hits, and when their last_used gets written.'''
+import sqlite3
+
+import probe_cache
+from probe_cache import ProbeCache
+
+
+def last_used(db_path, path) -> float:
+    with sqlite3.connect(db_path) as db:  # another connection only sees what was committed
+        return db.execute("SELECT last_used FROM probes WHERE path = ?", (str(path),)).fetchone()[0]
+
+
+def test_hits_are_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(probe_cache, 'FLUSH_EVERY', 3)
+    files = [tmp_path / f"{idx}.mkv" for idx in range(3)]
+    for file in files:
+        file.write_bytes(b"video")
+    db_path = tmp_path / "probes.sqlite"
+    cache = ProbeCache(db_path)
+    for file in files:
+        cache.put(file, {'format': {'filename': file.name}})
+    stored = last_used(db_path, files[0])
+
+    assert cache.get(files[0]) == {'format': {'filename': "0.mkv"}}
+    assert cache.get(files[1]) is not None
+    assert last_used(db_path, files[0]) == stored  # not committed on every hit
+    assert cache.get(files[2]) is not None
+    assert last_used(db_path, files[0]) > stored  # the third one wrote them all
+
+    cache.get(files[0])
+    cache.close()
+    assert cache.hits == 4 and cache.misses == 0
+    assert last_used(db_path, files[0]) > last_used(db_path, files[1])
+
+
+def test_changed_file_misses(tmp_path):
+    file = tmp_path / "in.mkv"
+    file.write_bytes(b"video")
+    cache = ProbeCache(tmp_path / "probes.sqlite")
+    cache.probe(file, lambda path: {'format': {'size': '5'}})
+    file.write_bytes(b"a longer video")
+    assert cache.get(file) is None
+    assert cache.probe(file, lambda path: {'format': {'size': '14'}}) == {'format': {'size': '14'}}
+    assert (cache.hits, cache.misses) == (0, 3)
+    cache.close()
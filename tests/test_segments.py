@@ -0,0 +1,96 @@
+'''SegmentedEncoder with finish now and cancel arriving while the segments are joined, and a failing segment.'''
+import shutil
+import signal
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import engine
+import segments
+from segments import SegmentedEncoder
+from verify import count_packets
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg")
+
+FRAMES = 200  # 8s at 25 fps
+
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory) -> Path:
+    path = tmp_path_factory.mktemp("source") / "in.mkv"
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=320x240:rate=25:duration=8',
+                    '-f', 'lavfi', '-i', 'sine=duration=8', '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '25',
+                    '-c:a', 'aac', str(path)], check=True)
+    return path
+
+
+@pytest.fixture
+def encoder(source, tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'DATA_DIR', tmp_path)
+    # 2s segments, so a short input still gets a few
+    plan = segments.plan_segments
+    monkeypatch.setattr(segments, 'plan_segments', lambda keyframes, duration: plan(keyframes, duration, 2.0))
+    encoder = SegmentedEncoder({'input': str(source), 'output': str(tmp_path / "out.mp4"), 'speed': 'ultrafast',
+                                'segmented': True, 'segment_workers': 2, 'threads': 2, 'force_encode': True,
+                                'output_cache': False})
+    encoder.status = lambda s: None
+    return encoder
+
+
+def during_join(monkeypatch, action):
+    '''calls `action(process)` as soon as the first join's ffmpeg is started'''
+    supervisor = segments.SUPERVISOR
+    joins = []
+
+    class Supervisor:
+        def watch(self, process, *args):
+            watch = supervisor.watch(process, *args)
+            if 'concat' in process.args:
+                joins.append(process)
+                if len(joins) == 1:
+                    action(process)
+            return watch
+
+    monkeypatch.setattr(segments, 'SUPERVISOR', Supervisor())
+
+
+@pytest.mark.parametrize('how', ['stop', 'ctrl+c'])
+def test_stop_during_join_keeps_everything(encoder, monkeypatch, tmp_path, how):
+    def stop(process):
+        if how == 'ctrl+c':  # the terminal sends ffmpeg a SIGINT too
+            process.send_signal(signal.SIGINT)
+        encoder.stop()
+
+    during_join(monkeypatch, stop)
+    encoder.run()
+    assert encoder.stopped
+    assert count_packets(str(tmp_path / "out.mp4"))[0] >= FRAMES
+    assert encoder.verification.ok
+    assert not encoder.workdir.exists()
+
+
+def test_cancel_during_join(encoder, monkeypatch, tmp_path):
+    during_join(monkeypatch, lambda process: encoder.kill())
+    encoder.run()
+    assert encoder.cancelled
+    assert not (tmp_path / "out.mp4").exists()
+
+
+def test_failed_segment_stops_the_others(encoder, monkeypatch, tmp_path):
+    encode = SegmentedEncoder._encode_segment
+    started = []
+
+    def segment(self, idx, *args):
+        started.append(idx)
+        if idx == 0:
+            raise RuntimeError("segment 0 failed")
+        return encode(self, idx, *args)
+
+    monkeypatch.setattr(SegmentedEncoder, '_encode_segment', segment)
+    encoder.config['segment_workers'] = 1  # the rest wait in the queue
+    with pytest.raises(RuntimeError, match="segment 0 failed"):
+        encoder.run()
+    assert started == [0]
+    assert not encoder.cancelled
+    assert not (tmp_path / "out.mp4").exists()
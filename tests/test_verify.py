@@ -0,0 +1,64 @@
+'''verify.py on real encodes, and check_structure on probe results.'''
+import shutil
+import subprocess
+
+import pytest
+
+import engine
+from engine import DEFAULTS, Encoder
+from verify import Verification, check_structure
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg")
+
+
+def probe(duration=None, video_duration=None, start_time='0.000000', audio=True):
+    metadata = {'format': {'start_time': start_time},
+                'streams': [{'codec_type': 'video', 'codec_name': 'h264', 'r_frame_rate': '25/1',
+                             'avg_frame_rate': '25/1'}]}
+    if duration is not None:
+        metadata['format']['duration'] = str(duration)
+    if video_duration is not None:
+        metadata['streams'][0]['duration'] = str(video_duration)
+    if audio:
+        metadata['streams'].append({'codec_type': 'audio', 'codec_name': 'aac'})
+    return metadata
+
+
+def test_check_structure_falls_back_on_the_video_duration():
+    # a container without a duration, ie. a matroska file written by a live recorder
+    verification = Verification(packets=100)
+    check_structure(verification, DEFAULTS, probe(video_duration=10), probe(duration=4))
+    assert not verification.ok
+    assert verification.problems[0] == "duration is 4.00s, the input's is 10.00s"
+    assert verification.expected_frames == 250
+
+
+def test_check_structure_without_any_duration():
+    verification = Verification(packets=100)
+    check_structure(verification, DEFAULTS, probe(), probe(duration=4))
+    assert verification.ok
+    assert verification.expected_frames == 0  # nothing to expect a frame count from
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('rate', [25, 30])
+def test_metrics_line_up_on_an_aac_primed_input(tmp_path, monkeypatch, rate):
+    monkeypatch.setattr(engine, 'DATA_DIR', tmp_path)
+    source = tmp_path / "primed.mkv"
+    # aac's priming puts the audio, and the container, 23ms before the video
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size=320x240:rate={rate}:duration=12',
+                    '-f', 'lavfi', '-i', 'sine=duration=12', '-c:v', 'libx264', '-preset', 'ultrafast',
+                    '-c:a', 'aac', str(source)], check=True)
+    start = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=start_time', '-of', 'csv=p=0',
+                            str(source)], capture_output=True, text=True, check=True).stdout
+    assert float(start) < 0
+
+    encoder = Encoder({'input': str(source), 'output': str(tmp_path / "out.mp4"), 'speed': 'ultrafast',
+                       'force_encode': True, 'output_cache': False, 'verify_metrics': 'ssim,psnr',
+                       'verify_samples': 6})
+    encoder.status = lambda s: None
+    encoder.run()
+    assert encoder.verification.ok, encoder.verification.problems
+    # a near lossless encode, frames compared one apart score about 0.9
+    assert encoder.verification.metrics['ssim_min'] > 0.99
+    assert encoder.verification.metrics['psnr'] > 40
@@ -0,0 +1,123 @@
+'''Thumbnails and contact sheets for previewing files before converting them.
+
+Every tile is a separate ffmpeg seeking on the input side and decoding only the
+keyframe it lands on, so a tile costs one frame no matter how long the file is.
+The tiles are extracted on a worker pool, joined with the tile filter, and the
+sheet is cached under a fingerprint of the file and the sheet's settings.
+'''
+from __future__ import annotations
+
+import hashlib
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import engine
+from engine import CPU_COUNT, even, find_ffmpeg, sample_aspect_ratio
+
+DEFAULT_DIR = "thumbnails"
+COLUMNS = 4
+ROWS = 4
+TILE_WIDTH = 320
+# the tiles mostly wait on seeks, so there can be more of them than cores
+WORKERS = min(CPU_COUNT * 2, 16)
+
+
+def fingerprint(path: str | Path) -> str:
+    '''absolute path, size and mtime, like the probe cache'''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return hashlib.sha1(f"{path}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()
+
+
+def tile_times(duration: float, count: int) -> list[float]:
+    '''the middle of `count` equal parts of the file, so the first and last tiles aren't black
+
+    >>> tile_times(100, 4)
+    [12.5, 37.5, 62.5, 87.5]
+    '''
+    return [duration * (idx + 0.5) / count for idx in range(count)]
+
+
+def tile_size(video: dict, width: int = TILE_WIDTH) -> tuple[int, int]:
+    '''the tile size for a video stream, keeping its display aspect ratio with even sides'''
+    aspect = int(video['width']) * sample_aspect_ratio(video) / int(video['height'])
+    return even(width), even(width / aspect)
+
+
+def extract_tile(path: str, seconds: float, size: tuple[int, int], ffmpeg_path: str = 'ffmpeg') -> bytes | None:
+    '''One raw rgb24 frame from the keyframe at or before `seconds`, None if there's none.
+
+    -skip_frame nokey makes the decoder throw away everything but keyframes,
+    so together with the input side seek only a single frame is decoded.
+    '''
+    result = subprocess.run(
+        [ffmpeg_path, '-v', 'error', '-nostdin', '-skip_frame', 'nokey', '-noaccurate_seek', '-ss', f"{seconds:.3f}",
+         # passthrough, the keyframe is usually before `seconds` and would be dropped as late
+         '-i', path, '-map', '0:v:0', '-frames:v', '1', '-vsync', 'passthrough', '-vf', f"scale={size[0]}:{size[1]}",
+         '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+        capture_output=True
+    )
+    frame = result.stdout
+    return frame if result.returncode == 0 and len(frame) == size[0] * size[1] * 3 else None
+
+
+def contact_sheet(path: str | Path, columns: int = COLUMNS, rows: int = ROWS, width: int = TILE_WIDTH,
+                  output: str | Path | None = None, workers: int = WORKERS,
+                  metadata: dict | None = None) -> Path:
+    '''Builds (or gets from the cache) a `columns`x`rows` sheet of `width` pixel wide tiles.
+
+    Parameters
+    ----------
+    path : str | Path
+        the video
+    columns, rows : int, optional
+        the grid, 1x1 is a single thumbnail, by default 4x4
+    width : int, optional
+        the width of a tile, by default TILE_WIDTH
+    output : str | Path, optional
+        where to copy the sheet to, by default it's only kept in the cache
+    workers : int, optional
+        tiles extracted at once, by default WORKERS
+    metadata : dict, optional
+        an ffprobe result of `path`, probed (through the probe cache) if not given
+    '''
+    path = str(path)
+    cache_dir = engine.data_path(DEFAULT_DIR)
+    cached = cache_dir / f"{fingerprint(path)}-{columns}x{rows}-{width}.jpg"
+    if not cached.exists():
+        ffmpeg_path, ffprobe_path = find_ffmpeg()
+        if metadata is None:
+            import ffmpeg
+            from probe_cache import get_cache
+            metadata = get_cache().probe(path, lambda file: ffmpeg.probe(file, cmd=ffprobe_path or 'ffprobe'))
+        video = [stream for stream in metadata['streams'] if stream['codec_type'] == 'video'][0]
+        size = tile_size(video, width)
+        times = tile_times(float(metadata['format'].get('duration', 0)), columns * rows)
+
+        with ThreadPoolExecutor(max(min(workers, len(times)), 1)) as pool:
+            tiles = list(pool.map(lambda seconds: extract_tile(path, seconds, size, ffmpeg_path or 'ffmpeg'), times))
+        if not any(tiles):
+            raise RuntimeError(f"no frames could be read from {path}")
+        blank = bytes(size[0] * size[1] * 3)
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_name(f".{cached.stem}.{os.getpid()}.jpg")
+        subprocess.run(
+            [ffmpeg_path or 'ffmpeg', '-v', 'error', '-nostdin', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+             '-s', f"{size[0]}x{size[1]}", '-i', 'pipe:0', '-vf', f"tile={columns}x{rows}",
+             '-frames:v', '1', '-q:v', '3', str(tmp)],
+            input=b"".join(tile or blank for tile in tiles), check=True, capture_output=True
+        )
+        os.replace(tmp, cached)  # a sheet that's being written is never picked up
+
+    if output is not None:
+        Path(output).write_bytes(cached.read_bytes())
+        return Path(output)
+    return cached
+
+
+def thumbnail(path: str | Path, width: int = TILE_WIDTH, metadata: dict | None = None) -> Path:
+    '''a single frame from the middle of the file'''
+    return contact_sheet(path, 1, 1, width, metadata=metadata)
@@ -1,19 +1,11 @@
-import json
-import os
 import shutil
-import subprocess
-import sys
-import tarfile
 import time
-import zipfile
-
-import wget
-
 
 
 class Timer:
     def __init__(self, timestamp: int | None = None):
         self.time = timestamp or time.perf_counter()
+        self.laps: list[tuple[str, float]] = []
 
     def print(self, msg: str = ""):
         '''print and resets time'''
@@ -29,15 +21,34 @@ class Timer:
         self.time = time.perf_counter()
         return self.time
 
+    def lap(self, name: str) -> float:
+        '''records the time since the last lap or reset under `name`, then resets'''
+        elapsed = time.perf_counter() - self.time
+        self.laps.append((name, elapsed))
+        self.reset()
+        return elapsed
+
+    @property
+    def total(self) -> float:
+        return sum(elapsed for _, elapsed in self.laps)
+
+    def report(self) -> str:
+        '''a table of every lap and the total, in milliseconds'''
+        rows = self.laps + [("total", self.total)]
+        width = max(len(name) for name, _ in rows)
+        return "\n".join(f"{name:<{width}}  {elapsed * 1000:8.1f} ms" for name, elapsed in rows)
+
     def __str__(self): return self.__repr__()
 
     def __repr__(self): return str((time.perf_counter()) - self.time)
 
 
 # custom progress bar (slightly modified) [https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console]
-def progress_bar(iteration: int, total: int, length: int = max(os.get_terminal_size()[0]//6, 10),
+def progress_bar(iteration: int, total: int, length: int | None = None,
                 Print=False, fill="#", nullp="-", corner="[]", color=True,
                 end="\r", pref='', suff=''):
+    if length is None:  # measured per call, there may be no terminal at import time
+        length = max(shutil.get_terminal_size()[0]//6, 10)
     color1, color2 = "\033[93m", "\033[92m"
     filledLength = length * iteration // total
 
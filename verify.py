@@ -0,0 +1,228 @@
+'''Checks a finished output against its input without decoding all of it.
+
+The structural check compares the probed duration and stream layout, and
+counts the video packets with ffprobe, which only reads the container. A
+truncated or cut off file fails it. Quality metrics (SSIM, PSNR and VMAF when
+ffmpeg has libvmaf) are measured on a few short windows spread through the
+file, each compared by its own ffmpeg process, so a long file takes seconds.
+'''
+from __future__ import annotations
+
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from fractions import Fraction
+from functools import cache
+
+from engine import estimate_frames, frame_rate, media_duration
+from jobs import partition_threads
+
+METRICS = ['ssim', 'psnr', 'vmaf']
+SAMPLE_COUNT = 8
+# seconds of video compared per sample
+SAMPLE_LENGTH = 1.0
+# outputs may be this much shorter or longer than the input
+DURATION_TOLERANCE = 0.5  # seconds
+FRAME_TOLERANCE = 0.01
+
+_SSIM = re.compile(r"SSIM .*All:([\d.]+)")
+_PSNR = re.compile(r"PSNR .*average:([\d.]+|inf)")
+_VMAF = re.compile(r"VMAF score: ([\d.]+)")
+
+
+class VerificationError(RuntimeError):
+    '''the output failed the structural check'''
+
+
+@dataclass
+class Verification:
+    ok: bool = True
+    problems: list[str] = field(default_factory=list)
+    duration: float = 0.0
+    packets: int = 0
+    expected_frames: int = 0
+    # metric -> mean over the samples, ssim_min is the worst sample
+    metrics: dict[str, float] = field(default_factory=dict)
+    samples: int = 0
+    seconds: float = 0.0  # how long verifying took
+
+    def problem(self, text: str):
+        self.ok = False
+        self.problems.append(text)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self):
+        if not self.ok:
+            return f"verification failed: {'; '.join(self.problems)}"
+        text = f"verified, {self.packets} frames"
+        if self.metrics:
+            text += ", " + ", ".join(f"{name} {value:.4g}" for name, value in self.metrics.items())
+            text += f" ({self.samples} samples)"
+        return text
+
+
+@cache
+def available_metrics(ffmpeg_path: str = 'ffmpeg') -> frozenset[str]:
+    '''the metrics this ffmpeg build has filters for'''
+    out = subprocess.run([ffmpeg_path, '-hide_banner', '-filters'], capture_output=True, text=True).stdout
+    names = {line.split()[1] for line in out.splitlines() if len(line.split()) > 1}
+    return frozenset({'ssim', 'psnr'} & names | ({'vmaf'} if 'libvmaf' in names else set()))
+
+
+def count_packets(path: str, ffprobe_path: str = 'ffprobe') -> tuple[int, str]:
+    '''the number of video packets, and whatever errors ffprobe ran into reading them'''
+    result = subprocess.run(
+        [ffprobe_path, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+         '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', path],
+        capture_output=True, text=True
+    )
+    packets = result.stdout.strip().split(',')[0]
+    return int(packets) if packets.isdigit() else 0, result.stderr.strip()
+
+
+def _streams(metadata: dict, kind: str) -> list[dict]:
+    return [stream for stream in metadata['streams'] if stream['codec_type'] == kind]
+
+
+def check_structure(verification: Verification, config: dict, source: dict, output: dict):
+    '''compares the duration, stream layout and frame count of the output with the input'''
+    source_duration = media_duration(source) or 0.0
+    verification.duration = duration = media_duration(output) or 0.0
+    if source_duration and abs(duration - source_duration) > max(DURATION_TOLERANCE, source_duration * 0.001):
+        verification.problem(f"duration is {duration:.2f}s, the input's is {source_duration:.2f}s")
+
+    videos = _streams(output, 'video')
+    if len(videos) != 1:
+        verification.problem(f"{len(videos)} video streams")
+    elif videos[0].get('codec_name') != 'h264':
+        verification.problem(f"video is {videos[0].get('codec_name')}, not h264")
+    if _streams(source, 'audio') and not _streams(output, 'audio'):
+        verification.problem("the audio is missing")
+
+    # r_frame_rate is only the base rate of a variable frame rate input, its frame count can't be told
+    # from the probe then and the duration check above has to do
+    expected, reliable = estimate_frames(config, source)
+    if videos and reliable and expected > 0:
+        verification.expected_frames = expected
+        rate = expected / source_duration if source_duration else 0
+        slack = max(expected * FRAME_TOLERANCE, rate * DURATION_TOLERANCE)
+        if abs(verification.packets - expected) > slack:
+            verification.problem(f"{verification.packets} frames, expected about {expected}")
+
+
+def _container_start(metadata: dict) -> float:
+    '''the container's start time, which ffmpeg adds to -ss'''
+    return float(metadata['format'].get('start_time') or 0)
+
+
+def _frame_time(metadata: dict, time: float) -> float:
+    '''the time of the video frame closest to `time`, both on the container's time'''
+    video = _streams(metadata, 'video')[0]
+    rate = frame_rate(video)
+    if not rate:
+        return time
+    origin = float(video.get('start_time') or 0) - _container_start(metadata)
+    return max(origin + round((time - origin) * rate) / rate, 0.0)
+
+
+def compare_window(source_path: str, output_path: str, source_start: float, output_start: float, start: float,
+                   length: float, size: tuple[int, int], metrics: list[str], rate: Fraction | None = None,
+                   threads: int = 1, ffmpeg_path: str = 'ffmpeg') -> dict[str, float]:
+    '''Measures `metrics` on `length` seconds from `start` of both files.
+
+    The input is scaled to match the output, and the fps filter puts both on
+    the output's frame `rate` from `start`, one of the output's frames, so
+    the frames are compared pairwise by when they're shown. The timestamps
+    are kept, less each container's start time, like -ss counts them.
+    Numbering the frames from each seek instead pairs them one apart when the
+    video starts a bit after the audio (ie. aac priming) in one file and not
+    in the other.
+    '''
+    grid = f",fps={rate}:start_time={start:.6f}:round=near" if rate else ""
+    graph = [f"[0:v]settb=AVTB,setpts=PTS-{output_start:.6f}/TB{grid},split={len(metrics)}"
+             + "".join(f"[d{idx}]" for idx in range(len(metrics))),
+             f"[1:v]scale={size[0]}:{size[1]}:flags=bicubic,settb=AVTB,setpts=PTS-{source_start:.6f}/TB{grid},"
+             f"split={len(metrics)}" + "".join(f"[r{idx}]" for idx in range(len(metrics)))]
+    for idx, metric in enumerate(metrics):
+        graph.append(f"[d{idx}][r{idx}]{'libvmaf' if metric == 'vmaf' else metric}")
+    # half a frame early, so the frames closest to `start` are in
+    early = float(1 / rate / 2) if rate else 0.0
+    seek = ['-ss', f"{max(start - early, 0.0):.6f}", '-t', f"{length + early:.3f}"]
+    result = subprocess.run(
+        [ffmpeg_path, '-hide_banner', '-nostdin', '-nostats', '-threads', str(threads), '-copyts',
+         *seek, '-i', output_path, *seek, '-i', source_path,
+         '-filter_complex', ";".join(graph), '-f', 'null', '-'],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"comparing at {start:.1f}s failed: {result.stderr.strip()[-500:]}")
+    scores = {}
+    for metric, pattern in (('ssim', _SSIM), ('psnr', _PSNR), ('vmaf', _VMAF)):
+        if metric in metrics and (match := pattern.search(result.stderr)):
+            scores[metric] = float(match.group(1))
+    return scores
+
+
+def verify(config: dict, source: dict, output_path: str, ffmpeg_path: str = 'ffmpeg', ffprobe_path: str = 'ffprobe',
+           metrics: list[str] = (), samples: int = SAMPLE_COUNT, length: float = SAMPLE_LENGTH,
+           threads: int = 1) -> Verification:
+    '''Checks `output_path` against the input probed as `source`.
+
+    Parameters
+    ----------
+    config : dict
+        the job's settings
+    source : dict
+        the ffprobe result of the input
+    output_path : str
+        the output to check
+    metrics : list[str], optional
+        any of METRICS, measured on `samples` windows of `length` seconds. Ones
+        the local ffmpeg doesn't have are skipped, by default none
+    threads : int, optional
+        split across the sample workers, by default 1
+    '''
+    import ffmpeg
+
+    start = time.perf_counter()
+    verification = Verification()
+    try:
+        output = ffmpeg.probe(output_path, cmd=ffprobe_path)
+    except ffmpeg.Error as e:
+        stderr = e.stderr.decode(errors='replace').strip().splitlines()
+        verification.problem(f"the output can't be read: {stderr[-1] if stderr else e}")
+        return verification
+    verification.packets, errors = count_packets(output_path, ffprobe_path)
+    if errors:
+        verification.problem(f"errors reading the output: {errors.splitlines()[0]}")
+    check_structure(verification, config, source, output)
+
+    metrics = [metric for metric in metrics if metric in available_metrics(ffmpeg_path)]
+    if metrics and verification.ok and verification.duration > 0:
+        video = _streams(output, 'video')[0]
+        length = min(length, verification.duration / samples)
+        starts = [_frame_time(output, (verification.duration - length) * (idx + 0.5) / samples)
+                  for idx in range(samples)]
+        workers = min(samples, max(threads, 1))
+        shares = partition_threads(threads, workers)
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(
+                lambda idx: compare_window(config['input'], output_path, _container_start(source),
+                                           _container_start(output), starts[idx], length,
+                                           (int(video['width']), int(video['height'])), metrics, frame_rate(video),
+                                           shares[idx % workers], ffmpeg_path),
+                range(samples)
+            ))
+        for metric in metrics:
+            values = [scores[metric] for scores in results if metric in scores]
+            if values:
+                verification.metrics[metric] = sum(values) / len(values)
+                if metric == 'ssim':
+                    verification.metrics['ssim_min'] = min(values)
+        verification.samples = samples
+    verification.seconds = time.perf_counter() - start
+    return verification
@@ -0,0 +1,261 @@
+'''Converts videos as they are dropped into a folder.
+
+New files are noticed through inotify, or by polling the directories on
+filesystems that don't support it (network shares, most of the time). A file
+is only queued once its size and mtime have stopped changing for a while, and
+files that already have a `-converted` output are skipped. The queue is only
+fed while it's short, the rest of a burst waits here as paths.
+'''
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+from collections import deque
+from collections.abc import Callable
+from pathlib import Path
+
+from engine import IMAGE_FORMATS, VIDEO_EXTENSIONS
+from jobs import JobQueue, converted_path
+
+# seconds a file's size and mtime have to stay the same before it's queued
+SETTLE_TIME = 5.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# no IN_MODIFY, a file being copied in would send thousands of them
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by the name
+
+# the stems converted_path() gives, ie. clip-converted, clip-converted-30fps
+_OUTPUT_STEM = re.compile(r"-converted(-[\d.]+fps)?$")
+
+
+def is_output(path: Path) -> bool:
+    '''whether the file looks like something converted_path() named'''
+    return bool(_OUTPUT_STEM.search(path.stem))
+
+
+def already_converted(path: Path, config: dict) -> bool:
+    output = converted_path(path, config)
+    # image sequences are a directory of their own
+    return (output.parent if config['extension'] in IMAGE_FORMATS else output).exists()
+
+
+class InotifySource:
+    '''Recursive inotify watches on a tree, through libc'''
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+        self.watches: dict[int, Path] = {}
+
+    def add_tree(self, path: Path) -> list[Path]:
+        '''watches `path` and every directory under it, returns the files already in there'''
+        files = []
+        for directory, dirnames, filenames in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch {directory}: "
+                                                  f"{os.strerror(ctypes.get_errno())}")
+            self.watches[wd] = Path(directory)
+            files.extend(Path(directory, name) for name in filenames)
+        return files
+
+    def read(self, timeout: float) -> tuple[list[Path], bool]:
+        '''the files that were created or written to, and whether the kernel dropped events'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return [], False
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return [], False
+        files, overflowed, offset = [], False, 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+            elif mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches and name:
+                path = self.watches[wd] / os.fsdecode(name)
+                if mask & IN_ISDIR:
+                    # a directory moved or copied in may already have files in it
+                    files.extend(self.add_tree(path))
+                else:
+                    files.append(path)
+        return files, overflowed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+
+
+class PollingSource:
+    '''Rescans only the directories whose mtime changed, which is when entries were added or removed'''
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.dirs: dict[Path, int] = {}
+
+    def add_tree(self, path: Path) -> list[Path]:
+        files = []
+        for directory, dirnames, filenames in os.walk(path):
+            try:
+                self.dirs[Path(directory)] = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            files.extend(Path(directory, name) for name in filenames)
+        return files
+
+    def read(self, timeout: float) -> tuple[list[Path], bool]:
+        time.sleep(timeout)
+        files = []
+        for directory, mtime in list(self.dirs.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self.dirs[directory]
+                continue
+            if current == mtime:
+                continue
+            self.dirs[directory] = current
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if Path(entry.path) not in self.dirs:
+                            files.extend(self.add_tree(Path(entry.path)))
+                    else:
+                        files.append(Path(entry.path))
+        return files, False
+
+    def close(self):
+        pass
+
+
+class WatchFolder:
+    '''Feeds new, settled files under `root` into a JobQueue.
+
+    Parameters
+    ----------
+    root : str | Path
+        the folder to watch, subfolders included
+    config : dict
+        the settings every job is converted with
+    queue : JobQueue
+        where the jobs go, draining it is up to the caller
+    settle : float, optional
+        seconds a file has to stay unchanged, by default SETTLE_TIME
+    max_pending : int, optional
+        no more jobs are queued while this many are waiting, by default twice the workers
+    polling : bool, optional
+        poll instead of using inotify, by default False (it's still used as the fallback)
+    '''
+
+    def __init__(self, root: str | Path, config: dict, queue: JobQueue, settle: float = SETTLE_TIME,
+                 max_pending: int | None = None, polling: bool = False,
+                 status: Callable[[str], None] = print):
+        self.root = Path(root).resolve()
+        self.config = config
+        self.queue = queue
+        self.settle = settle
+        self.max_pending = max_pending or max(queue.workers * 2, 2)
+        self.status = status
+        self.source = None
+        if not polling:
+            try:
+                self.source = InotifySource(self.root)
+                files = self.source.add_tree(self.root)
+            except (OSError, AttributeError) as e:  # AttributeError: no inotify in this libc
+                status(f"inotify is unavailable ({e}), polling instead")
+                if self.source is not None:
+                    self.source.close()
+                    self.source = None
+        if self.source is None:
+            self.source = PollingSource(self.root)
+            files = self.source.add_tree(self.root)
+        # path -> (size, mtime_ns, when it last changed)
+        self.candidates: dict[Path, tuple[int, int, float]] = {}
+        self.ready: deque[Path] = deque()
+        # path -> (size, mtime_ns) when it was queued or skipped, so it isn't looked at again
+        self.handled: dict[Path, tuple[int, int]] = {}
+        self.consider(files)
+
+    def consider(self, files: list[Path]):
+        '''starts the stability check of files that aren't known yet'''
+        now = time.monotonic()
+        for path in files:
+            if path in self.candidates or path.suffix.lower() not in VIDEO_EXTENSIONS \
+                    or path.name.startswith('.') or is_output(path):
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if self.handled.get(path) == (st.st_size, st.st_mtime_ns):
+                continue
+            self.candidates[path] = (st.st_size, st.st_mtime_ns, now)
+
+    def check_candidates(self):
+        '''moves the files that stopped changing to `ready`'''
+        now = time.monotonic()
+        for path, (size, mtime, since) in list(self.candidates.items()):
+            try:
+                st = path.stat()
+            except OSError:
+                del self.candidates[path]  # deleted or moved away before it settled
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                self.candidates[path] = (st.st_size, st.st_mtime_ns, now)
+            elif now - since >= self.settle and size > 0:
+                del self.candidates[path]
+                self.handled[path] = (size, mtime)
+                if already_converted(path, self.config):
+                    self.status(f"skipping {path.name}, it was converted already")
+                else:
+                    self.ready.append(path)
+
+    def feed(self) -> int:
+        '''queues ready files while the queue is short, returns how many'''
+        count = 0
+        while self.ready and len(self.queue.pending) < self.max_pending:
+            path = self.ready.popleft()
+            output = converted_path(path, self.config)
+            self.queue.add(str(path), str(output), self.config)
+            count += 1
+        return count
+
+    def step(self, timeout: float = 1.0) -> int:
+        '''waits up to `timeout` for changes, then queues what's ready'''
+        # don't sleep through a settle time that's about to run out
+        files, overflowed = self.source.read(min(timeout, self.settle / 2) if self.candidates else timeout)
+        if overflowed:
+            self.status("the inotify queue overflowed, rescanning")
+            files = self.source.add_tree(self.root)
+        self.consider(files)
+        self.check_candidates()
+        return self.feed()
+
+    @property
+    def backlog(self) -> int:
+        '''files waiting to settle or for room in the queue'''
+        return len(self.candidates) + len(self.ready)
+
+    def close(self):
+        self.source.close()